@@ -0,0 +1,59 @@
+"""
+Fixtures for the benchmarks.
+
+The benchmarks use pytest-benchmark, peak memory of the benchmarked
+functions is stored in the extra_info of the benchmark results.
+The model and result caches are written to a temporary directory (not to
+the user's cache). Machine-readable results are written with
+
+    pytest benchmarks --benchmark-json=bench_output.json
+"""
+import resource
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import matplotlib
+matplotlib.use("Agg")
+
+from liverfunction import simulation as lfsim
+from liverfunction.tests import data
+# model and result caches of the session in a temporary directory (autouse)
+from liverfunction.tests.conftest import cache_dir  # noqa: F401
+
+
+def peak_memory(f, *args, **kwargs):
+    """ Peak memory [bytes] of Python allocations (including NumPy) of function call. """
+    tracemalloc.start()
+    try:
+        f(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+@pytest.fixture
+def measure(benchmark):
+    """ Benchmarks function and stores the peak memory in the results. """
+    def run(f, *args, pedantic=False, rounds=1, **kwargs):
+        benchmark.extra_info["peak_memory"] = peak_memory(f, *args, **kwargs)
+        if pedantic:
+            result = benchmark.pedantic(f, args=args, kwargs=kwargs, rounds=rounds, iterations=1)
+        else:
+            result = benchmark(f, *args, **kwargs)
+        benchmark.extra_info["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
+    return run
+
+
+@pytest.fixture(scope="module")
+def model():
+    return lfsim.load_model(data.APAP_SBML)
+
+
+@pytest.fixture(scope="module")
+def dosing():
+    return lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
@@ -0,0 +1,125 @@
+"""
+Benchmarks of the simulation and pharmacokinetic hot paths.
+
+    pytest benchmarks --benchmark-json=bench_output.json
+"""
+import sys
+import subprocess
+
+import numpy as np
+import pytest
+from matplotlib import pyplot as plt
+
+from liverfunction import simulation as lfsim
+from liverfunction import pharmacokinetic as pk
+from liverfunction import cache
+from liverfunction.tests import data
+
+
+TEND = 10 * 60
+STEPS = 600
+
+
+def test_load_model(measure):
+    measure(lfsim.load_model, data.APAP_SBML, cache=False, pedantic=True, rounds=3)
+
+
+def test_load_model_cached(measure):
+    lfsim.load_model(data.APAP_SBML)
+    measure(lfsim.load_model, data.APAP_SBML)
+
+
+def test_load_model_disk_cache(measure):
+    lfsim.load_model(data.APAP_SBML)
+
+    def load():
+        cache.clear_model_cache()
+        return lfsim.load_model(data.APAP_SBML)
+
+    measure(load)
+
+
+def test_set_dosing(measure, model, dosing):
+    measure(lfsim.set_dosing, model, dosing)
+
+
+def test_simulate(measure, model, dosing):
+    measure(lfsim.simulate, model, TEND, STEPS, dosing)
+
+
+def test_simulate_outputs(measure, model, dosing):
+    measure(lfsim.simulate, model, TEND, STEPS, dosing, outputs=["Ave_apap"], as_frame=False)
+
+
+def test_simulate_sensitivity(measure, model, dosing):
+    parameters = lfsim.parameters_for_sensitivity(model, data.APAP_SBML)
+    measure(lfsim.simulate, model, TEND, STEPS, dosing, parameters=parameters,
+            pedantic=True, rounds=1)
+
+
+def test_parameters_for_sensitivity(measure, model):
+    measure(lfsim.parameters_for_sensitivity, model, data.APAP_SBML)
+
+
+@pytest.fixture(scope="module")
+def curves():
+    t = np.linspace(0, 24, num=STEPS+1)
+    ka = np.linspace(0.5, 3.0, num=1000)[:, np.newaxis]
+    ke = np.linspace(0.05, 0.3, num=1000)[:, np.newaxis]
+    c = 10.0 * ka/(ka - ke) * (np.exp(-ke*t) - np.exp(-ka*t))
+    return t, c
+
+
+def test_import_pharmacokinetic(measure):
+    # fresh interpreter, so the import is not cached in sys.modules
+    measure(subprocess.check_call, [sys.executable, "-c", "import liverfunction.pharmacokinetic"],
+            pedantic=True, rounds=5)
+
+
+def test_f_pk(measure, curves):
+    t, c = curves
+    measure(pk.f_pk, t, c[0, :], compound="apap", dose=2000)
+
+
+def test_f_pk_loop(measure, curves):
+    t, c = curves
+
+    def f_pk_loop():
+        return [pk.f_pk(t, c[k, :], compound="apap", dose=2000) for k in range(c.shape[0])]
+
+    measure(f_pk_loop, pedantic=True, rounds=3)
+
+
+def test_f_pk_batch(measure, curves):
+    t, c = curves
+    measure(pk.f_pk_batch, t, c, compound="apap", dose=2000)
+
+
+def test_add_line(measure, model, dosing):
+    from liverfunction import plotting
+    parameters = dict(list(lfsim.parameters_for_sensitivity(model, data.APAP_SBML).items())[:10])
+    s = lfsim.simulate(model, TEND, STEPS, dosing, parameters=parameters)
+
+    def render():
+        f, ax = plt.subplots(1, 1)
+        for yid in ["Ave_apap", "Ave_apap_glu", "Ave_apap_sul", "Ave_apap_cys"]:
+            plotting.add_line(xid="time", yid=yid, ax=ax, s=s, label=yid)
+        f.canvas.draw()
+        plt.close(f)
+
+    measure(render)
+
+
+def test_add_lines(measure, model, dosing):
+    from liverfunction import plotting
+    parameters = dict(list(lfsim.parameters_for_sensitivity(model, data.APAP_SBML).items())[:10])
+    s = lfsim.simulate(model, TEND, STEPS, dosing, parameters=parameters)
+    yids = [c for c in s.mean.columns if c.startswith("Ave_") or c.startswith("Cve_")]
+
+    def render():
+        f, ax = plt.subplots(1, 1)
+        plotting.add_lines("time", [(s, yid, "black", yid) for yid in yids], ax)
+        f.canvas.draw()
+        plt.close(f)
+
+    measure(render)
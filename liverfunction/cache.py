@@ -0,0 +1,428 @@
+"""
+Caching of compiled models and model metadata.
+
+Loading a model with roadrunner parses the SBML and JIT compiles
+the model which takes seconds for the whole-body models.
+The compiled models are cached
+- in process as LRU of the serialized model states
+- on disk as roadrunner state files (saveState/loadState)
+
+The cache is keyed by the hash of the SBML content and the roadrunner
+version, so changes to the model file or roadrunner invalidate the cache.
+Compiled models are stored once under the hash of the SBML of the loaded
+model (RoadRunner.getSBML), which is also the SBML the worker processes
+load. Sources with a different serialization (e.g. a model file) are
+mapped to this key by small alias files.
+The metadata index of the model parameters (see model_index) is stored
+next to the compiled models.
+
+Simulation results can be memoized on disk (see simulation.simulate with
+cache=True). The results are stored as npz files keyed by the hash of all
+simulation settings, the size of the result cache is bounded by
+RESULT_CACHE_SIZE with least recently used results evicted first.
+The cache directory can be set via the LIVERFUNCTION_CACHE environment
+variable.
+
+roadrunner and libsbml are imported by the functions which use them, so
+the cache directory is available (e.g. for the data cache) without
+loading the simulation stack.
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import types
+import functools
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    "LIVERFUNCTION_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "liverfunction")
+)
+MODEL_CACHE_SIZE = 8
+RESULT_CACHE_SIZE = 1024**3  # [bytes]
+
+# in-process LRU of serialized model states {key: state}
+_model_states = OrderedDict()
+
+# in-process aliases of the model keys {source key: key of getSBML}
+_model_aliases = {}
+
+# in-process model indices {sbml hash: ModelIndex}
+_model_indices = {}
+
+
+def sbml_hash(source):
+    """ SHA256 hash of the SBML content.
+
+    :param source: path to SBML file or SBML string
+    :return: hex digest
+    """
+    if os.path.exists(source):
+        with open(source, "rb") as f:
+            content = f.read()
+    else:
+        content = source.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def model_key(source):
+    """ Cache key of model, i.e. SBML content hash and roadrunner version. """
+    import roadrunner
+    return "{}-{}".format(sbml_hash(source), roadrunner.__version__)
+
+
+def cache_path(filename, cache_dir=None):
+    """ Path of filename in the cache directory (directory is created). """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, filename)
+
+
+def load_roadrunner(source, cache_dir=None, disk=True):
+    """ Loads roadrunner model for SBML using the model cache.
+
+    Every call returns a new RoadRunner instance in the initial state
+    of the model, so instances can be changed independently.
+
+    :param source: path to SBML file or SBML string
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :param disk: boolean flag if the disk cache is used
+    :return: roadrunner.RoadRunner
+    """
+    import roadrunner
+    source_key = model_key(source)
+    key = _model_alias(source_key, cache_dir=cache_dir, disk=disk)
+
+    # in-process cache
+    state = _model_states.get(key)
+    if state is not None:
+        _model_states.move_to_end(key)
+        r = roadrunner.RoadRunner()
+        r.loadStateS(state)
+        _make_properties(r)
+        return r
+
+    # disk cache
+    r = None
+    path = cache_path("{}.rr".format(key), cache_dir=cache_dir) if disk else None
+    if disk and os.path.exists(path):
+        try:
+            r = roadrunner.RoadRunner()
+            r.loadState(path)
+            _make_properties(r)
+        except RuntimeError as err:
+            logging.warning("Invalid model cache '{}': {}".format(path, err))
+            r = None
+
+    if r is None:
+        r = roadrunner.RoadRunner(source)
+        key = model_key(r.getSBML())
+        if key != source_key:
+            _model_aliases[source_key] = key
+            if disk:
+                _write_atomic(cache_path("{}.key".format(source_key), cache_dir=cache_dir),
+                              key.encode("utf-8"))
+        if disk:
+            path = cache_path("{}.rr".format(key), cache_dir=cache_dir)
+            # write to temporary file first, so concurrent processes never
+            # read a partially written state
+            fd, tmp_path = tempfile.mkstemp(suffix=".rr", dir=os.path.dirname(path))
+            os.close(fd)
+            r.saveState(tmp_path)
+            os.replace(tmp_path, path)
+
+    _model_states[key] = r.saveStateS()
+    while len(_model_states) > MODEL_CACHE_SIZE:
+        _model_states.popitem(last=False)
+
+    return r
+
+
+def _model_alias(key, cache_dir=None, disk=True):
+    """ Key of the compiled model for the key of the source (see load_roadrunner). """
+    alias = _model_aliases.get(key)
+    if alias is None and disk:
+        path = cache_path("{}.key".format(key), cache_dir=cache_dir)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                alias = f.read().strip()
+            _model_aliases[key] = alias
+    return alias if alias else key
+
+
+def _write_atomic(path, content):
+    """ Writes content via temporary file, so concurrent processes never read partial files. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _make_properties(r):
+    """ Creates the dynamic properties (e.g. r.BW) of a model loaded from a state.
+
+    Roadrunner only creates the properties when loading SBML, for states
+    this requires the private RoadRunner._makeProperties (roadrunner 2.x).
+    Without it the values are available via item access, e.g. r["BW"].
+    """
+    import roadrunner
+    make_properties = getattr(roadrunner.RoadRunner, "_makeProperties", None)
+    if make_properties is None:
+        return
+    try:
+        make_properties(r)
+    except Exception as err:
+        logging.warning("Model properties could not be created: {}".format(err))
+
+
+def clear_model_cache(cache_dir=None, disk=False):
+    """ Clears the in-process model cache and optionally the disk cache. """
+    _model_states.clear()
+    _model_aliases.clear()
+    _model_indices.clear()
+    if disk:
+        if cache_dir is None:
+            cache_dir = CACHE_DIR
+        if os.path.exists(cache_dir):
+            for filename in os.listdir(cache_dir):
+                if filename.endswith((".rr", ".key")) or filename.endswith("-index.npz"):
+                    os.remove(os.path.join(cache_dir, filename))
+
+
+# -----------------------------------------------------------------------------
+# Model metadata
+# -----------------------------------------------------------------------------
+# Metadata of the global parameters of a model as arrays (in SBML order)
+#   ids: parameter ids
+#   constant: constant flag of parameters
+#   assigned: parameter is variable of assignment or rate rule
+#   dose: dose parameters (PODOSE_*, IVDOSE_*)
+#   physical: physical constants (Mr_*, R_PDB)
+#   values: values in the SBML (NaN if not set)
+#   dose_targets: variable initialized with the dose parameter ('' otherwise)
+ModelIndex = namedtuple("ModelIndex", ['ids', 'constant', 'assigned', 'dose', 'physical',
+                                       'values', 'dose_targets'])
+
+
+def model_index(source, cache_dir=None):
+    """ Metadata index of the model parameters.
+
+    The index is created once per model (keyed by SBML content hash)
+    and persisted in the cache directory.
+
+    :param source: path to SBML file or SBML string
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :return: ModelIndex
+    """
+    key = sbml_hash(source)
+    index = _model_indices.get(key)
+    if index is not None:
+        return index
+
+    path = cache_path("{}-index.npz".format(key), cache_dir=cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            index = ModelIndex(**{field: data[field] for field in ModelIndex._fields})
+    else:
+        index = _create_model_index(source)
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **index._asdict())
+        os.replace(tmp_path, path)
+
+    _model_indices[key] = index
+    return index
+
+
+def _create_model_index(source):
+    """ Creates metadata index of the model parameters from the SBML. """
+    import libsbml
+    if os.path.exists(source):
+        doc = libsbml.readSBMLFromFile(source)  # type: libsbml.SBMLDocument
+    else:
+        doc = libsbml.readSBMLFromString(source)  # type: libsbml.SBMLDocument
+    model = doc.getModel()  # type: libsbml.Model
+
+    rule_variables = set(rule.getVariable() for rule in model.getListOfRules())
+    targets = {}
+    for assignment in model.getListOfInitialAssignments():
+        math = assignment.getMath()
+        if math is not None and math.isName():
+            targets[math.getName()] = assignment.getSymbol()
+
+    parameters = list(model.getListOfParameters())
+    ids = [p.getId() for p in parameters]
+    return ModelIndex(
+        ids=np.array(ids, dtype=str),
+        constant=np.array([p.getConstant() for p in parameters], dtype=bool),
+        assigned=np.array([pid in rule_variables for pid in ids], dtype=bool),
+        dose=np.array([pid.startswith("PODOSE_") or pid.startswith("IVDOSE_") for pid in ids], dtype=bool),
+        physical=np.array([pid.startswith("Mr_") or pid in ["R_PDB"] for pid in ids], dtype=bool),
+        values=np.array([p.getValue() if p.isSetValue() else np.nan for p in parameters], dtype=float),
+        dose_targets=np.array([targets.get(pid, "") if pid.startswith(("PODOSE_", "IVDOSE_")) else ""
+                               for pid in ids], dtype=str),
+    )
+
+
+# -----------------------------------------------------------------------------
+# Simulation results
+# -----------------------------------------------------------------------------
+def result_key(*settings):
+    """ SHA256 hash of the simulation settings.
+
+    Settings are serialized as JSON; objects (e.g. Dosing) by class name
+    and attributes, functions by module, name, bytecode, constants, defaults,
+    the values of the closure and of the referenced module globals (see
+    _function_settings), so lambdas and closures with different captured
+    values have different keys. Referenced modules, functions and classes
+    are keyed by name only.
+
+    :param settings: JSON serializable settings
+    :return: hex digest
+    """
+    content = json.dumps(settings, sort_keys=True, default=_json_default)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _json_default(obj):
+    """ JSON serialization of objects in the simulation settings. """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, types.FunctionType):
+        return _function_settings(obj)
+    if isinstance(obj, types.MethodType):
+        return [_function_settings(obj.__func__), obj.__self__]
+    if isinstance(obj, functools.partial):
+        return ["partial", obj.func, obj.args, obj.keywords]
+    if isinstance(obj, (type, types.BuiltinFunctionType)):
+        return "{}.{}".format(getattr(obj, "__module__", None), getattr(obj, "__qualname__", repr(obj)))
+    if hasattr(obj, "__array__"):
+        # e.g. pandas objects
+        return [obj.__class__.__name__, np.asarray(obj).tolist(),
+                [str(c) for c in getattr(obj, "columns", [])]]
+    if hasattr(obj, "__dict__"):
+        return [obj.__class__.__name__, vars(obj)]
+    return repr(obj)
+
+
+def _function_settings(f):
+    """ Settings of a Python function which determine its behavior. """
+    closure = []
+    for cell in (f.__closure__ or ()):
+        try:
+            closure.append(cell.cell_contents)
+        except ValueError:
+            # empty cell
+            closure.append(None)
+    return ["function", "{}.{}".format(f.__module__, f.__qualname__), _code_hash(f.__code__),
+            f.__defaults__, f.__kwdefaults__, closure, _global_values(f)]
+
+
+def _global_values(f):
+    """ Values of the module globals referenced by the function (without modules and callables). """
+    values = []
+    for name in sorted(_code_names(f.__code__)):
+        if name in f.__globals__:
+            value = f.__globals__[name]
+            if not isinstance(value, types.ModuleType) and not callable(value):
+                values.append([name, value])
+    return values
+
+
+def _code_names(code):
+    """ Names referenced by a code object (with nested code). """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def _code_hash(code):
+    """ SHA256 hash of the bytecode, constants and names of a code object (with nested code). """
+    h = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            h.update(_code_hash(const).encode("utf-8"))
+        else:
+            h.update(repr(const).encode("utf-8"))
+    h.update(repr(code.co_names).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _result_dir(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    path = os.path.join(cache_dir, "results")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_result(key, cache_dir=None):
+    """ Loads simulation result from the result cache.
+
+    :param key: result key (see result_key)
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :return: dict of arrays or None if not cached
+    """
+    path = os.path.join(_result_dir(cache_dir), "{}.npz".format(key))
+    try:
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+    except (IOError, ValueError):
+        return None
+    # access time for LRU eviction
+    os.utime(path)
+    return arrays
+
+
+def save_result(key, arrays, cache_dir=None, max_size=None):
+    """ Stores simulation result in the result cache.
+
+    Least recently used results are removed if the cache exceeds max_size.
+
+    :param key: result key (see result_key)
+    :param arrays: dict of arrays
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :param max_size: maximal size of the result cache in bytes, defaults to RESULT_CACHE_SIZE
+    """
+    directory = _result_dir(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, os.path.join(directory, "{}.npz".format(key)))
+    _evict_results(directory, RESULT_CACHE_SIZE if max_size is None else max_size)
+
+
+def _evict_results(directory, max_size):
+    """ Removes least recently used results until the cache fits in max_size. """
+    entries = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".npz"):
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def clear_result_cache(cache_dir=None):
+    """ Removes all results from the result cache. """
+    _evict_results(_result_dir(cache_dir), max_size=-1)
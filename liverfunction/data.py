@@ -1,21 +1,230 @@
 """
 Helpers for loading and working with data.
+
+The study tables are CSV/TSV files with '#' comments. Parsing the text
+files is slow for repeated loading, so a DataCatalog indexes a data
+directory and converts the tables on first load to a binary columnar cache
+(Feather if pyarrow is installed, pickle otherwise). A cached table is
+invalidated when the source file changes (size and modification time, or
+the content hash). Many tables are loaded concurrently with load_many.
+IPython is only used (if available) to display tables in notebooks.
 """
+import os
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
-from IPython.display import display
 
-def load_data(fid, sep="\t", show=True, data_dir=".", extension="csv"):
+
+def load_data(fid, sep="\t", show=True, data_dir=".", extension="csv", cache_dir=None):
     """ Loads data from given figure/table id.
     Displays the first rows of the dataframe by default.
+
+    :param cache_dir: directory of the binary table cache (see DataCatalog),
+        without the table is parsed from the text file.
     """
     if fid.endswith(".csv") or fid.endswith(".tsv"):
         pass
     else:
         fid = '{}.{}'.format(fid, extension)
-    df = pd.read_csv(os.path.join(data_dir, fid), sep=sep, comment="#")
+    path = os.path.join(data_dir, fid)
+    if cache_dir is not None:
+        df = _load_cached(path, sep=sep, cache_dir=cache_dir)
+    else:
+        df = read_table(path, sep=sep)
     if show is True:
-        display(df.head())
+        _display(df.head())
         print(fid)
     return df
 
 
+def read_table(path, sep="\t"):
+    """ Parses study table from CSV/TSV file. """
+    return pd.read_csv(path, sep=sep, comment="#")
+
+
+def _display(df):
+    """ Displays DataFrame in notebooks, prints otherwise. """
+    try:
+        from IPython.display import display
+    except ImportError:
+        display = print
+    display(df)
+
+
+# -----------------------------------------------------------------------------
+# Data catalog
+# -----------------------------------------------------------------------------
+class DataCatalog(object):
+    """ Index of the study tables in a data directory with binary cache.
+
+    Tables are identified by their path relative to the data directory
+    without extension, e.g. 'Critchley1994/Fig1'.
+    """
+
+    def __init__(self, data_dir, cache_dir=None, sep="\t", extensions=(".csv", ".tsv"), validate="mtime"):
+        """
+        :param data_dir: data directory (searched recursively)
+        :param cache_dir: directory of the binary cache, defaults to CACHE_DIR/data
+        :param sep: separator of the tables
+        :param extensions: extensions of the tables
+        :param validate: invalidation of cached tables, 'mtime' (size and
+            modification time of the source) or 'hash' (content hash)
+        """
+        if validate not in ("mtime", "hash"):
+            raise ValueError("Invalid validation: {}".format(validate))
+        self.data_dir = os.path.abspath(data_dir)
+        self.cache_dir = cache_dir
+        self.sep = sep
+        self.extensions = tuple(extensions)
+        self.validate = validate
+        self.tables = {}
+        self.refresh()
+
+    def refresh(self):
+        """ Indexes the tables of the data directory. """
+        tables = {}
+        for root, dirs, files in os.walk(self.data_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for filename in sorted(files):
+                name, ext = os.path.splitext(filename)
+                if ext in self.extensions:
+                    path = os.path.join(root, filename)
+                    fid = os.path.relpath(os.path.join(root, name), self.data_dir).replace(os.sep, "/")
+                    if fid in tables:
+                        raise ValueError("Duplicate table id '{}': {}, {}".format(fid, tables[fid], path))
+                    tables[fid] = path
+        self.tables = tables
+
+    def __contains__(self, fid):
+        return fid in self.tables
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def keys(self):
+        return list(self.tables.keys())
+
+    def path(self, fid):
+        """ Path of the table file. """
+        try:
+            return self.tables[fid]
+        except KeyError:
+            raise KeyError("Table '{}' not in data catalog: {}".format(fid, self.data_dir))
+
+    def load(self, fid, show=False):
+        """ Loads table from the cache (converted from the source if changed).
+
+        :param fid: table id
+        :param show: boolean flag to display the first rows
+        :return: DataFrame
+        """
+        df = _load_cached(self.path(fid), sep=self.sep, cache_dir=self.cache_dir, validate=self.validate)
+        if show is True:
+            _display(df.head())
+            print(fid)
+        return df
+
+    def load_many(self, fids=None, n_workers=8):
+        """ Loads tables concurrently.
+
+        Reading the cache and parsing text files mostly releases the GIL,
+        so the tables are loaded in a thread pool.
+
+        :param fids: table ids, defaults to all tables
+        :param n_workers: number of threads
+        :return: dict {fid: DataFrame} in order of fids
+        """
+        fids = self.keys() if fids is None else list(fids)
+        if n_workers is None or n_workers <= 1 or len(fids) <= 1:
+            return {fid: self.load(fid) for fid in fids}
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return dict(zip(fids, executor.map(self.load, fids)))
+
+    def clear_cache(self):
+        """ Removes the cached tables of the data directory. """
+        cache_dir = _data_cache_dir(self.cache_dir)
+        for path in self.tables.values():
+            prefix = _path_hash(path)
+            for filename in os.listdir(cache_dir):
+                if filename.startswith(prefix):
+                    os.remove(os.path.join(cache_dir, filename))
+
+
+def _data_cache_dir(cache_dir=None):
+    if cache_dir is None:
+        from .cache import CACHE_DIR
+        cache_dir = os.path.join(CACHE_DIR, "data")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _path_hash(path):
+    return hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:32]
+
+
+def _cache_format():
+    """ Format of the cached tables ('feather' with pyarrow, otherwise 'pkl'). """
+    try:
+        import pyarrow  # noqa: F401
+        return "feather"
+    except ImportError:
+        return "pkl"
+
+
+def _load_cached(path, sep="\t", cache_dir=None, validate="mtime"):
+    """ Loads table from the binary cache, the cache is updated if the source changed.
+
+    The cache file name contains the hash of the source path and of the
+    source stamp (size and mtime, or content), so changed sources are never
+    read from stale cache files.
+    """
+    cache_dir = _data_cache_dir(cache_dir)
+    stat = os.stat(path)
+    if validate == "hash":
+        with open(path, "rb") as f:
+            stamp = hashlib.sha256(f.read()).hexdigest()
+    else:
+        stamp = "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+    ext = _cache_format()
+    prefix = _path_hash(path)
+    key = hashlib.sha256("{}|{}|{}".format(stamp, sep, pd.__version__).encode("utf-8")).hexdigest()[:32]
+    cache_path = os.path.join(cache_dir, "{}-{}.{}".format(prefix, key, ext))
+
+    if os.path.exists(cache_path):
+        try:
+            if ext == "feather":
+                return pd.read_feather(cache_path)
+            return pd.read_pickle(cache_path)
+        except Exception:
+            pass
+
+    df = read_table(path, sep=sep)
+
+    # write to temporary file first, so concurrent readers never read partial files
+    fd, tmp_path = tempfile.mkstemp(suffix="." + ext, dir=cache_dir)
+    os.close(fd)
+    try:
+        if ext == "feather":
+            df.to_feather(tmp_path)
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception as err:
+        os.remove(tmp_path)
+        logging.warning("Table '{}' could not be cached: {}".format(path, err))
+        return df
+
+    # remove stale versions of the table
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(prefix) and filename != os.path.basename(cache_path):
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except OSError:
+                pass
+    return df
@@ -0,0 +1,294 @@
+"""
+Fitting of model parameters to clinical datasets.
+
+A FitData couples a dataset of a study (e.g. a table from data.load_data)
+to a model output, with the Dosing and changes (e.g. bodyweight) of the
+study. A FitProblem fits model parameters to one or multiple datasets by
+weighted least squares (scipy.optimize.least_squares) in log parameter
+space:
+- the simulations of all datasets (and candidate parameter sets) of an
+  evaluation run in a pool of worker processes with preloaded models
+- the Jacobian is calculated by forward differences in log parameter space
+  (see FitProblem.jacobian), the perturbed simulations of all datasets and
+  parameters run in one parallel batch
+- simulations are cached, e.g. the residuals and Jacobian at the same
+  parameters share the simulations
+
+Usage:
+    datasets = [FitData(df, output="Cve_apap", dosing=dosing, y="mean", yerr="sd")]
+    with FitProblem(r, datasets, {"FVli": 0.021}, n_workers=4) as problem:
+        fit = problem.fit()
+"""
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import optimize
+
+from .simulation import output_selections, _simulate_once, _init_worker, _integrator_settings, _worker
+
+
+# Result of fit
+#   parameters: dict {pid: value} of the fitted parameters
+#   cost: 0.5 * sum of squared residuals
+#   residuals: weighted residuals of all datasets
+#   success: boolean flag of convergence
+#   nfev: number of residual evaluations
+#   optimize_result: scipy.optimize.OptimizeResult
+FitResult = namedtuple("FitResult", ['parameters', 'cost', 'residuals', 'success', 'nfev',
+                                     'optimize_result'])
+
+
+class FitData(object):
+    """ Dataset of a study matched to a model output. """
+
+    def __init__(self, data, output, dosing, changes=None, x="time", y="mean", yerr=None,
+                 x_factor=1.0, y_factor=1.0, weight=1.0, name=None):
+        """
+        Residuals are (simulation - y)/yerr; without yerr all points of the
+        dataset are scaled by the maximal absolute value of y, so datasets
+        of different magnitude are comparable. Rows with missing values and
+        data before the dosing (time < 0) are not used.
+
+        :param data: DataFrame of the study, e.g. from data.load_data
+        :param output: model output (simulation column) corresponding to y
+        :param dosing: Dosing or DosingSchedule of the study
+        :param changes: dict of changes of the study, e.g. bodyweight of the subjects
+        :param x: column of the time
+        :param y: column of the values
+        :param yerr: column of the errors (e.g. SD)
+        :param x_factor: conversion factor of data time to model time
+        :param y_factor: conversion factor of data values to model units
+        :param weight: weight of the dataset
+        :param name: name of the dataset
+        """
+        columns = [c for c in (x, y, yerr) if c is not None]
+        df = data[columns].dropna()
+        t = df[x].values.astype(float) * x_factor
+        mask = t >= 0
+        order = np.argsort(t[mask], kind="stable")
+
+        self.output = output
+        self.dosing = dosing
+        self.changes = dict(changes) if changes else {}
+        self.name = name if name is not None else output
+        self.t = t[mask][order]
+        self.y = df[y].values.astype(float)[mask][order] * y_factor
+        if yerr is not None:
+            self.yerr = df[yerr].values.astype(float)[mask][order] * y_factor
+        else:
+            self.yerr = np.full(self.y.shape, np.max(np.abs(self.y)) if self.y.size else 1.0)
+        if np.any(self.yerr <= 0):
+            raise ValueError("Errors of dataset '{}' must be positive.".format(self.name))
+        self.weight = weight
+
+        # simulation on the unique data times (from the dosing at time 0)
+        self.times, self._inverse = np.unique(np.concatenate([[0.0], self.t]), return_inverse=True)
+        self._inverse = self._inverse[1:]
+
+    def residuals(self, values):
+        """ Weighted residuals of the simulated output on the simulation times. """
+        return np.sqrt(self.weight) * (values[self._inverse] - self.y) / self.yerr
+
+    def _spec(self):
+        """ Simulation settings of the dataset (for the worker processes). """
+        return (self.dosing, self.changes, self.output, self.times)
+
+
+class FitProblem(object):
+    """ Least squares fit of model parameters to datasets. """
+
+    def __init__(self, r, datasets, parameters, bounds=None, n_workers=None, step=1E-4,
+                 cache_size=4096):
+        """
+        :param r: roadrunner model
+        :param datasets: list of FitData
+        :param parameters: dict {pid: initial value} of the fitted parameters (positive)
+        :param bounds: dict {pid: (lower, upper)} of parameter bounds
+        :param n_workers: number of worker processes, None or 1 simulates serially on r.
+        :param step: relative parameter step of the forward sensitivities
+        :param cache_size: maximal number of cached simulations
+        """
+        self.r = r
+        self.datasets = list(datasets)
+        self.parameters = list(parameters.keys())
+        self.initial = np.array([parameters[pid] for pid in self.parameters], dtype=float)
+        if np.any(self.initial <= 0):
+            raise ValueError("Fitted parameters must be positive (log parameter space).")
+        bounds = bounds if bounds else {}
+        self.bounds = (
+            np.array([bounds.get(pid, (0, np.inf))[0] for pid in self.parameters], dtype=float),
+            np.array([bounds.get(pid, (0, np.inf))[1] for pid in self.parameters], dtype=float),
+        )
+        self.n_workers = n_workers
+        self.step = step
+        self.cache_size = cache_size
+        self.selections = output_selections(sorted(set(d.output for d in self.datasets)))
+        self.n_simulations = 0
+        self._cache = OrderedDict()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Shuts down the worker pool. """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    # -------------------------------------------------------------------------
+    # objective
+    # -------------------------------------------------------------------------
+    def residuals(self, x):
+        """ Weighted residuals of all datasets at log parameters x. """
+        values = np.exp(np.asarray(x, dtype=float))
+        sims = self._simulate([(k, values) for k in range(len(self.datasets))])
+        return np.concatenate([d.residuals(s) for d, s in zip(self.datasets, sims)])
+
+    def jacobian(self, x):
+        """ Jacobian of the residuals with respect to the log parameters x.
+
+        Forward sensitivities with one simulation per dataset and parameter,
+        all simulations run in one batch.
+        """
+        values = np.exp(np.asarray(x, dtype=float))
+        Nd, Np = len(self.datasets), len(self.parameters)
+        items = [(k, values) for k in range(Nd)]
+        for j in range(Np):
+            changed = values.copy()
+            changed[j] *= 1.0 + self.step
+            items.extend((k, changed) for k in range(Nd))
+        sims = self._simulate(items)
+
+        base = [d.residuals(s) for d, s in zip(self.datasets, sims[:Nd])]
+        J = np.empty((sum(b.size for b in base), Np))
+        for j in range(Np):
+            changed = sims[Nd*(j+1):Nd*(j+2)]
+            J[:, j] = np.concatenate([
+                d.residuals(s) - b for d, s, b in zip(self.datasets, changed, base)
+            ]) / np.log1p(self.step)
+        return J
+
+    def cost(self, values):
+        """ Cost 0.5 * sum of squared residuals at the parameter values. """
+        return self.evaluate(np.atleast_2d(values))[0]
+
+    def evaluate(self, candidates):
+        """ Costs of candidate parameter sets.
+
+        The simulations of all candidates and datasets run in one batch.
+
+        :param candidates: array (n, Np) of parameter values (or DataFrame with the pids)
+        :return: array of costs
+        """
+        if hasattr(candidates, "columns"):
+            candidates = candidates[self.parameters].values
+        candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+        Nd = len(self.datasets)
+        sims = self._simulate([(k, values) for values in candidates for k in range(Nd)])
+        costs = np.empty(len(candidates))
+        for i in range(len(candidates)):
+            res = np.concatenate([d.residuals(s) for d, s in zip(self.datasets, sims[i*Nd:(i+1)*Nd])])
+            costs[i] = 0.5 * np.sum(res**2)
+        return costs
+
+    def fit(self, initial=None, starts=None, **kwargs):
+        """ Fits the parameters with scipy.optimize.least_squares.
+
+        :param initial: dict {pid: value} of initial values, defaults to the problem parameters
+        :param starts: candidate initial parameter sets (n, Np), the fit starts
+            from the candidate with the lowest cost (evaluated in parallel)
+        :param kwargs: keyword arguments for least_squares
+        :return: FitResult
+        """
+        if initial is not None:
+            x0 = np.array([initial[pid] for pid in self.parameters], dtype=float)
+        else:
+            x0 = self.initial
+        if starts is not None:
+            if hasattr(starts, "columns"):
+                starts = starts[self.parameters].values
+            starts = np.vstack([x0, np.atleast_2d(np.asarray(starts, dtype=float))])
+            x0 = starts[np.nanargmin(self.evaluate(starts))]
+
+        with np.errstate(divide="ignore"):
+            bounds = (np.log(self.bounds[0]), np.log(self.bounds[1]))
+        res = optimize.least_squares(self.residuals, np.log(x0), jac=self.jacobian, bounds=bounds,
+                                     **kwargs)
+        return FitResult(
+            parameters=dict(zip(self.parameters, np.exp(res.x))),
+            cost=res.cost, residuals=res.fun, success=res.success, nfev=res.nfev,
+            optimize_result=res,
+        )
+
+    # -------------------------------------------------------------------------
+    # simulations
+    # -------------------------------------------------------------------------
+    def _simulate(self, items):
+        """ Simulated outputs for the (dataset index, parameter values) items.
+
+        Cached simulations are reused, the remaining simulations run in the
+        worker pool (or serially on r).
+
+        :return: list of arrays of the output on the simulation times of the datasets
+        """
+        keys = [(k, np.asarray(values, dtype=float).tobytes()) for k, values in items]
+        missing = OrderedDict()
+        for key, (k, values) in zip(keys, items):
+            if key not in self._cache and key not in missing:
+                missing[key] = (k, tuple(float(v) for v in values))
+
+        if missing:
+            tasks = list(missing.values())
+            if self.n_workers is not None and self.n_workers > 1:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.n_workers,
+                        initializer=_init_worker,
+                        initargs=(self.r.getSBML(), self.selections, {
+                            'datasets': [d._spec() for d in self.datasets],
+                            'parameters': self.parameters,
+                        }, _integrator_settings(self.r))
+                    )
+                chunksize = max(1, len(tasks) // (4 * self.n_workers))
+                results = list(self._executor.map(_fit_item, tasks, chunksize=chunksize))
+            else:
+                self.r.timeCourseSelections = self.selections
+                specs = [d._spec() for d in self.datasets]
+                results = [_simulate_output(self.r, self.selections, specs[k], self.parameters, values)
+                           for k, values in tasks]
+            self.n_simulations += len(tasks)
+            for key, s in zip(missing.keys(), results):
+                self._cache[key] = s
+
+        sims = []
+        for key in keys:
+            self._cache.move_to_end(key)
+            sims.append(self._cache[key])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return sims
+
+
+def _simulate_output(r, selections, spec, parameters, values):
+    """ Simulates the output of a dataset with the parameter values.
+
+    :return: array of the output on the simulation times of the dataset
+    """
+    dosing, changes, output, times = spec
+    changes = dict(changes)
+    changes.update(zip(parameters, values))
+    s = _simulate_once(r, times[-1], times.size - 1, dosing, changes, times=times)
+    return np.asarray(s, dtype=float)[:, selections.index(output)]
+
+
+def _fit_item(item):
+    """ Simulates a (dataset index, parameter values) item in the worker process. """
+    k, values = item
+    r = _worker['r']
+    return _simulate_output(r, list(r.timeCourseSelections), _worker['datasets'][k],
+                            _worker['parameters'], values)
@@ -3,18 +3,20 @@ Helper functions for pharmacokinetic analysis.
 
 Takes concentration~time curves in plasma as input for analysis.
 Pharmacokinetic parameters are than calculated and returned.
+
+Only numpy is imported with the module, so f_pk can be used in lightweight
+worker processes. scipy.stats, pandas and matplotlib are imported on first
+use (regression statistics, f_pk_batch and pk_figure).
 """
-import pandas as pd
 import numpy as np
-from scipy import stats
-from matplotlib import pyplot as plt
 import warnings
 
 # TODO: add estimation of confidence intervals (use also the errorbars on the curves)
 # Currently only simple calculation of pharmacokinetic parameters
 
 
-def f_pk(t, c, compound, dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/L", dose_unit="mg", vd_unit="L", bodyweight_unit="kg"):
+def f_pk(t, c, compound, dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/L", dose_unit="mg", vd_unit="L", bodyweight_unit="kg",
+         weighted=False):
     """ Calculates all the pk parameters from given time course.
 
     The returned data structure can be used to
@@ -24,7 +26,13 @@ def f_pk(t, c, compound, dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/
     The given doses must be in absolute amount, not per bodyweight. If doses are given per bodyweight, e.g. [mg/kg]
     these must be multiplied with the bodyweight before calling this function.
 
-    :param t: time vector
+    The time vector can be non-uniform, e.g. the adaptive output of simulate.
+    By default the terminal regression is the ordinary least squares fit of
+    all points after the maximum. With weighted every point is weighted with
+    its time interval, so dense output (e.g. of adaptive simulations) does not
+    dominate the fit (see _regression_batch).
+
+    :param t: time vector (increasing)
     :param c: concentration vector corresponding to time vector
     :param compound: name of compound/substance
     :param dose: given dose of the test substance (absolute amount, not per bodyweight)
@@ -34,33 +42,52 @@ def f_pk(t, c, compound, dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/
     :param dose_unit: dose unit
     :param vd_unit: unit for volume of distribution (normally [L])
     :param bodyweight_unit: unit of bodyweight (normally [kg])
+    :param weighted: boolean flag to weight the regression with the time intervals
 
     :return: dict with pharmacokinetic paramatern and information
     """
     # make sure we work on ndarrays
-    if isinstance(t, pd.core.series.Series):
-        t = np.copy(t.values)
-    if isinstance(c, pd.core.series.Series):
-        c = np.copy(c.values)
+    if not isinstance(t, np.ndarray):
+        t = np.array(t)
+    if not isinstance(c, np.ndarray):
+        c = np.array(c)
     assert isinstance(t, np.ndarray)
     assert isinstance(c, np.ndarray)
     assert t.size == c.size
+    if np.any(np.diff(t) < 0):
+        raise ValueError("Time vector must be increasing.")
 
     # calculate pk
     auc = _auc(t, c)
     tmax, cmax = _max(t, c)
     tmaxhalf, cmaxhalf = _max_half(t, c)
+    regression = _regression(t, c, weighted=weighted)
+
+    return _pk_parameters(compound, auc, tmax, cmax, tmaxhalf, cmaxhalf, regression, t_end=t[-1],
+                          dose=dose, bodyweight=bodyweight, t_unit=t_unit, c_unit=c_unit,
+                          dose_unit=dose_unit, vd_unit=vd_unit, bodyweight_unit=bodyweight_unit)
+
+
+def _pk_parameters(compound, auc, tmax, cmax, tmaxhalf, cmaxhalf, regression, t_end,
+                   dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/L", dose_unit="mg",
+                   vd_unit="L", bodyweight_unit="kg"):
+    """ Pharmacokinetic parameters from the curve statistics (see f_pk).
 
-    [slope, intercept, r_value, p_value, std_err, max_idx] = _regression(t, c)
+    :param regression: [slope, intercept, r_value, p_value, std_err, max_idx] of the
+        regression after the maximum
+    :param t_end: last time point of the curve
+    :return: dict with pharmacokinetic parameters and information
+    """
+    [slope, intercept, r_value, p_value, std_err, max_idx] = regression
     if np.isnan(slope) or np.isnan(intercept):
         warnings.warn("Regression could not be calculated on timecourse curve.")
 
-    kel = _kel(t, c, slope=slope)
-    thalf = _thalf(t, c, slope=slope)
-    aucinf = _aucinf(t, c, slope=slope, intercept=intercept)
+    kel = _kel(None, None, slope=slope)
+    thalf = _thalf(None, None, slope=slope)
+    aucinf = auc - intercept/slope * np.exp(slope*t_end)
 
     if dose is not None:
-        vd = _vd(t, c, dose, intercept=intercept)
+        vd = _vd(None, None, dose, intercept=intercept)
         cl = kel * vd
     else:
         vd = np.nan
@@ -103,6 +130,285 @@ def f_pk(t, c, compound, dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/
     }
 
 
+def f_pk_batch(t, c, compound, dose=np.nan, bodyweight=np.nan, t_unit="h", c_unit="mg/L", dose_unit="mg", vd_unit="L", bodyweight_unit="kg",
+               weighted=False):
+    """ Calculates all the pk parameters for a batch of time courses.
+
+    Vectorized version of f_pk for many curves on a shared time grid, e.g.
+    from population or sensitivity simulations. All curves are processed with
+    NumPy operations, the results per curve are identical to f_pk.
+
+    :param t: time vector (n_timepoints)
+    :param c: concentration matrix (n_curves, n_timepoints)
+    :param compound: name of compound/substance, or names per curve
+    :param dose: given dose of the test substance (scalar or per curve)
+    :param bodyweight: bodyweight (scalar or per curve)
+    :param t_unit: time unit
+    :param c_unit: concentration unit
+    :param dose_unit: dose unit
+    :param vd_unit: unit for volume of distribution (normally [L])
+    :param bodyweight_unit: unit of bodyweight (normally [kg])
+    :param weighted: boolean flag to weight the regression with the time intervals (see f_pk)
+
+    :return: DataFrame with one row per curve and the keys of f_pk as columns
+    """
+    import pandas as pd
+    t = np.asarray(t, dtype=float)
+    c = np.atleast_2d(np.asarray(c, dtype=float))
+    assert t.ndim == 1
+    assert t.size == c.shape[1]
+    if np.any(np.diff(t) < 0):
+        raise ValueError("Time vector must be increasing.")
+    n = c.shape[0]
+    rows = np.arange(n)
+
+    # calculate pk
+    auc = _auc(t, c)
+    max_idx = np.argmax(c, axis=1)
+    tmax, cmax = t[max_idx], c[rows, max_idx]
+
+    # half maximum before the maximum
+    if np.any(max_idx == c.shape[1]-1):
+        warnings.warn("No MAXIMUM reached within time course, last value used.")
+    cnew = np.abs(c - 0.5*cmax[:, np.newaxis])
+    cnew[np.arange(c.shape[1]) >= max_idx[:, np.newaxis]] = np.inf
+    idx_half = np.argmin(cnew, axis=1)
+    tmaxhalf = np.where(max_idx == 0, np.nan, t[idx_half])
+    cmaxhalf = np.where(max_idx == 0, np.nan, c[rows, idx_half])
+
+    slope, intercept, r_value, p_value, std_err = _regression_batch(t, c, max_idx, weighted=weighted)
+    if np.any(np.isnan(slope) | np.isnan(intercept)):
+        warnings.warn("Regression could not be calculated on timecourse curve.")
+    max_idx = np.where(max_idx == c.shape[1]-1, np.nan, max_idx)
+
+    kel = -slope
+    with np.errstate(divide="ignore", invalid="ignore"):
+        thalf = np.log(2) / kel
+        aucinf = auc - intercept/slope * np.exp(slope*t[-1])
+
+    if dose is not None:
+        dose = np.broadcast_to(np.asarray(dose, dtype=float), (n,))
+        vd = dose / np.exp(intercept)
+        cl = kel * vd
+    else:
+        vd = np.full(n, np.nan)
+        cl = np.full(n, np.nan)
+
+    return pd.DataFrame({
+        'compound': np.broadcast_to(np.asarray(compound, dtype=object), (n,)),
+        'dose': np.broadcast_to(np.asarray(dose, dtype=float), (n,)) if dose is not None else None,
+        'dose_unit': dose_unit,
+        'bodyweight': np.broadcast_to(np.asarray(bodyweight, dtype=float), (n,)),
+        'bodyweight_unit': bodyweight_unit,
+        'auc': auc,
+        'auc_unit': '{}*{}'.format(c_unit, t_unit),
+        'aucinf': aucinf,
+        'aucinf_unit': '{}*{}'.format(c_unit, t_unit),
+        'tmax': tmax,
+        'tmax_unit': t_unit,
+        'cmax': cmax,
+        'cmax_unit': c_unit,
+        'tmaxhalf': tmaxhalf,
+        'tmaxhalf_unit': t_unit,
+        'cmaxhalf': cmaxhalf,
+        'cmaxhalf_unit': c_unit,
+
+        'kel': kel,
+        'kel_unit': '1/{}'.format(t_unit),
+        'thalf': thalf,
+        'thalf_unit': t_unit,
+        'vd': vd,
+        'vd_unit': vd_unit,
+        'cl': cl,
+        'cl_unit': '{}/{}'.format(vd_unit, t_unit),
+
+        'slope': slope,
+        'intercept': intercept,
+        'r_value': r_value,
+        'p_value': p_value,
+        'std_err': std_err,
+        'max_idx': max_idx,
+    }, index=rows)
+
+
+class PKAccumulator(object):
+    """ Pharmacokinetic parameters from a streamed time course.
+
+    The curve is added in chunks via update (e.g. while simulating) and only
+    running statistics are stored instead of the time course:
+    - trapezoid AUC
+    - running maximum (first occurrence) with tmax
+    - candidates for the half maximum before the maximum, i.e. all points
+      above the current half maximum and the largest point below it
+    - sums of the log-linear regression after the maximum, which restart
+      with every new maximum (with weighted of the time interval weights,
+      see _regression_batch)
+
+    result returns the parameters of f_pk on the complete curve (identical
+    up to floating point summation order).
+    """
+
+    def __init__(self, compound, weighted=False, **kwargs):
+        """
+        :param compound: name of compound/substance
+        :param weighted: boolean flag to weight the regression with the time intervals (see f_pk)
+        :param kwargs: keyword arguments of f_pk, e.g. dose, bodyweight and units
+        """
+        self.compound = compound
+        self.weighted = weighted
+        self.kwargs = kwargs
+        self.n = 0
+        self.auc = 0.0
+        self.max_idx = None
+        self.tmax = np.nan
+        self.cmax = np.nan
+
+        self._last = None
+        # half maximum candidates (idx, t, c) before and after the maximum
+        self._before = np.empty((0, 3))
+        self._after = np.empty((0, 3))
+        self._reset_regression(None)
+
+    def _reset_regression(self, origin):
+        """ Restarts the regression sums at origin (t, log c). """
+        self._origin = origin
+        # [sum w, sum w*x, sum w*y, sum w*x*x, sum w*y*y, sum w*x*y, sum w*w]
+        self._sums = np.zeros(7)
+        # last regression point (x, y, left half interval) without weight
+        self._pending = None
+
+    def update(self, t, c):
+        """ Adds chunk of the time course.
+
+        :param t: time vector of chunk (increasing, after the previous chunks)
+        :param c: concentration vector corresponding to time vector
+        """
+        t = np.asarray(t, dtype=float)
+        c = np.asarray(c, dtype=float)
+        assert t.size == c.size
+        if t.size == 0:
+            return
+
+        # auc and time grid
+        if self._last is not None:
+            tc = np.concatenate([[self._last[0]], t])
+            cc = np.concatenate([[self._last[1]], c])
+        else:
+            tc, cc = t, c
+        dt = np.diff(tc)
+        if np.any(dt < 0):
+            raise ValueError("Time vector must be increasing.")
+        if dt.size > 0:
+            self.auc += np.sum(dt * (cc[1:] + cc[:-1]) / 2.0)
+
+        # maximum
+        points = np.column_stack([self.n + np.arange(t.size), t, c])
+        k = np.argmax(c)
+        if self.max_idx is None or c[k] > self.cmax:
+            if self.max_idx is not None:
+                old_max = np.array([[self.max_idx, self.tmax, self.cmax]])
+                self._before = np.vstack([self._before, old_max, self._after])
+            self._before = np.vstack([self._before, points[:k]])
+            self._after = np.empty((0, 3))
+            self.max_idx, self.tmax, self.cmax = int(self.n + k), t[k], c[k]
+            self._reset_regression((t[k], np.log(c[k])))
+            points = points[k+1:]
+
+        self._after = np.vstack([self._after, points])
+        self._add_regression(points[:, 1], points[:, 2])
+        self._before = self._prune(self._before)
+        self._after = self._prune(self._after)
+
+        self._last = (t[-1], c[-1])
+        self.n += t.size
+
+    def _prune(self, points):
+        """ Removes points which can not be the half maximum.
+
+        The half maximum only increases, so of the points below the half
+        maximum only the largest (first) point is required.
+        """
+        half = 0.5 * self.cmax
+        below = points[:, 2] <= half
+        if np.sum(below) <= 1:
+            return points
+        k = np.nonzero(below)[0]
+        keep = ~below
+        keep[k[np.argmax(points[k, 2])]] = True
+        return points[keep]
+
+    def _add_regression(self, x, c):
+        """ Adds points after the maximum to the regression sums. """
+        if x.size == 0:
+            return
+        with np.errstate(divide="ignore", invalid="ignore"):
+            y = np.log(c)
+        (x0, y0) = self._origin
+        x, y = x - x0, y - y0
+        if not self.weighted:
+            self._sums += self._moments(x, y, np.ones(x.size))
+            return
+
+        # trapezoid weights, the last point is weighted with the next point
+        if self._pending is not None:
+            x = np.concatenate([[self._pending[0]], x])
+            y = np.concatenate([[self._pending[1]], y])
+            left = np.concatenate([[self._pending[2]], np.diff(x) / 2.0])
+        else:
+            left = np.concatenate([[0.0], np.diff(x) / 2.0])
+        right = np.diff(x) / 2.0
+        self._sums += self._moments(x[:-1], y[:-1], left[:-1] + right)
+        self._pending = (x[-1], y[-1], left[-1])
+
+    @staticmethod
+    def _moments(x, y, w):
+        return np.array([np.sum(w), np.sum(w*x), np.sum(w*y),
+                         np.sum(w*x*x), np.sum(w*y*y), np.sum(w*x*y), np.sum(w*w)])
+
+    def _regression(self):
+        """ Regression after the maximum like _regression on the complete curve. """
+        if self.max_idx == self.n - 1:
+            return [np.nan]*6
+        sums = self._sums.copy()
+        n = self.n - 1 - self.max_idx
+        n_eff = None
+        if self.weighted:
+            if self._pending is not None:
+                (x, y, left) = self._pending
+                sums += self._moments(np.array([x]), np.array([y]), np.array([left]))
+            n_eff = np.array([sums[0]**2 / sums[6]])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xmean, ymean = sums[1] / sums[0], sums[2] / sums[0]
+            ssxm = sums[3] / sums[0] - xmean**2
+            ssym = sums[4] / sums[0] - ymean**2
+            ssxym = sums[5] / sums[0] - xmean*ymean
+        (x0, y0) = self._origin
+        results = _regression_stats(np.array([float(n)]), np.array([xmean + x0]), np.array([ymean + y0]),
+                                    np.array([ssxm]), np.array([ssym]), np.array([ssxym]), n_eff=n_eff)
+        return [float(v[0]) for v in results] + [self.max_idx]
+
+    def _max_half(self):
+        """ Half maximum before the maximum like _max_half on the complete curve. """
+        if self.max_idx == self.n - 1:
+            warnings.warn("No MAXIMUM reached within time course, last value used.")
+        if self.max_idx == 0:
+            return np.nan, np.nan
+        points = self._before[np.argsort(self._before[:, 0], kind="stable")]
+        k = np.argmin(np.abs(points[:, 2] - 0.5*self.cmax))
+        return points[k, 1], points[k, 2]
+
+    def result(self):
+        """ Pharmacokinetic parameters of the curve (see f_pk).
+
+        :return: dict with pharmacokinetic parameters and information
+        """
+        if self.n == 0:
+            raise ValueError("No data added to PKAccumulator.")
+        tmaxhalf, cmaxhalf = self._max_half()
+        return _pk_parameters(self.compound, self.auc, self.tmax, self.cmax, tmaxhalf, cmaxhalf,
+                              self._regression(), t_end=self._last[0], **self.kwargs)
+
+
 def pk_report(pk):
     """ Print report for given pharmacokinetic information.
 
@@ -155,6 +461,7 @@ def pk_figure(t, c, pk):
     if max_idx is None or np.isnan(max_idx):
         max_idx = c.size-1
 
+    from matplotlib import pyplot as plt
     kwargs={"markersize": 10}
 
     # create figure
@@ -188,8 +495,11 @@ def pk_figure(t, c, pk):
 
 
 def _auc(t, c):
-    """ Calculates the area under the curve (AUC) via trapezoid rule """
-    return np.sum((t[1:] - t[0:-1]) * (c[1:] + c[0:-1]) / 2.0)
+    """ Calculates the area under the curve (AUC) via trapezoid rule
+
+    For a matrix of curves c (n_curves, n_timepoints) the AUC of every curve is returned.
+    """
+    return np.sum((t[1:] - t[0:-1]) * (c[..., 1:] + c[..., 0:-1]) / 2.0, axis=-1)
 
 
 def _aucinf(t, c, slope=None, intercept=None):
@@ -307,19 +617,115 @@ def _vd(t, c, dose, intercept=None):
     return dose / np.exp(intercept)
 
 
-def _regression(t, c):
+def _regression(t, c, weighted=False):
     """ Linear regression on the log timecourse after maximal value.
     No check is performed if already in equilibrium distribution !.
     The linear regression is calculated from all data points after the maximum.
+    With weighted the regression is weighted by the time intervals
+    (see _regression_batch).
 
     :return:
     """
     # TODO: check for distribution and elimination part of curve.
     max_index = np.argmax(c)
+    if max_index == (len(c)-1):
+        return [np.nan]*6
+    if weighted:
+        results = _regression_batch(t, c[np.newaxis, :], np.array([max_index]), weighted=True)
+        return [float(v[0]) for v in results] + [max_index]
+
     # linear regression
+    from scipy import stats
     x = t[max_index+1:]
     y = np.log(c[max_index+1:])
-    if max_index == (len(c)-1):
-        return [np.nan]*6
     slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
     return [slope, intercept, r_value, p_value, std_err, max_index]
+
+
+def _regression_batch(t, c, max_index, weighted=False):
+    """ Linear regression on the log timecourses after maximal value.
+
+    Vectorized version of _regression for a matrix of curves (n_curves, n_timepoints)
+    with the statistics of scipy.stats.linregress.
+
+    With weighted every point is weighted by its time interval, i.e. half
+    the distance to the neighbouring points within the regression range
+    (trapezoid weights). On uniform grids this is (up to the end points) the
+    unweighted regression, on non-uniform grids dense regions do not
+    dominate the fit. The p_value and std_err of the weighted regression use
+    the effective number of points (sum w)^2 / sum w^2.
+
+    :return: tuple of arrays (slope, intercept, r_value, p_value, std_err)
+    """
+    mask = np.arange(t.size) > max_index[:, np.newaxis]
+    if weighted:
+        w = _trapezoid_weights(t, max_index)
+    else:
+        w = np.ones(c.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = np.where(mask, w, 0.0)
+        x = np.where(mask, t, 0.0)
+        y = np.where(mask, np.log(np.where(mask, c, 1.0)), 0.0)
+        n = mask.sum(axis=1).astype(float)
+        wsum = w.sum(axis=1)
+        n_eff = wsum**2 / (w * w).sum(axis=1) if weighted else None
+        xmean = (w * x).sum(axis=1) / wsum
+        ymean = (w * y).sum(axis=1) / wsum
+        dx = np.where(mask, t - xmean[:, np.newaxis], 0.0)
+        dy = np.where(mask, y - ymean[:, np.newaxis], 0.0)
+        ssxm = (w * dx * dx).sum(axis=1) / wsum
+        ssym = (w * dy * dy).sum(axis=1) / wsum
+        ssxym = (w * dx * dy).sum(axis=1) / wsum
+
+    return _regression_stats(n, xmean, ymean, ssxm, ssym, ssxym, n_eff=n_eff)
+
+
+def _regression_stats(n, xmean, ymean, ssxm, ssym, ssxym, n_eff=None):
+    """ Statistics of scipy.stats.linregress from the (co)variances.
+
+    :param n: number of data points
+    :param n_eff: effective number of data points of weighted (co)variances,
+        the degrees of freedom are n_eff - 2 (defaults to n)
+    :return: tuple of arrays (slope, intercept, r_value, p_value, std_err)
+    """
+    from scipy import stats
+    TINY = 1.0e-20
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        r = np.where((ssxm == 0.0) | (ssym == 0.0), np.where(ssxym == 0, np.nan, 0.0), r)
+        slope = ssxym / ssxm
+        intercept = ymean - slope*xmean
+
+        df = (n if n_eff is None else n_eff) - 2
+        t_stat = r * np.sqrt(df / ((1.0 - r + TINY)*(1.0 + r + TINY)))
+        p_value = 2 * stats.t.sf(np.abs(t_stat), df)
+        std_err = np.sqrt((1 - r**2) * ssym / ssxm / df)
+
+    # two data points
+    two = (n == 2)
+    p_value[two] = np.where(ssym[two] == 0.0, 1.0, 0.0)
+    std_err[two] = 0.0
+
+    # no data points after maximum
+    none = (n == 0)
+    for values in (slope, intercept, r, p_value, std_err):
+        values[none] = np.nan
+
+    return slope, intercept, r, p_value, std_err
+
+
+def _trapezoid_weights(t, max_index):
+    """ Time interval of every point for the regression after max_index.
+
+    :return: weights (n_curves, n_timepoints)
+    """
+    half = np.diff(t) / 2.0
+    w = np.zeros(t.size)
+    w[:-1] += half
+    w[1:] += half
+    w = np.tile(w, (max_index.size, 1))
+    # first point of regression has no left neighbour
+    first = max_index + 1
+    rows = np.nonzero(first < t.size)[0]
+    w[rows, first[rows]] -= half[first[rows] - 1]
+    return w
@@ -1,7 +1,10 @@
+import numpy as np
+import pandas as pd
 import matplotlib
 from matplotlib import pyplot as plt
+from matplotlib.collections import PolyCollection
 
-from .simulation import Result
+from .result import Result
 
 # global settings for plots
 plt.rcParams.update({
@@ -23,7 +26,7 @@ kwargs_data = {'marker': 's', 'linestyle': '--', 'linewidth': 1, 'capsize': 3}
 kwargs_sim = {'marker': None, 'linestyle': '-', 'linewidth': 2}
 
 
-def add_line(xid, yid, ax, s, color='black', label='', xf=1.0, kwargs_sim=kwargs_sim, **kwargs):
+def add_line(xid, yid, ax, s, color='black', label='', xf=1.0, kwargs_sim=kwargs_sim, max_points=None, **kwargs):
     """
 
     :param xid:
@@ -31,22 +34,112 @@ def add_line(xid, yid, ax, s, color='black', label='', xf=1.0, kwargs_sim=kwargs
     :param ax:
     :param s: namedtuple Result from simulate
     :param color:
+    :param max_points: maximal number of points per line (see add_lines)
+    :return:
+    """
+    add_lines(xid, [(s, yid, color, label)], ax, xf=xf, kwargs_sim=kwargs_sim, max_points=max_points, **kwargs)
+
+
+def add_lines(xid, series, ax, xf=1.0, kwargs_sim=kwargs_sim, max_points=None, **kwargs):
+    """ Adds many simulations with uncertainty bands to the axes.
+
+    The columns are read once as NumPy arrays and long trajectories are
+    decimated to max_points (min/max per bin, so peaks are preserved).
+    The uncertainty bands of all Results are drawn as a single PolyCollection.
+
+    :param xid: x column
+    :param series: list of (s, yid, color, label) with s a Result, DataFrame or Timecourse
+    :param ax: axes
+    :param xf: factor for x values
+    :param max_points: maximal number of points per line, defaults to the
+        width of the axes in pixel. 0 for no decimation.
     :return:
     """
     kwargs_plot = dict(kwargs_sim)
     kwargs_plot.update(kwargs)
+    if max_points is None:
+        max_points = int(ax.bbox.width)
+
+    polygons = []
+    facecolors = []
+    for s, yid, color, label in series:
+        if isinstance(s, Result):
+            x = _values(s.mean, xid) * xf
+            y = _values(s.mean, yid)
+            std = _values(s.std, yid)
+            bands = [
+                (_values(s.min, yid), y - std, 0.3),
+                (y + std, _values(s.max, yid), 0.3),
+                (y - std, y + std, 0.5),
+            ]
+            for lower, upper, alpha in bands:
+                xb, lower, upper = _decimate_band(x, lower, upper, max_points)
+                polygons.append(np.column_stack([
+                    np.concatenate([xb, xb[::-1]]), np.concatenate([lower, upper[::-1]])
+                ]))
+                facecolors.append(matplotlib.colors.to_rgba(color, alpha))
+        else:
+            x = _values(s, xid) * xf
+            y = _values(s, yid)
+
+        x, y = _decimate_line(x, y, max_points)
+        ax.plot(x, y, color=color, label="sim {}".format(label), **kwargs_plot)
+
+    if polygons:
+        ax.add_collection(PolyCollection(polygons, facecolors=facecolors, edgecolors=facecolors,
+                                         label="__nolabel__"))
+        ax.autoscale_view()
 
-    if isinstance(s, Result):
-        x = s.mean[xid]*xf
 
-        ax.fill_between(x, s.min[yid], s.mean[yid] - s.std[yid], color=color, alpha=0.3, label="__nolabel__")
-        ax.fill_between(x, s.mean[yid] + s.std[yid], s.max[yid], color=color, alpha=0.3, label="__nolabel__")
-        ax.fill_between(x, s.mean[yid] - s.std[yid], s.mean[yid] + s.std[yid], color=color, alpha=0.5, label="__nolabel__")
+def _values(s, key):
+    """ Column of DataFrame or Timecourse as NumPy array. """
+    values = s[key]
+    if isinstance(values, pd.Series):
+        values = values.values
+    return np.asarray(values, dtype=float)
 
-        ax.plot(x, s.mean[yid], '-', color=color, label="sim {}".format(label), **kwargs_plot)
-    else:
-        x = s[xid] * xf
-        ax.plot(x, s[yid], '-', color=color, label="sim {}".format(label), **kwargs_plot)
 
+def _bins(n, max_points):
+    """ Size of bins for decimation of n points to max_points (None for no decimation). """
+    if not max_points or n <= 2 * max_points:
+        return None
+    return int(np.ceil(2.0 * n / max_points))
 
 
+def _reshape_bins(values, size):
+    """ Values in bins of size, the last bin is padded with the last value. """
+    pad = -values.size % size
+    return np.concatenate([values, np.repeat(values[-1:], pad)]).reshape(-1, size)
+
+
+def _decimate_line(x, y, max_points):
+    """ Min/max decimation of line to about max_points points.
+
+    Per bin the minimum and maximum are kept in order of occurrence.
+    """
+    size = _bins(x.size, max_points)
+    if size is None:
+        return x, y
+    k = np.arange(x.size)
+    bins = _reshape_bins(y, size)
+    offsets = np.arange(bins.shape[0]) * size
+    idx = np.sort(np.column_stack([offsets + np.argmin(bins, axis=1),
+                                   offsets + np.argmax(bins, axis=1)]), axis=1).ravel()
+    idx = np.unique(np.concatenate([[0], np.minimum(idx, k[-1]), [k[-1]]]))
+    return x[idx], y[idx]
+
+
+def _decimate_band(x, lower, upper, max_points):
+    """ Decimation of band to about max_points points.
+
+    Per bin the minimum of the lower and the maximum of the upper
+    boundary are used at the first and last x of the bin, so the
+    decimated band contains the band.
+    """
+    size = _bins(x.size, max_points)
+    if size is None:
+        return x, lower, upper
+    xb = _reshape_bins(x, size)
+    lower = np.repeat(_reshape_bins(lower, size).min(axis=1), 2)
+    upper = np.repeat(_reshape_bins(upper, size).max(axis=1), 2)
+    return np.column_stack([xb[:, 0], xb[:, -1]]).ravel(), lower, upper
@@ -0,0 +1,152 @@
+"""
+Virtual population (Monte Carlo) simulations.
+
+Parameters of virtual individuals (e.g. bodyweight, liver volume, blood
+flows and enzyme activities) are sampled from distributions via
+Latin hypercube or Sobol sampling. Every individual is simulated and only
+the pharmacokinetic parameters (f_pk) of the requested outputs are kept,
+the timecourses are not stored.
+"""
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.stats import qmc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .simulation import output_selections, simulate_pk, _init_worker, _integrator_settings, _worker
+
+
+# -----------------------------------------------------------------------------
+# Sampling
+# -----------------------------------------------------------------------------
+def distributions_from_parameters(parameters, cv=0.2):
+    """ Parameter distributions around the given parameter values.
+
+    Lognormal distributions with the parameter value as median and the
+    given coefficient of variation, e.g. for the parameters from
+    parameters_for_sensitivity. Negative parameters are normal distributed.
+
+    :param parameters: dict {pid: value}
+    :param cv: coefficient of variation
+    :return: dict {pid: frozen scipy.stats distribution}
+    """
+    sigma = np.sqrt(np.log(1.0 + cv**2))
+    distributions = {}
+    for pid, value in parameters.items():
+        if value > 0:
+            distributions[pid] = stats.lognorm(s=sigma, scale=value)
+        else:
+            distributions[pid] = stats.norm(loc=value, scale=np.abs(value)*cv)
+    return distributions
+
+
+def sample_parameters(distributions, n, method="lhs", seed=None):
+    """ Samples parameters from the distributions.
+
+    :param distributions: dict {pid: frozen scipy.stats distribution}
+    :param n: number of samples
+    :param method: sampling method, 'lhs' (Latin hypercube) or 'sobol'
+    :param seed: seed of the random number generator
+    :return: DataFrame of samples (n, Np) with pids as columns
+    """
+    pids = list(distributions.keys())
+    if method == "lhs":
+        sampler = qmc.LatinHypercube(d=len(pids), seed=seed)
+    elif method == "sobol":
+        sampler = qmc.Sobol(d=len(pids), scramble=True, seed=seed)
+    else:
+        raise ValueError("Invalid sampling method: {}".format(method))
+    u = sampler.random(n)
+
+    samples = pd.DataFrame(index=np.arange(n))
+    for k, pid in enumerate(pids):
+        samples[pid] = distributions[pid].ppf(u[:, k])
+    return samples
+
+
+# -----------------------------------------------------------------------------
+# Population simulation
+# -----------------------------------------------------------------------------
+def iter_population(r, tend, steps, dosing, samples, outputs, changes=None,
+                    pk_kwargs=None, n_workers=None, chunksize=10):
+    """ Simulates the individuals of the population.
+
+    The samples are simulated in chunks. With n_workers the chunks are
+    distributed over a process pool, every worker loads the model once and
+    is reused for all chunks. Per individual only the pharmacokinetic
+    parameters of the outputs are returned, which are accumulated during the
+    simulation (see simulation.simulate_pk).
+
+    :param r: roadrunner model
+    :param tend: end time of simulation
+    :param steps: steps of simulation
+    :param dosing: Dosing or DosingSchedule
+    :param samples: DataFrame of parameter samples (see sample_parameters)
+    :param outputs: list of columns for pharmacokinetic analysis
+    :param changes: dict of changes applied to all individuals
+    :param pk_kwargs: dict of keyword arguments for f_pk, e.g. dose and units
+    :param n_workers: number of worker processes, None or 1 runs serially on r.
+    :param chunksize: individuals per chunk
+    :return: generator of DataFrames of pharmacokinetic parameters per chunk
+    """
+    settings = {
+        'tend': tend, 'steps': steps, 'dosing': dosing,
+        'changes': changes if changes else {},
+        'outputs': outputs,
+        'pk_kwargs': pk_kwargs if pk_kwargs else {},
+    }
+    records = samples.to_dict(orient="index")
+    chunks = [[(idx, records[idx]) for idx in samples.index[k:k+chunksize]]
+              for k in range(0, len(samples), chunksize)]
+    selections = output_selections(outputs)
+
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(r.getSBML(), selections, settings,
+                                           _integrator_settings(r))) as executor:
+            futures = [executor.submit(_simulate_chunk, chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                yield pd.DataFrame(future.result())
+    else:
+        r.timeCourseSelections = selections
+        for chunk in chunks:
+            yield pd.DataFrame(_simulate_individuals(r, chunk, settings))
+
+
+def simulate_population(r, tend, steps, dosing, samples, outputs, changes=None,
+                        pk_kwargs=None, n_workers=None, chunksize=10):
+    """ Simulates the population and returns the pharmacokinetic parameters.
+
+    See iter_population for the arguments.
+
+    :return: DataFrame with one row per individual and output
+    """
+    chunks = list(iter_population(r, tend, steps, dosing, samples, outputs, changes=changes,
+                                  pk_kwargs=pk_kwargs, n_workers=n_workers,
+                                  chunksize=chunksize))
+    df = pd.concat(chunks, ignore_index=True)
+    return df.sort_values(by="individual", kind="stable").reset_index(drop=True)
+
+
+def _simulate_individuals(r, individuals, settings):
+    """ Simulates individuals and calculates pharmacokinetic parameters.
+
+    :param individuals: list of (idx, {pid: value})
+    :return: list of pk dicts with individual and output
+    """
+    rows = []
+    for idx, values in individuals:
+        changes = dict(settings['changes'])
+        changes.update(values)
+        pks = simulate_pk(r, settings['tend'], settings['steps'], settings['dosing'],
+                          settings['outputs'], changes=changes, pk_kwargs=settings['pk_kwargs'])
+        for key, pk in pks.items():
+            pk['individual'] = idx
+            pk['output'] = key
+            rows.append(pk)
+    return rows
+
+
+def _simulate_chunk(chunk):
+    """ Simulates chunk of individuals in the worker process. """
+    return _simulate_individuals(_worker['r'], chunk, _worker)
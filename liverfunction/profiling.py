@@ -0,0 +1,193 @@
+"""
+Profiling of simulations.
+
+The phases of simulate (and of the functions it calls, e.g. simulate_pk)
+are timed when a Profiler is active:
+- reset: restore of the initial model state (snapshot)
+- dosing: dose parameters of the dosing (set_dosing)
+- changes: changes and parameter perturbations
+- integrate: integration with roadrunner (all segments of a dose schedule)
+- frame: DataFrame construction
+- yfun: conversion function
+- statistics: statistics over the parameter perturbations
+- cache: lookup and storage in the result cache
+Every record contains the phase, the wall and CPU time [s], the process and
+the perturbed parameter and factor of the run (None for the baseline).
+Integration records contain the number of output points and integration
+segments. Records of worker processes are collected in the profiler of the
+parent process.
+
+A profiler is activated
+- with the context manager: with profile() as profiler: simulate(...)
+- per call: simulate(..., profiler=profiler)
+- without code changes via the environment variable
+  LIVERFUNCTION_PROFILE=<path>: the records of the process are written
+  as JSON lines to the path at exit.
+Without active profiler the phases cost a single function call.
+"""
+import os
+import json
+import time
+import atexit
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """ Collects timing records of the simulation phases. """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: function called with every record (dict)
+        """
+        self.records = []
+        self.callback = callback
+        self._context = [{}]
+
+    def phase(self, name, **info):
+        """ Context manager timing a phase.
+
+        Phases are nested, records of nested phases contain the info of the
+        enclosing phases (e.g. pid and factor of the run).
+        """
+        return _Phase(self, name, info)
+
+    def add(self, records):
+        """ Adds records, e.g. from worker processes. """
+        for record in records:
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def to_frame(self):
+        """ DataFrame of the records. """
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """ Total wall and CPU time and number of records per phase.
+
+        :return: DataFrame indexed by phase
+        """
+        df = self.to_frame()
+        if df.empty:
+            return df
+        return df.groupby("phase", sort=False).agg(
+            calls=("wall", "size"), wall=("wall", "sum"), cpu=("cpu", "sum")
+        )
+
+    def to_json(self, path, mode="w"):
+        """ Writes the records as JSON lines. """
+        with open(path, mode) as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str))
+                f.write("\n")
+
+
+class _Phase(object):
+    """ Timed phase of a Profiler. """
+    __slots__ = ('profiler', 'name', 'info', 'wall', 'cpu')
+
+    def __init__(self, profiler, name, info):
+        self.profiler = profiler
+        self.name = name
+        self.info = info
+
+    def set(self, **info):
+        """ Adds info to the record of the phase. """
+        self.info.update(info)
+
+    def __enter__(self):
+        context = self.profiler._context
+        if self.info:
+            merged = dict(context[-1])
+            merged.update(self.info)
+            context.append(merged)
+        else:
+            context.append(context[-1])
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        context = self.profiler._context
+        context.pop()
+        record = {'phase': self.name, 'wall': wall, 'cpu': cpu, 'process': os.getpid(),
+                  'pid': None, 'factor': None}
+        record.update(context[-1])
+        record.update(self.info)
+        self.profiler.add([record])
+
+
+class _NoPhase(object):
+    """ Phase without active profiler. """
+    __slots__ = ()
+
+    def set(self, **info):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+# stack of active profilers
+_active = []
+
+
+def active():
+    """ Active profiler or None. """
+    return _active[-1] if _active else None
+
+
+def phase(name, **info):
+    """ Times the phase with the active profiler (no-op without profiler). """
+    if not _active:
+        return _NO_PHASE
+    return _active[-1].phase(name, **info)
+
+
+@contextmanager
+def activate(profiler):
+    """ Activates the profiler in the context (no-op for None). """
+    if profiler is None:
+        yield None
+        return
+    _active.append(profiler)
+    try:
+        yield profiler
+    finally:
+        _active.remove(profiler)
+
+
+@contextmanager
+def profile(callback=None):
+    """ Profiles all simulations in the context.
+
+    :param callback: function called with every record (dict)
+    :return: Profiler
+    """
+    with activate(Profiler(callback=callback)) as profiler:
+        yield profiler
+
+
+def _profile_from_environment():
+    """ Activates process wide profiler if LIVERFUNCTION_PROFILE is set. """
+    path = os.environ.get("LIVERFUNCTION_PROFILE")
+    if path:
+        profiler = Profiler()
+        _active.append(profiler)
+
+        def write():
+            if profiler.records:
+                profiler.to_json(path, mode="a")
+
+        atexit.register(write)
+
+
+_profile_from_environment()
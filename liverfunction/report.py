@@ -0,0 +1,268 @@
+"""
+Batch reports of pharmacokinetic parameters.
+
+Reports for many curves (e.g. scenarios or virtual individuals) reuse a
+single figure per process and only update the data of the artists
+(see PKFigure) instead of creating a new figure per curve.
+The figures are rendered to PNG with the Agg canvas, optionally in
+parallel worker processes, and written as PNG files and/or as a single
+multi-page PDF report. The pharmacokinetic parameters of all curves are
+collected in a summary table.
+"""
+import io
+import os
+import re
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib import image as mimage
+
+
+class PKFigure(object):
+    """ Reusable figure of time course and pharmacokinetic parameters.
+
+    Same layout as pharmacokinetic.pk_figure, but the figure and artists
+    are created once and updated for every curve.
+    """
+
+    def __init__(self, figsize=(10, 4), dpi=80):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        (ax1, ax2) = self.figure.subplots(1, 2)
+        self.figure.subplots_adjust(wspace=0.3)
+        self.axes = (ax1, ax2)
+        kwargs = {"markersize": 10}
+
+        self.lines = {
+            'c': ax1.plot([], [], '--', color="black", label="__nolabel__", **kwargs)[0],
+            'c_before': ax1.plot([], [], 'o', color="darkgray", **kwargs)[0],
+            'c_after': ax1.plot([], [], 's', color="black", linewidth=2, **kwargs)[0],
+            'fit': ax1.plot([], [], '-', color='blue', label="fit")[0],
+            'logc': ax2.plot([], [], '--', color="black", label='__nolabel__', **kwargs)[0],
+            'logc_before': ax2.plot([], [], 'o', color="darkgray", label='log(substance)', **kwargs)[0],
+            'logc_after': ax2.plot([], [], 's', color="black", linewidth=2, label='log(substance) fit',
+                                   **kwargs)[0],
+            'logfit': ax2.plot([], [], '-', color='blue', label="fit")[0],
+        }
+        ax1.legend()
+        ax2.legend()
+        self.title = self.figure.suptitle("")
+
+    def update(self, t, c, pk, title=None):
+        """ Updates the figure with time course and pharmacokinetic parameters.
+
+        :param t: time vector
+        :param c: concentration vector
+        :param pk: set of pharmacokinetic parameters returned by f_pk.
+        :param title: title of figure
+        """
+        t = np.asarray(t, dtype=float)
+        c = np.asarray(c, dtype=float)
+        c_unit = pk['cmax_unit']
+        t_unit = pk['tmax_unit']
+        slope = pk['slope']
+        intercept = pk['intercept']
+        max_idx = pk['max_idx']
+        if max_idx is None or np.isnan(max_idx):
+            max_idx = c.size-1
+        max_idx = int(max_idx)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            logc = np.log(c)
+        logc[~np.isfinite(logc)] = np.nan
+
+        lines = self.lines
+        lines['c'].set_data(t, c)
+        lines['c_before'].set_data(t[:max_idx+1], c[:max_idx+1])
+        lines['c_after'].set_data(t[max_idx+1:], c[max_idx+1:])
+        lines['fit'].set_data(t, np.exp(intercept) * np.exp(slope * t))
+        lines['logc'].set_data(t[1:], logc[1:])
+        lines['logc_before'].set_data(t[1:max_idx+1], logc[1:max_idx+1])
+        lines['logc_after'].set_data(t[max_idx+1:], logc[max_idx+1:])
+        lines['logfit'].set_data(t, intercept + slope * t)
+
+        (ax1, ax2) = self.axes
+        ax1.set_ylabel('substance [{}]'.format(c_unit))
+        ax1.set_xlabel('time [{}]'.format(t_unit))
+        ax2.set_ylabel('log(substance [{}])'.format(c_unit))
+        ax2.set_xlabel('time [{}]'.format(t_unit))
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
+        self.title.set_text(title if title is not None else pk['compound'])
+
+    def to_png(self):
+        """ PNG of the figure.
+
+        :return: bytes
+        """
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format="png")
+        return buffer.getvalue()
+
+
+# -----------------------------------------------------------------------------
+# Batch reports
+# -----------------------------------------------------------------------------
+def pk_summary(pks, names=None):
+    """ Summary table of pharmacokinetic parameters.
+
+    :param pks: list of pk dicts (see f_pk)
+    :param names: names of the curves, defaults to the compounds
+    :return: DataFrame with one row per pk dict
+    """
+    df = pd.DataFrame(list(pks))
+    if names is not None:
+        df.insert(0, "name", list(names))
+    return df
+
+
+def render_pk_figures(curves, n_workers=None, chunksize=10, figsize=(10, 4), dpi=80):
+    """ Renders figures of the curves as PNG.
+
+    Every process reuses a single PKFigure. With n_workers the curves are
+    rendered in chunks in a pool of worker processes (Agg canvas).
+
+    :param curves: list of (name, t, c, pk)
+    :param n_workers: number of worker processes, None or 1 renders in process.
+    :param chunksize: curves per work item
+    :return: generator of PNG bytes in order of the curves
+    """
+    curves = list(curves)
+    chunks = [curves[k:k+chunksize] for k in range(0, len(curves), chunksize)]
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_report_worker,
+                                 initargs=(figsize, dpi)) as executor:
+            for pngs in executor.map(_render_chunk, chunks):
+                for png in pngs:
+                    yield png
+    else:
+        figure = PKFigure(figsize=figsize, dpi=dpi)
+        for chunk in chunks:
+            for png in _render(figure, chunk):
+                yield png
+
+
+def write_pk_report(curves, pdf_path=None, png_dir=None, summary_path=None, n_workers=None,
+                    chunksize=10, figsize=(10, 4), dpi=80):
+    """ Writes report of pharmacokinetic parameters for many curves.
+
+    The figures are written
+    - as one page per curve to a multi-page PDF (pdf_path)
+    - as PNG files per curve (png_dir)
+    The summary table of all pk dicts is written as CSV (summary_path).
+
+    Without n_workers a single PKFigure is updated for all curves and the
+    PDF pages are vector graphics. With n_workers the figures are rendered
+    as PNG in the worker processes (see render_pk_figures) and the PDF pages
+    contain these images.
+
+    :param curves: list of (name, t, c, pk)
+    :param pdf_path: path of multi-page PDF report
+    :param png_dir: directory for PNG figures ({name}.png), characters of the
+        names which are invalid in file names (e.g. '/' of catalog ids) are
+        replaced by '_' (see png_filename)
+    :param summary_path: path of CSV summary table
+    :param n_workers: number of worker processes for rendering
+    :param chunksize: curves per work item
+    :return: DataFrame summary of the pharmacokinetic parameters
+    """
+    curves = list(curves)
+    names = [str(curve[0]) for curve in curves]
+    summary = pk_summary([curve[3] for curve in curves], names=names)
+    if summary_path is not None:
+        summary.to_csv(summary_path, index=False)
+
+    if pdf_path is None and png_dir is None:
+        return summary
+    if png_dir is not None:
+        os.makedirs(png_dir, exist_ok=True)
+
+    filenames = set()
+
+    def write_png(name, png):
+        filename = png_filename(name, used=filenames)
+        filenames.add(filename)
+        with open(os.path.join(png_dir, filename), "wb") as f:
+            f.write(png)
+
+    pdf = PdfPages(pdf_path) if pdf_path is not None else None
+    try:
+        if n_workers is not None and n_workers > 1:
+            page = None
+            pngs = render_pk_figures(curves, n_workers=n_workers, chunksize=chunksize,
+                                     figsize=figsize, dpi=dpi)
+            for name, png in zip(names, pngs):
+                if png_dir is not None:
+                    write_png(name, png)
+                if pdf is not None:
+                    data = mimage.imread(io.BytesIO(png), format="png")
+                    if page is None:
+                        # page with the rendered image, the image data is updated
+                        page = Figure(figsize=(data.shape[1]/dpi, data.shape[0]/dpi), dpi=dpi)
+                        image = page.figimage(data)
+                    else:
+                        image.set_data(data)
+                    pdf.savefig(page, dpi=dpi)
+        else:
+            figure = PKFigure(figsize=figsize, dpi=dpi)
+            for name, t, c, pk in curves:
+                figure.update(t, c, pk, title=str(name))
+                if png_dir is not None:
+                    write_png(name, figure.to_png())
+                if pdf is not None:
+                    pdf.savefig(figure.figure)
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+    return summary
+
+
+def png_filename(name, used=()):
+    """ File name of the PNG figure of the curve.
+
+    Characters other than letters, digits, '.', '-' and '_' are replaced by
+    '_', e.g. 'Critchley1994/Fig1' -> 'Critchley1994_Fig1.png'. Names which
+    collide after the replacement are numbered.
+
+    :param name: name of the curve
+    :param used: file names already in use
+    :return: file name
+    """
+    stem = re.sub(r"[^A-Za-z0-9._-]", "_", str(name)).strip(".") or "curve"
+    filename = "{}.png".format(stem)
+    k = 1
+    while filename in used:
+        filename = "{}_{}.png".format(stem, k)
+        k += 1
+    return filename
+
+
+def _render(figure, curves):
+    """ Renders curves on the figure.
+
+    :return: list of PNG bytes
+    """
+    pngs = []
+    for name, t, c, pk in curves:
+        figure.update(t, c, pk, title=str(name))
+        pngs.append(figure.to_png())
+    return pngs
+
+
+# state of the worker processes (figure)
+_report = {}
+
+
+def _init_report_worker(figsize, dpi):
+    """ Initializes worker process with a reusable figure. """
+    _report['figure'] = PKFigure(figsize=figsize, dpi=dpi)
+
+
+def _render_chunk(chunk):
+    """ Renders chunk of curves in the worker process. """
+    return _render(_report['figure'], chunk)
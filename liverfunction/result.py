@@ -0,0 +1,253 @@
+"""
+Results of simulations with parameter sensitivity.
+
+A Result stores the timecourses of the simulation with the reference
+parameters (base) and the statistics over the parameter perturbations
+(mean, std, min, max) in a single contiguous array of shape (5, Nt, Ns)
+with one shared column index. The fields are available as DataFrame views
+on this array (no copies), as for the former namedtuple of DataFrames.
+
+If the simulations of the parameter perturbations are kept (samples of
+shape (2*Np, Nt, Ns)), quantile bands (e.g. 5 % and 95 %) are computed on
+request.
+
+Results are serialized to npz or to Arrow IPC files (requires pyarrow),
+which are memory-mapped when loaded.
+
+Kept free of roadrunner and pandas imports, so results can be handled
+(e.g. in plotting) without loading the simulation stack.
+"""
+import json
+import numpy as np
+
+
+class Result(object):
+    """ Timecourses of simulation with parameter sensitivity.
+
+    Created from the DataFrames of the fields (as the former namedtuple)
+        Result(base=df, mean=df_mean, std=df_std, min=df_min, max=df_max)
+    or from the data array of shape (5, Nt, Ns) with the columns
+        Result(data=data, columns=columns, samples=samples)
+    """
+    _fields = ('base', 'mean', 'std', 'min', 'max')
+
+    def __init__(self, base=None, mean=None, std=None, min=None, max=None,
+                 data=None, columns=None, samples=None):
+        """
+        :param base: DataFrame of the simulation with reference parameters
+        :param mean: DataFrame of the mean over the parameter changes
+        :param std: DataFrame of the standard deviation over the parameter changes
+        :param min: DataFrame of the minimum over the parameter changes
+        :param max: DataFrame of the maximum over the parameter changes
+        :param data: array (5, Nt, Ns) of the fields, alternative to the DataFrames
+        :param columns: columns of the data
+        :param samples: array (2*Np, Nt, Ns) of the simulations of the parameter changes
+        """
+        if data is None:
+            frames = (base, mean, std, min, max)
+            if any(df is None for df in frames):
+                raise ValueError("Result requires all fields {} or data.".format(self._fields))
+            columns = list(base.columns)
+            data = np.empty((len(frames), ) + base.shape, dtype=np.result_type(*[
+                np.asarray(df).dtype for df in frames
+            ]))
+            for k, df in enumerate(frames):
+                if list(df.columns) != columns:
+                    raise ValueError("Columns of Result fields differ.")
+                data[k] = np.asarray(df)
+        else:
+            data = np.asarray(data)
+            if data.ndim != 3 or data.shape[0] != len(self._fields):
+                raise ValueError("Result data must have shape (5, Nt, Ns), not {}.".format(data.shape))
+            if columns is None or len(columns) != data.shape[2]:
+                raise ValueError("Result requires the columns of the data.")
+        if samples is not None and samples.shape[1:] != data.shape[1:]:
+            raise ValueError("Samples must have shape (Np, {}, {}), not {}.".format(
+                data.shape[1], data.shape[2], samples.shape))
+
+        self.data = data
+        self.columns = list(columns)
+        self.samples = samples
+        self._index = None
+        self._frames = {}
+        self._quantiles = {}
+
+    # -------------------------------------------------------------------------
+    # fields
+    # -------------------------------------------------------------------------
+    def frame(self, field):
+        """ DataFrame view of a field on the data array.
+
+        :param field: one of Result._fields
+        :return: DataFrame (shares memory with data)
+        """
+        df = self._frames.get(field)
+        if df is None:
+            df = self._frame(self.data[self._fields.index(field)])
+            self._frames[field] = df
+        return df
+
+    @property
+    def base(self):
+        return self.frame('base')
+
+    @property
+    def mean(self):
+        return self.frame('mean')
+
+    @property
+    def std(self):
+        return self.frame('std')
+
+    @property
+    def min(self):
+        return self.frame('min')
+
+    @property
+    def max(self):
+        return self.frame('max')
+
+    @property
+    def shape(self):
+        """ Shape (Nt, Ns) of the timecourses. """
+        return self.data.shape[1:]
+
+    @property
+    def nbytes(self):
+        """ Memory of the data array (and samples) in bytes. """
+        nbytes = self.data.nbytes
+        if self.samples is not None:
+            nbytes += self.samples.nbytes
+        return nbytes
+
+    def astype(self, dtype):
+        """ Result with data (and samples) converted to dtype, e.g. np.float32. """
+        return Result(data=self.data.astype(dtype), columns=self.columns,
+                      samples=self.samples.astype(dtype) if self.samples is not None else None)
+
+    def _frame(self, values):
+        import pandas as pd
+        if self._index is None:
+            self._index = pd.Index(self.columns)
+        return pd.DataFrame(values, columns=self._index, copy=False)
+
+    # namedtuple interface
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return (self.frame(field) for field in self._fields)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return tuple(self.frame(field) for field in self._fields[k])
+        return self.frame(self._fields[k])
+
+    def _asdict(self):
+        return {field: self.frame(field) for field in self._fields}
+
+    def __repr__(self):
+        return "Result(shape={}, samples={}, dtype={})".format(
+            self.shape, None if self.samples is None else self.samples.shape[0], self.data.dtype)
+
+    # -------------------------------------------------------------------------
+    # quantiles
+    # -------------------------------------------------------------------------
+    def quantile(self, q):
+        """ Quantile over the simulations of the parameter changes.
+
+        Computed on first request and stored with the result.
+
+        :param q: quantile in [0, 1]
+        :return: DataFrame
+        """
+        if self.samples is None:
+            raise ValueError("Quantiles require the samples of the parameter changes, "
+                             "see simulate(..., samples=True).")
+        q = float(q)
+        values = self._quantiles.get(q)
+        if values is None:
+            values = np.quantile(self.samples, q, axis=0).astype(self.data.dtype, copy=False)
+            self._quantiles[q] = values
+        return self._frame(values)
+
+    def band(self, lower=0.05, upper=0.95):
+        """ Quantile band over the simulations of the parameter changes.
+
+        :param lower: lower quantile
+        :param upper: upper quantile
+        :return: tuple of DataFrames (lower, upper)
+        """
+        return self.quantile(lower), self.quantile(upper)
+
+    # -------------------------------------------------------------------------
+    # serialization
+    # -------------------------------------------------------------------------
+    def to_arrays(self):
+        """ Dict of arrays of the result (data, columns and samples). """
+        arrays = {'data': self.data, 'columns': np.array(self.columns, dtype=str)}
+        if self.samples is not None:
+            arrays['samples'] = self.samples
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ Result from dict of arrays (see to_arrays). """
+        return cls(data=arrays['data'], columns=[str(c) for c in arrays['columns']],
+                   samples=arrays.get('samples'))
+
+    def to_npz(self, path):
+        """ Writes result to npz file (uncompressed, arrays are written without copies). """
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def from_npz(cls, path):
+        """ Reads result from npz file. """
+        with np.load(path) as f:
+            return cls.from_arrays({name: f[name] for name in f.files})
+
+    def to_arrow(self):
+        """ Arrow table of the result (requires pyarrow).
+
+        The data array is stored as a single column of the flat data
+        (zero-copy), the shape and columns as schema metadata.
+        The samples are not stored.
+
+        :return: pyarrow.Table
+        """
+        import pyarrow as pa
+        data = np.ascontiguousarray(self.data)
+        table = pa.table({'data': pa.array(data.reshape(-1))})
+        return table.replace_schema_metadata({
+            'shape': json.dumps(list(data.shape)),
+            'columns': json.dumps(self.columns),
+        })
+
+    @classmethod
+    def from_arrow(cls, table):
+        """ Result from Arrow table (see to_arrow), zero-copy for a single chunk. """
+        metadata = table.schema.metadata
+        shape = json.loads(metadata[b'shape'].decode())
+        columns = json.loads(metadata[b'columns'].decode())
+        column = table.column('data')
+        if column.num_chunks == 1:
+            data = column.chunk(0).to_numpy()
+        else:
+            data = column.to_numpy()
+        return cls(data=data.reshape(shape), columns=columns)
+
+    def to_feather(self, path):
+        """ Writes result as Arrow IPC file (requires pyarrow). """
+        import pyarrow as pa
+        table = self.to_arrow()
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    @classmethod
+    def from_feather(cls, path):
+        """ Reads result from Arrow IPC file, the data is memory-mapped (read-only). """
+        import pyarrow as pa
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        return cls.from_arrow(table)
@@ -0,0 +1,162 @@
+"""
+Batch simulation of scenarios.
+
+A scenario is a dosing (Dosing or DosingSchedule) with a dict of changes,
+e.g. different doses and routes for patient covariates like bodyweight
+or changes of the liver function. The scenarios are simulated in one call:
+- the selections are set once
+- identical scenarios are simulated only once
+- with n_workers the scenarios run on a pool of preloaded models
+The timecourses are written in one long-format result indexed by scenario.
+"""
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from .simulation import Timecourse, set_selections, output_selections, _simulate_once, _init_worker, \
+    _integrator_settings, _worker
+
+
+# -----------------------------------------------------------------------------
+# Scenario table
+# -----------------------------------------------------------------------------
+def scenario_table(dosings, changes=None):
+    """ Scenarios for all combinations of dosings and changes.
+
+    :param dosings: dict {dosing id: Dosing} or list of Dosing
+    :param changes: dict {changes id: dict of changes} or list of dicts of changes
+    :return: DataFrame with columns dosing_id, changes_id, dosing and changes
+        indexed by scenario
+    """
+    if not isinstance(dosings, dict):
+        dosings = dict(enumerate(dosings))
+    if changes is None:
+        changes = {None: {}}
+    elif not isinstance(changes, dict):
+        changes = dict(enumerate(changes))
+
+    rows = []
+    for (dosing_id, dosing), (changes_id, c) in itertools.product(dosings.items(), changes.items()):
+        rows.append({
+            'dosing_id': dosing_id, 'changes_id': changes_id,
+            'dosing': dosing, 'changes': c,
+        })
+    df = pd.DataFrame(rows, columns=['dosing_id', 'changes_id', 'dosing', 'changes'])
+    df.index.name = "scenario"
+    return df
+
+
+def _scenario_key(dosing, changes):
+    """ Hashable key of scenario (identical keys give identical simulations). """
+    if dosing is None:
+        dosing_key = None
+    else:
+        dosing_key = (dosing.__class__.__name__,
+                      repr(sorted(vars(dosing).items(), key=lambda item: item[0])))
+    return (tuple(sorted(changes.items())), dosing_key)
+
+
+# -----------------------------------------------------------------------------
+# Simulation
+# -----------------------------------------------------------------------------
+def simulate_scenarios(r, tend, steps, scenarios, selections=None, outputs=None,
+                       yfun=None, n_workers=None, chunksize=None):
+    """ Simulates all scenarios of the scenario table.
+
+    Every scenario is simulated from the initial state of the model with
+    its dosing and changes (see simulation.simulate). Identical scenarios
+    are only simulated once. With n_workers the scenarios are distributed
+    over a process pool, every worker loads the model once. A given yfun
+    must be picklable (i.e. a module level function) when used with n_workers.
+
+    :param r: roadrunner model
+    :param tend: end time of simulation
+    :param steps: steps of simulation
+    :param scenarios: DataFrame with columns dosing and changes indexed by
+        scenario (see scenario_table), or list of dicts with dosing and changes
+    :param selections: timecourse selections, defaults to all model variables
+    :param outputs: list of required outputs (see output_selections),
+        ignored if selections are given.
+    :param yfun: conversion function applied to every simulation
+    :param n_workers: number of worker processes, None or 1 runs serially on r.
+    :param chunksize: scenarios per work item for the process pool
+    :return: DataFrame of timecourses with MultiIndex (scenario, step)
+    """
+    if not isinstance(scenarios, pd.DataFrame):
+        scenarios = pd.DataFrame(list(scenarios))
+    if len(scenarios) == 0:
+        raise ValueError("No scenarios to simulate.")
+
+    # set selections
+    if selections is None and outputs is not None:
+        selections = output_selections(outputs, yfun=yfun, r=r)
+    if selections is None:
+        set_selections(r)
+    else:
+        r.timeCourseSelections = selections
+
+    # unique scenarios
+    runs = {}
+    keys = []
+    for sid, row in scenarios.iterrows():
+        dosing = row.get("dosing", None)
+        changes = row.get("changes", None)
+        if not isinstance(changes, dict):
+            changes = {}
+        key = _scenario_key(dosing, changes)
+        keys.append(key)
+        if key not in runs:
+            runs[key] = (dosing, changes)
+    items = [(key, ) + run for key, run in runs.items()]
+
+    executor = None
+    if n_workers is not None and n_workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(r.getSBML(), r.timeCourseSelections, {
+                'tend': tend, 'steps': steps, 'yfun': yfun,
+            }, _integrator_settings(r))
+        )
+        if chunksize is None:
+            chunksize = max(1, len(items) // (4 * n_workers))
+        results = executor.map(_simulate_scenario, items, chunksize=chunksize)
+    else:
+        results = (_simulate_run(r, tend, steps, item, yfun=yfun) for item in items)
+
+    try:
+        data = {}
+        columns = None
+        for key, s, s_columns in results:
+            data[key] = s
+            if columns is None:
+                columns = s_columns
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # long format in order of the scenario table
+    Nt = steps + 1
+    values = np.empty((len(keys) * Nt, len(columns)))
+    for k, key in enumerate(keys):
+        values[k*Nt:(k+1)*Nt, :] = data[key]
+    index = pd.MultiIndex.from_product([scenarios.index, np.arange(Nt)],
+                                       names=["scenario", "step"])
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def _simulate_run(r, tend, steps, item, yfun=None):
+    """ Simulates single scenario (key, dosing, changes).
+
+    :return: (key, array of simulation, columns)
+    """
+    key, dosing, changes = item
+    s = Timecourse.from_simulation(_simulate_once(r, tend, steps, dosing, changes, yfun=yfun))
+    return key, np.asarray(s.data, dtype=float), s.columns
+
+
+def _simulate_scenario(item):
+    """ Simulates single scenario in the worker process. """
+    return _simulate_run(_worker['r'], _worker['tend'], _worker['steps'], item,
+                         yfun=_worker['yfun'])
@@ -0,0 +1,239 @@
+"""
+Global sensitivity analysis of pharmacokinetic parameters.
+
+Variance based (Sobol) first and total order indices with the Saltelli
+sampling scheme and Morris elementary effects. The sample matrices are
+created once (and can be reused for multiple outputs and pharmacokinetic
+metrics); the model runs are executed in parallel batches via the
+population simulation, which reduces every run to the f_pk parameters.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+from .population import simulate_population
+
+
+# -----------------------------------------------------------------------------
+# Sobol indices
+# -----------------------------------------------------------------------------
+SaltelliSample = namedtuple("SaltelliSample", ['samples', 'n', 'parameters'])
+MorrisSample = namedtuple("MorrisSample", ['samples', 'trajectories', 'parameters', 'delta', 'directions'])
+
+
+def saltelli_sample(distributions, n, seed=None):
+    """ Saltelli sample matrices for Sobol indices.
+
+    Two independent sample matrices A and B (n, Np) are created from a
+    Sobol sequence. The samples consist of the blocks
+    [A, B, AB_1, ..., AB_Np, BA_1, ..., BA_Np], with AB_i the matrix A with
+    column i from B (BA_i accordingly), i.e. n*(2*Np+2) samples in total.
+
+    :param distributions: dict {pid: frozen scipy.stats distribution}
+    :param n: number of base samples (power of 2 for Sobol sequences)
+    :param seed: seed of the random number generator
+    :return: SaltelliSample
+    """
+    pids = list(distributions.keys())
+    Np = len(pids)
+    u = qmc.Sobol(d=2*Np, scramble=True, seed=seed).random(n)
+    A, B = u[:, :Np], u[:, Np:]
+
+    blocks = [A, B]
+    for i in range(Np):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(AB)
+    for i in range(Np):
+        BA = B.copy()
+        BA[:, i] = A[:, i]
+        blocks.append(BA)
+    u = np.vstack(blocks)
+
+    samples = pd.DataFrame(index=np.arange(u.shape[0]))
+    for k, pid in enumerate(pids):
+        samples[pid] = distributions[pid].ppf(u[:, k])
+    return SaltelliSample(samples=samples, n=n, parameters=pids)
+
+
+def sobol_indices(sample, y, n_bootstrap=100, seed=None):
+    """ First and total order Sobol indices from the model outputs of Saltelli sample.
+
+    First order indices are calculated with the estimator of Saltelli (2010),
+    total order indices with the estimator of Jansen (1999). Both estimators
+    are averaged over the (A, AB_i) and (B, BA_i) matrices.
+    Confidence intervals (95%) are estimated by bootstrap.
+
+    :param sample: SaltelliSample
+    :param y: model outputs for the samples (n*(2*Np+2))
+    :param n_bootstrap: number of bootstrap samples for confidence intervals
+    :param seed: seed of the random number generator for bootstrap
+    :return: DataFrame with S1, S1_conf, ST, ST_conf per parameter
+    """
+    n, Np = sample.n, len(sample.parameters)
+    y = np.asarray(y, dtype=float)
+    if y.size != n * (2*Np + 2):
+        raise ValueError("Outputs do not match Saltelli sample: {} != {}".format(y.size, n * (2*Np + 2)))
+    blocks = y.reshape(2*Np + 2, n)
+    fA, fB = blocks[0], blocks[1]
+    fAB, fBA = blocks[2:Np+2], blocks[Np+2:]
+
+    def estimate(idx):
+        var = np.var(np.concatenate([fA[idx], fB[idx]]))
+        S1 = 0.5 * (np.mean(fB[idx] * (fAB[:, idx] - fA[idx]), axis=1)
+                    + np.mean(fA[idx] * (fBA[:, idx] - fB[idx]), axis=1)) / var
+        ST = 0.25 * (np.mean((fA[idx] - fAB[:, idx])**2, axis=1)
+                     + np.mean((fB[idx] - fBA[:, idx])**2, axis=1)) / var
+        return S1, ST
+
+    S1, ST = estimate(np.arange(n))
+    S1_conf, ST_conf = np.full(Np, np.nan), np.full(Np, np.nan)
+    if n_bootstrap:
+        rng = np.random.RandomState(seed)
+        boot = [estimate(rng.randint(n, size=n)) for _ in range(n_bootstrap)]
+        S1_conf = 1.96 * np.std([b[0] for b in boot], axis=0)
+        ST_conf = 1.96 * np.std([b[1] for b in boot], axis=0)
+
+    return pd.DataFrame({
+        'S1': S1, 'S1_conf': S1_conf, 'ST': ST, 'ST_conf': ST_conf
+    }, index=pd.Index(sample.parameters, name="parameter"))
+
+
+# -----------------------------------------------------------------------------
+# Morris elementary effects
+# -----------------------------------------------------------------------------
+def morris_sample(distributions, trajectories, levels=4, seed=None):
+    """ Morris trajectories for elementary effects.
+
+    Every trajectory consists of Np+1 points, with one parameter changed by
+    delta = levels/(2*(levels-1)) in the unit hypercube per step. The grid
+    levels are mapped to the centers of equiprobable bins of the distributions.
+
+    :param distributions: dict {pid: frozen scipy.stats distribution}
+    :param trajectories: number of trajectories
+    :param levels: number of grid levels (even)
+    :param seed: seed of the random number generator
+    :return: MorrisSample
+    """
+    pids = list(distributions.keys())
+    Np = len(pids)
+    rng = np.random.RandomState(seed)
+    delta = levels / (2.0 * (levels - 1))
+
+    u = np.empty((trajectories * (Np + 1), Np))
+    directions = np.empty((trajectories, Np), dtype=int)
+    for k in range(trajectories):
+        # start point on grid with x + delta within [0, 1]
+        x = rng.randint(levels // 2, size=Np) / (levels - 1.0)
+        signs = rng.choice([-1, 1], size=Np)
+        # start from upper point for negative steps
+        x = np.where(signs < 0, x + delta, x)
+        order = rng.permutation(Np)
+        points = [x.copy()]
+        for i in order:
+            x[i] += signs[i] * delta
+            points.append(x.copy())
+        u[k*(Np+1):(k+1)*(Np+1), :] = points
+        directions[k, :] = order
+
+    # grid levels to bin centers
+    q = (u * (levels - 1) + 0.5) / levels
+
+    samples = pd.DataFrame(index=np.arange(u.shape[0]))
+    for k, pid in enumerate(pids):
+        samples[pid] = distributions[pid].ppf(q[:, k])
+    return MorrisSample(samples=samples, trajectories=trajectories, parameters=pids,
+                        delta=delta, directions=directions)
+
+
+def morris_indices(sample, y):
+    """ Elementary effects from the model outputs of Morris sample.
+
+    The elementary effects are calculated in the unit hypercube, i.e.
+    the output change for a step of delta.
+
+    :param sample: MorrisSample
+    :param y: model outputs for the samples (trajectories*(Np+1))
+    :return: DataFrame with mu, mu_star and sigma per parameter
+    """
+    Np = len(sample.parameters)
+    y = np.asarray(y, dtype=float).reshape(sample.trajectories, Np + 1)
+    u = sample.samples.values.reshape(sample.trajectories, Np + 1, Np)
+
+    effects = np.empty((sample.trajectories, Np))
+    for k in range(sample.trajectories):
+        for step, i in enumerate(sample.directions[k]):
+            # sign of the step in the parameter
+            sign = np.sign(u[k, step+1, i] - u[k, step, i])
+            effects[k, i] = sign * (y[k, step+1] - y[k, step]) / sample.delta
+
+    return pd.DataFrame({
+        'mu': np.mean(effects, axis=0),
+        'mu_star': np.mean(np.abs(effects), axis=0),
+        'sigma': np.std(effects, axis=0, ddof=1) if sample.trajectories > 1 else np.nan,
+    }, index=pd.Index(sample.parameters, name="parameter"))
+
+
+# -----------------------------------------------------------------------------
+# Analysis
+# -----------------------------------------------------------------------------
+def evaluate_sample(r, tend, steps, dosing, sample, outputs, metrics=("auc", "cmax", "thalf"),
+                    changes=None, pk_kwargs=None, n_workers=None, chunksize=10):
+    """ Pharmacokinetic parameters for all samples.
+
+    The samples are simulated in parallel batches (see population.iter_population),
+    every run is reduced to the pharmacokinetic metrics.
+
+    :return: dict {(output, metric): array of outputs in order of the samples}
+    """
+    df = simulate_population(r, tend, steps, dosing, sample.samples, outputs=outputs,
+                             changes=changes, pk_kwargs=pk_kwargs, n_workers=n_workers,
+                             chunksize=chunksize)
+    results = {}
+    for output in outputs:
+        df_output = df[df.output == output].set_index("individual").reindex(sample.samples.index)
+        for metric in metrics:
+            results[(output, metric)] = df_output[metric].values.astype(float)
+    return results
+
+
+def sobol_analysis(r, tend, steps, dosing, distributions, outputs, n=64,
+                   metrics=("auc", "cmax", "thalf"), seed=None, n_bootstrap=100, **kwargs):
+    """ Sobol sensitivity analysis of pharmacokinetic metrics.
+
+    Requires n*(2*Np+2) model simulations, see evaluate_sample for the
+    additional arguments (e.g. n_workers).
+
+    :return: DataFrame of Sobol indices per output, metric and parameter
+    """
+    sample = saltelli_sample(distributions, n=n, seed=seed)
+    results = evaluate_sample(r, tend, steps, dosing, sample, outputs, metrics=metrics, **kwargs)
+    dfs = []
+    for (output, metric), y in results.items():
+        df = sobol_indices(sample, y, n_bootstrap=n_bootstrap, seed=seed).reset_index()
+        df.insert(0, "metric", metric)
+        df.insert(0, "output", output)
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def morris_analysis(r, tend, steps, dosing, distributions, outputs, trajectories=10, levels=4,
+                    metrics=("auc", "cmax", "thalf"), seed=None, **kwargs):
+    """ Morris screening of pharmacokinetic metrics.
+
+    Requires trajectories*(Np+1) model simulations, see evaluate_sample for the
+    additional arguments (e.g. n_workers).
+
+    :return: DataFrame of elementary effects per output, metric and parameter
+    """
+    sample = morris_sample(distributions, trajectories=trajectories, levels=levels, seed=seed)
+    results = evaluate_sample(r, tend, steps, dosing, sample, outputs, metrics=metrics, **kwargs)
+    dfs = []
+    for (output, metric), y in results.items():
+        df = morris_indices(sample, y).reset_index()
+        df.insert(0, "metric", metric)
+        df.insert(0, "output", output)
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
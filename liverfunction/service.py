@@ -0,0 +1,203 @@
+"""
+Asyncio front end for simulations.
+
+The SimulationService runs the simulations in a bounded pool of worker
+processes, so the event loop is never blocked. Every worker loads the
+model once via load_model (i.e. from the model cache) and is reused for
+all requests.
+
+The number of requests running in the pool is bounded by n_workers,
+further requests wait in a queue of size max_queue. If the queue is full
+the request is rejected with a ServiceBusyError (backpressure).
+Requests can be cancelled or time out: requests still waiting for the
+pool are removed, running simulations finish in the worker but their
+results are discarded (the worker slot is released afterwards).
+
+Usage:
+    async with SimulationService(model_path, n_workers=4) as service:
+        s = await service.simulate(tend=24, steps=100, dosing=dosing, outputs=["Ave_apap"])
+"""
+import asyncio
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from .simulation import load_model, output_selections, set_selections, Timecourse, _simulate_once
+from .pharmacokinetic import f_pk
+
+
+class ServiceBusyError(RuntimeError):
+    """ Raised if the request queue of the service is full. """
+    pass
+
+
+class SimulationService(object):
+    """ Asynchronous simulation service with bounded worker pool. """
+
+    def __init__(self, model_path, n_workers=2, max_queue=64, timeout=None):
+        """
+        :param model_path: path to SBML model
+        :param n_workers: number of worker processes (maximal running requests)
+        :param max_queue: maximal number of requests waiting for a worker
+        :param timeout: default timeout of requests in seconds (None for no timeout)
+        """
+        self.model_path = model_path
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        self._slots = None
+        self._waiting = 0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def start(self):
+        """ Starts the worker pool. """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                initializer=_init_service_worker,
+                initargs=(self.model_path,)
+            )
+            self._slots = asyncio.Semaphore(self.n_workers)
+            self._waiting = 0
+
+    async def close(self):
+        """ Shuts down the worker pool after the running requests. """
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, executor.shutdown)
+
+    @property
+    def pending(self):
+        """ Number of requests waiting for a worker. """
+        return self._waiting
+
+    async def simulate(self, tend, steps, dosing, changes=None, outputs=None, selections=None,
+                       timeout=None):
+        """ Simulates the model in a worker process (see simulation.simulate).
+
+        :param outputs: list of required outputs (see output_selections),
+            ignored if selections are given.
+        :param selections: timecourse selections, defaults to all model variables
+        :param timeout: timeout in seconds, defaults to the service timeout
+        :return: DataFrame of simulation
+        """
+        if selections is None and outputs is not None:
+            selections = output_selections(outputs)
+        data, columns = await self._run(
+            _service_simulate, (tend, steps, dosing, changes, selections), timeout=timeout
+        )
+        return pd.DataFrame(data, columns=columns, copy=False)
+
+    async def f_pk(self, tend, steps, dosing, outputs, changes=None, pk_kwargs=None, timeout=None):
+        """ Pharmacokinetic parameters of the outputs calculated in a worker process.
+
+        Only the pharmacokinetic parameters are transferred from the worker.
+
+        :param outputs: list of columns for pharmacokinetic analysis
+        :param pk_kwargs: dict of keyword arguments for f_pk, e.g. dose and units
+        :param timeout: timeout in seconds, defaults to the service timeout
+        :return: DataFrame with one row per output
+        """
+        rows = await self._run(
+            _service_f_pk, (tend, steps, dosing, changes, outputs, pk_kwargs), timeout=timeout
+        )
+        return pd.DataFrame(rows)
+
+    async def _run(self, f, args, timeout=None):
+        """ Runs f(*args) in the worker pool with queueing and timeout. """
+        if self._executor is None:
+            raise RuntimeError("SimulationService is not started.")
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        # queue
+        if self._slots.locked() and self._waiting >= self.max_queue:
+            raise ServiceBusyError("Request queue is full ({} waiting).".format(self._waiting))
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=_remaining(loop, deadline))
+        finally:
+            self._waiting -= 1
+
+        # worker
+        future = self._executor.submit(f, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          timeout=_remaining(loop, deadline))
+        finally:
+            if future.cancel() or future.done():
+                self._slots.release()
+            else:
+                # running simulations can not be interrupted, the slot is
+                # released when the worker is finished
+                future.add_done_callback(
+                    lambda _: loop.call_soon_threadsafe(self._slots.release)
+                )
+
+
+def _remaining(loop, deadline):
+    """ Remaining time until deadline (None for no deadline). """
+    if deadline is None:
+        return None
+    return max(0.0, deadline - loop.time())
+
+
+# -----------------------------------------------------------------------------
+# Worker processes
+# -----------------------------------------------------------------------------
+# state of the service worker processes (model and current selections)
+_service = {}
+
+
+def _init_service_worker(model_path):
+    """ Initializes worker process by loading the model from the model cache. """
+    _service.clear()
+    _service['r'] = load_model(model_path, timeCourseSelections=False)
+    _service['selections'] = False
+
+
+def _set_selections(selections):
+    """ Sets selections on the worker model if changed. """
+    r = _service['r']
+    if selections != _service['selections']:
+        if selections is None:
+            set_selections(r)
+        else:
+            r.timeCourseSelections = selections
+        _service['selections'] = selections
+    return r
+
+
+def _service_simulate(tend, steps, dosing, changes, selections):
+    """ Simulation in the worker process.
+
+    :return: (array of simulation, columns)
+    """
+    r = _set_selections(selections)
+    s = Timecourse.from_simulation(_simulate_once(r, tend, steps, dosing, changes if changes else {}))
+    return np.asarray(s.data, dtype=float), s.columns
+
+
+def _service_f_pk(tend, steps, dosing, changes, outputs, pk_kwargs):
+    """ Pharmacokinetic parameters in the worker process.
+
+    :return: list of pk dicts with output
+    """
+    r = _set_selections(output_selections(outputs))
+    s = Timecourse.from_simulation(_simulate_once(r, tend, steps, dosing, changes if changes else {}))
+    rows = []
+    for key in outputs:
+        pk = f_pk(s["time"], s[key], compound=key, **(pk_kwargs if pk_kwargs else {}))
+        pk['output'] = key
+        rows.append(pk)
+    return rows
@@ -3,14 +3,21 @@ Simulation helpers.
 E.g. Dosing functions.
 """
 import logging
+import weakref
 import numpy as np
 import pandas as pd
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
 
-import libsbml
 import roadrunner
 from roadrunner import SelectionRecord
 
+from . import profiling
+from .pharmacokinetic import PKAccumulator
+from .result import Result
+from .cache import load_roadrunner, model_index, model_key, result_key, load_result, save_result
+
 
 # -----------------------------------------------------------------------------
 # Dosing
@@ -28,8 +35,94 @@ class Dosing(object):
         return "{} [{}] {}".format(self.dose, self.unit, self.route)
 
 
+class DosingSchedule(object):
+    """ Description of repeated dosing for simulation.
+
+    The schedule consists of Dosing given at times (in model time units),
+    e.g. oral doses every 6 hr. Infusions are described by a duration for
+    the respective (iv) dosing. The infusion dose is given as infusion_steps
+    equal boluses over the duration of the infusion.
+    """
+
+    def __init__(self, times, dosings, durations=None, infusion_steps=20):
+        if len(times) != len(dosings):
+            raise ValueError("times and dosings must have the same length.")
+        if durations is None:
+            durations = [None] * len(times)
+        if len(durations) != len(times):
+            raise ValueError("times and durations must have the same length.")
+        for t, dosing, duration in zip(times, dosings, durations):
+            if t < 0:
+                raise ValueError("Invalid dosing time: {}".format(t))
+            if duration is not None and dosing.route != "iv":
+                raise ValueError("Infusions require iv dosing: {}".format(dosing))
+
+        self.times = list(times)
+        self.dosings = list(dosings)
+        self.durations = list(durations)
+        self.infusion_steps = infusion_steps
+
+    @classmethod
+    def repeated(cls, dosing, interval, n, start=0.0, duration=None, **kwargs):
+        """ Schedule of n repeated doses with given interval. """
+        times = [start + k*interval for k in range(n)]
+        return cls(times=times, dosings=[dosing]*n, durations=[duration]*n, **kwargs)
+
+    @property
+    def per_bodyweight(self):
+        """ Boolean flag if any dose is given per bodyweight. """
+        return any(dosing.unit.endswith("kg") for dosing in self.dosings)
+
+    def events(self, bodyweight=None):
+        """ Dose events of the schedule.
+
+        :param bodyweight: bodyweight for doses per bodyweight
+        :return: list of (time, pid, dose) sorted by time, dose in [mg]
+        """
+        events = []
+        for t, dosing, duration in zip(self.times, self.dosings, self.durations):
+            pid, dose = dose_parameter(dosing, bodyweight=bodyweight)
+            if duration is None:
+                events.append((t, pid, dose))
+            else:
+                dt = 1.0 * duration / self.infusion_steps
+                for k in range(self.infusion_steps):
+                    events.append((t + k*dt, pid, dose/self.infusion_steps))
+
+        return sorted(events, key=lambda e: e[0])
+
+    def __repr__(self):
+        return "\n".join(
+            "{} {}{}".format(t, dosing, "" if duration is None else " ({} infusion)".format(duration))
+            for t, dosing, duration in zip(self.times, self.dosings, self.durations)
+        )
+
+
 def set_dosing(r, dosing, bodyweight=None, show=False):
-    """ Sets dosing for simulation. """
+    """ Sets dosing for simulation.
+
+    The model is restored to its initial state (see ModelSnapshot)
+    with the dose of the given dosing, all other doses are zero.
+    """
+    with profiling.phase("dosing"):
+        if bodyweight is None and dosing.unit.endswith("kg"):
+            bodyweight = r["BW"]
+        pid, dose = dose_parameter(dosing, bodyweight=bodyweight)
+
+    # reset the model with dose
+    with profiling.phase("reset"):
+        get_snapshot(r).restore(r, doses={pid: dose})
+    if show:
+        print_doses(r)
+
+
+def dose_parameter(dosing, bodyweight=None):
+    """ Dose parameter id and dose in [mg] for given dosing.
+
+    :param dosing: Dosing
+    :param bodyweight: bodyweight for doses per bodyweight
+    :return: tuple (pid, dose)
+    """
     if dosing.route == "oral":
         pid = "PODOSE_{}".format(dosing.substance)
     elif dosing.route == "iv":
@@ -40,59 +133,51 @@ def set_dosing(r, dosing, bodyweight=None, show=False):
     # get dose in [mg]
     dose = dosing.dose
     if dosing.unit.endswith("kg"):
-        if bodyweight is None:
-            bodyweight = r.BW
         dose = dose * bodyweight
 
-    # reset the model
-    r.reset()
-    reset_doses(r)
-    r.setValue('init({})'.format(pid), dose)  # set dose in [mg]
-    r.reset(SelectionRecord.GLOBAL_PARAMETER)
-    r.reset()
-    # r.resetAll()?
-    if show:
-        print_doses(r)
+    return pid, dose
 
 
 def get_doses_keys(r: roadrunner.ExecutableModel):
     """Get all the parameter ids for dosing information."""
-    pids = r.model.getGlobalParameterIds()
-    keys = []
-    for pid in pids:
-        if pid.startswith("PODOSE_") or pid.startswith("IVDOSE_"):
-            keys.append(pid)
-    return keys
+    return list(get_snapshot(r).dose_ids)
 
 
 def reset_doses(r):
-    """ Sets all doses to zero. """
-    for key in get_doses_keys(r):
-        r.setValue('init({})'.format(key), 0)  # [mg]
-    r.reset(SelectionRecord.GLOBAL_PARAMETER)
-    r.reset()
+    """ Sets all doses to zero.
+
+    The model is restored to its initial state (see ModelSnapshot).
+    """
+    get_snapshot(r).restore(r)
 
 
 def print_doses(r, name=None):
     """ Prints the complete dose information of the model. """
     if name:
         print('***', name, '***')
-    for key in get_doses_keys():
+    for key in get_doses_keys(r):
         print('{}\t{}'.format(key, r.getValue(key)))
 
 
 # -----------------------------------------------------------------------------
 # Model loading
 # -----------------------------------------------------------------------------
-def load_model(model_path, timeCourseSelections=True):
+def load_model(model_path, timeCourseSelections=True, cache=True):
     """ Loads model and sets selections.
 
+    Compiled models are cached in process and on disk (see cache module),
+    so repeated loading of the same model does not recompile the SBML.
+
     :param model_path:
     :param set_selections boolean flag if timeCourseSelections are set on model.
+    :param cache: boolean flag if the model cache is used
     :return:
     """
-    logging.info('Model:', model_path)
-    r = roadrunner.RoadRunner(model_path)
+    logging.info('Model: {}'.format(model_path))
+    if cache:
+        r = load_roadrunner(model_path)
+    else:
+        r = roadrunner.RoadRunner(model_path)
     if timeCourseSelections:
         set_selections(r)
     return r
@@ -132,95 +217,926 @@ def set_selections(r: roadrunner.ExecutableModel, time=True,
 
     r.timeCourseSelections = selections
 
+# -----------------------------------------------------------------------------
+# Model state
+# -----------------------------------------------------------------------------
+class ModelSnapshot(object):
+    """ Initial state of a model.
+
+    Captures the initial values of all global parameters which are not
+    defined by assignment rules once per model instance, the dose
+    parameters are precomputed. The initial state with given doses
+    is restored with a single call to restore, i.e. setting the parameters
+    and one reset of time, rates and species which evaluates the initial
+    assignments (e.g. dose parameters -> dose amounts).
+
+    Changing the init(X) values of the model after the snapshot was
+    taken is not reflected in the snapshot.
+    """
+
+    def __init__(self, r):
+        pids = r.model.getGlobalParameterIds()
+        assigned = set(r.getAssignmentRuleIds())
+
+        self.parameter_ids = [pid for pid in pids if pid not in assigned]
+        self.parameter_indices = np.array(
+            [k for k, pid in enumerate(pids) if pid not in assigned], dtype=np.int32
+        )
+        self.parameter_values = np.array(
+            [r.getValue('init({})'.format(pid)) for pid in self.parameter_ids], dtype=float
+        )
+        self._positions = {pid: k for k, pid in enumerate(self.parameter_ids)}
+
+        # dose parameters are zero in the initial state
+        self.dose_ids = [pid for pid in self.parameter_ids
+                         if pid.startswith("PODOSE_") or pid.startswith("IVDOSE_")]
+        for pid in self.dose_ids:
+            self.parameter_values[self._positions[pid]] = 0.0
+        self._dose_targets = None
+
+    def dose_targets(self, r):
+        """ Variables which are initialized with the dose parameters.
+
+        The dose parameters are only evaluated in the initial assignments,
+        doses during a simulation are added to the respective variables,
+        e.g. PODOSE_apap -> D_apap.
+
+        :return: dict {dose pid: variable id}
+        """
+        if self._dose_targets is None:
+            index = model_index(r.getSBML())
+            self._dose_targets = {
+                pid: target for pid, target in zip(index.ids[index.dose], index.dose_targets[index.dose])
+                if target
+            }
+        return self._dose_targets
+
+    def initial_value(self, pid):
+        """ Initial value of the parameter. """
+        return self.parameter_values[self._positions[pid]]
+
+    def restore(self, r, doses=None):
+        """ Restores the initial state of the model with the given doses.
+
+        :param r: roadrunner model the snapshot was taken from
+        :param doses: dict {pid: dose} of dose parameters, all other doses are zero
+        """
+        values = self.parameter_values
+        if doses:
+            values = values.copy()
+            for pid, dose in doses.items():
+                if pid not in self._positions:
+                    raise ValueError("Dose parameter does not exist in model: {}".format(pid))
+                values[self._positions[pid]] = dose
+        r.model.setGlobalParameterValues(self.parameter_indices, values)
+        r.reset(SelectionRecord.TIME | SelectionRecord.RATE | SelectionRecord.FLOATING)
+
+
+# snapshots of the model instances
+_snapshots = weakref.WeakKeyDictionary()
+
+
+def get_snapshot(r):
+    """ Snapshot of the initial state of the model (created on first use). """
+    snapshot = _snapshots.get(r)
+    if snapshot is None:
+        snapshot = ModelSnapshot(r)
+        _snapshots[r] = snapshot
+    return snapshot
+
+
 # -----------------------------------------------------------------------------
 # Simulation
 # -----------------------------------------------------------------------------
-Result = namedtuple("Result", ['base', 'mean', 'std', 'min', 'max'])
+class Timecourse(object):
+    """ Simulation result as NumPy array with column names.
+
+    The data is a view on the simulation result without copying,
+    the DataFrame is only created on first access of frame.
+    Columns are accessed via s[column] as NumPy arrays.
+    """
+
+    def __init__(self, data, columns):
+        self.data = np.asarray(data)
+        self.columns = list(columns)
+        self._index = {c: k for k, c in enumerate(self.columns)}
+        self._frame = None
+
+    @classmethod
+    def from_simulation(cls, s):
+        """ Timecourse from NamedArray or DataFrame of a simulation. """
+        if isinstance(s, pd.DataFrame):
+            return cls(s.values, s.columns)
+        return cls(s, s.colnames)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def frame(self):
+        """ DataFrame of the timecourse (created on first access). """
+        if self._frame is None:
+            self._frame = pd.DataFrame(self.data, columns=self.columns, copy=False)
+        return self._frame
+
+    def __getitem__(self, key):
+        return self.data[:, self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __repr__(self):
+        return "Timecourse{} {}".format(self.shape, self.columns)
+
+
+def output_selections(outputs, yfun=None, r=None):
+    """ Minimal selections for the given outputs.
+
+    The selections consist of time, the outputs and the columns
+    which are read by yfun. Outputs created by yfun are not selected.
+
+    If the columns read by yfun cannot be determined (yfun uses DataFrame
+    specific functionality, e.g. s.loc or s.shape, or reads columns which
+    are not model variables of r) None is returned, i.e. all variables are selected.
+
+    :param outputs: list of required outputs
+    :param yfun: conversion function applied on the simulation DataFrame
+    :param r: roadrunner model, the columns read by yfun are checked against its ids
+    :return: list of selections or None
+    """
+    created = set()
+    selections = ["time"]
+    if yfun is not None:
+        ids = _model_ids(r) if r is not None else None
+        recorder = _ColumnRecorder(ids=ids)
+        try:
+            yfun(recorder)
+        except Exception as err:
+            logging.warning("Columns read by yfun could not be determined, "
+                            "all variables are selected: {}".format(err))
+            return None
+        if ids is not None:
+            invalid = [key for key in recorder.read if key not in ids]
+            if invalid:
+                logging.warning("yfun reads columns which are not model variables {}, "
+                                "all variables are selected.".format(invalid))
+                return None
+        selections.extend(recorder.read)
+        created = set(recorder.keys())
+    for key in outputs:
+        if key not in created:
+            selections.append(key)
+
+    # unique in order
+    return list(OrderedDict.fromkeys(selections))
+
+
+def _model_ids(r):
+    """ Ids of the model variables which can be selected. """
+    model = r.model
+    ids = set(["time"])
+    for key in model.getFloatingSpeciesIds() + model.getBoundarySpeciesIds():
+        ids.update([key, "[{}]".format(key)])
+    ids.update(model.getGlobalParameterIds())
+    ids.update(model.getCompartmentIds())
+    ids.update(model.getReactionIds())
+    return ids
+
+
+class _ColumnRecorder(dict):
+    """ Records the columns which are read from a simulation result.
+
+    Stand-in for the simulation DataFrame passed to yfun. Columns which
+    are read before they are written are recorded as model outputs.
+    Attribute access is only recorded for model ids (or without ids for
+    names which are not DataFrame attributes), all other attributes raise
+    AttributeError, so the columns are not inferred.
+    """
+
+    def __init__(self, ids=None):
+        super(_ColumnRecorder, self).__init__()
+        self.ids = ids
+        self.read = []
+
+    def __getitem__(self, key):
+        if key not in self:
+            self.read.append(key)
+            return np.ones(2)
+        return dict.__getitem__(self, key)
+
+    def __getattr__(self, key):
+        if key.startswith("_") or key in ("ids", "read"):
+            raise AttributeError(key)
+        if key in self:
+            return dict.__getitem__(self, key)
+        if self.ids is not None:
+            if key not in self.ids:
+                raise AttributeError(key)
+        elif hasattr(pd.DataFrame, key):
+            raise AttributeError(key)
+        return self[key]
 
 
 def simulate(r, tend, steps, dosing, changes={}, parameters=None,
-             sensitivity=0.1, selections=None, yfun=None):
+             sensitivity=0.1, selections=None, yfun=None, n_workers=None,
+             streaming=False, out_path=None, outputs=None, as_frame=True,
+             cache=False, adaptive=False, samples=False, profiler=None):
     """ Performs model simulation simulation with option on fallback.
 
     Does not support changes to the model yet.
-    """
-    # set selections
-    if selections == None:
-        set_selections(r)
-    else:
-        r.timeCourseSelections = selections
 
-    if changes is None:
-        changes = {}
+    The dosing is either a single Dosing at time zero or a DosingSchedule
+    with multiple doses, which is simulated in segments between the doses.
 
-    # reset all
-    resetAll(r)
-    reset_doses(r)
+    If parameters are provided every parameter is changed by +/- sensitivity
+    and the model is simulated for every change. These 2*Np simulations can be
+    distributed over a process pool by setting n_workers. Every worker loads its
+    own copy of the model once and only receives the (pid, factor) work items.
+    The result is identical to the serial execution. A given yfun must be
+    picklable (i.e. a module level function) when used with n_workers.
 
-    # dosing
-    if dosing is not None:
-        # get bodyweight
-        if "BW" in changes:
-            bodyweight = changes["BW"]
+    The result of the parameter changes is a Result with the baseline and
+    the mean, std, min and max in a single (5, Nt, Ns) array. By default all
+    simulations of the parameter changes are stored in a (2*Np, Nt, Ns) array
+    for the statistics; with samples this array is kept in the Result for
+    quantile bands (see Result.quantile). With streaming the mean, std, min and max are
+    accumulated incrementally instead, so the memory does not depend on the
+    number of parameters. If an out_path is given the simulations are in addition
+    written to a memory-mapped .npy file of shape (2*Np, Nt, Ns), i.e. one
+    contiguous chunk per simulation.
+
+    See simulate_sensitivities for the derivatives dS/dp and linearized
+    bands with a single simulation per parameter.
+
+    :param n_workers: number of worker processes for the parameter changes,
+        None or 1 runs the changes serially on r.
+    :param streaming: boolean flag to accumulate the statistics incrementally
+    :param out_path: path of .npy file for the simulations of the parameter changes
+        (implies streaming)
+    :param outputs: list of required outputs. Only the outputs and the
+        columns read by yfun are selected (see output_selections), instead of
+        all model variables. Ignored if selections are given.
+    :param as_frame: boolean flag to return a DataFrame. Otherwise a Timecourse
+        with a view on the simulation data is returned (without parameters).
+    :param cache: boolean flag to memoize the result in the result cache
+        (see cache.load_result). The key contains the model, dosing, changes,
+        time grid, selections, yfun, parameters with sensitivity and the
+        integrator settings. yfun is keyed by its code, defaults, closure and
+        the values of the module globals it references, but not by the code
+        of other functions it calls: clear the result cache after changing
+        such helper functions. Not used with out_path.
+    :param adaptive: boolean flag for adaptive output. The baseline is
+        simulated with the variable steps of the integrator, i.e. dense output
+        where the model changes fast (e.g. absorption and peak after oral doses)
+        and sparse output in the elimination phase. The output interval is
+        bounded by tend/steps. The parameter changes are simulated on the time
+        grid of the baseline. Requires "time" in the selections.
+        For the APAP model (2 g oral single or repeated dose, 24 hr, steps=100)
+        AUC and Cmax differ by less than 1E-4 (relative) from a dense uniform
+        grid with 20000 steps, with about 2 % of the output points
+        (see test_simulate_adaptive). Use f_pk(..., weighted=True) for the
+        terminal regression on the adaptive output.
+    :param samples: boolean flag to keep the simulations of the parameter
+        changes in the Result (Result.samples), required for quantiles.
+        With out_path the samples are memory-mapped from the file, with
+        streaming only they are not available.
+    :param profiler: profiling.Profiler which records the time of the
+        simulation phases (reset, dosing, changes, integrate, frame, yfun, ...)
+        per run. Profilers can also be activated for all simulations in a
+        context (see profiling.profile) or via the environment.
+    """
+    with profiling.activate(profiler):
+        # set selections
+        if selections is None and outputs is not None:
+            selections = output_selections(outputs, yfun=yfun, r=r)
+        if selections == None:
+            set_selections(r)
         else:
-            bodyweight = r.BW
+            r.timeCourseSelections = selections
+
+        if changes is None:
+            changes = {}
 
-        set_dosing(r, dosing, bodyweight=bodyweight)
+        key = None
+        if cache and not out_path:
+            with profiling.phase("cache"):
+                key = result_key(
+                    _model_hash(r), tend, steps, dosing, changes, list(r.timeCourseSelections), yfun,
+                    parameters, sensitivity if parameters is not None else None,
+                    _integrator_settings(r), as_frame, adaptive, samples,
+                )
+                arrays = load_result(key)
+            if arrays is not None:
+                return _result_from_arrays(arrays, as_frame=as_frame)
 
-    # general changes
-    for key, value in changes.items():
-        r[key] = value
-    s = r.simulate(start=0, end=tend, steps=steps)
-    s_base = pd.DataFrame(s, columns=s.colnames)
+        result = _simulate(r, tend, steps, dosing, changes, parameters=parameters,
+                           sensitivity=sensitivity, yfun=yfun, n_workers=n_workers,
+                           streaming=streaming, out_path=out_path, as_frame=as_frame,
+                           adaptive=adaptive, samples=samples)
+        if key is not None:
+            with profiling.phase("cache"):
+                save_result(key, _result_to_arrays(result))
+        return result
 
-    if yfun:
-        # conversion functio
-        yfun(s_base)
 
+def _simulate(r, tend, steps, dosing, changes, parameters=None, sensitivity=0.1, yfun=None,
+              n_workers=None, streaming=False, out_path=None, as_frame=True, adaptive=False,
+              samples=False):
+    """ Simulation with parameter changes on the current selections, see simulate. """
+    if adaptive and "time" not in r.timeCourseSelections:
+        raise ValueError("Adaptive output requires 'time' in the selections.")
+    s = _simulate_once(r, tend, steps, dosing, changes, yfun=yfun, adaptive=adaptive)
     if parameters is None:
-        return s_base
+        if as_frame:
+            return _as_frame(s)
+        return Timecourse.from_simulation(s)
     else:
+        s_base = _as_frame(s)
         # baseline
         Np = 2 * len(parameters)
         (Nt, Ns) = s_base.shape
-        shape = (Nt, Ns, Np)
-
-        # empty array for storage
-        s_data = np.empty(shape) * np.nan
+        # parameter changes on time grid of adaptive baseline
+        times = s_base["time"].values if adaptive else None
 
         # all parameter changes
-        idx = 0
-        for pid in parameters.keys():
-            for change in [1.0 + sensitivity, 1.0 - sensitivity]:
-                resetAll(r)
-                reset_doses(r)
-                # dosing
-                if dosing:
-                    set_dosing(r, dosing, bodyweight=bodyweight)
-                # general changes
-                for key, value in changes.items():
-                    r[key] = value
-                # parameter changes
-                value = r[pid]
-                new_value = value * change
-                r[pid] = new_value
+        items = [(pid, change) for pid in parameters.keys()
+                 for change in [1.0 + sensitivity, 1.0 - sensitivity]]
+
+        runs = _parameter_runs(r, tend, steps, dosing, changes, items, yfun=yfun,
+                               n_workers=n_workers, times=times)
+
+        # base and statistics in one array
+        result = np.empty((len(Result._fields), Nt, Ns))
+        result[0] = s_base.values
+        s_data = None
+        with closing(runs):
+            if streaming or out_path:
+                stats = RunningStats(shape=(Nt, Ns))
+                if out_path:
+                    s_data = np.lib.format.open_memmap(out_path, mode="w+", dtype=float,
+                                                       shape=(Np, Nt, Ns))
+                for idx, s in enumerate(runs):
+                    s = np.asarray(s, dtype=float)
+                    with profiling.phase("statistics"):
+                        stats.update(s)
+                    if s_data is not None:
+                        s_data[idx, :, :] = s
+                if s_data is not None:
+                    s_data.flush()
+                    del s_data
+                    s_data = np.load(out_path, mmap_mode="r") if samples else None
+                result[1:] = (stats.mean, stats.std, stats.min, stats.max)
+
+            else:
+                # one contiguous chunk per simulation
+                s_data = np.full((Np, Nt, Ns), np.nan)
+                for idx, s in enumerate(runs):
+                    s_data[idx, :, :] = s
+                with profiling.phase("statistics"):
+                    _statistics(s_data, out=result[1:])
+                if not samples:
+                    s_data = None
+
+        return Result(data=result, columns=s_base.columns, samples=s_data)
+
+
+def _parameter_runs(r, tend, steps, dosing, changes, items, yfun=None, n_workers=None, times=None):
+    """ Simulations of the parameter changes (pid, factor) in order of the items.
+
+    With n_workers the items are distributed over a process pool, every
+    worker loads its own copy of the model once (see _init_worker).
+
+    :return: generator of simulations
+    """
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(r.getSBML(), r.timeCourseSelections, {
+                'tend': tend, 'steps': steps, 'dosing': dosing,
+                'changes': changes, 'yfun': yfun, 'times': times,
+            }, _integrator_settings(r))
+        ) as executor:
+            chunksize = max(1, len(items) // (4 * n_workers))
+            profiler = profiling.active()
+            if profiler is None:
+                for s in executor.map(_simulate_item, items, chunksize=chunksize):
+                    yield s
+            else:
+                # records of the workers are added to the active profiler
+                for s, records in executor.map(_simulate_item_profiled, items, chunksize=chunksize):
+                    profiler.add(records)
+                    yield s
+    else:
+        for (pid, factor) in items:
+            yield _simulate_once(r, tend, steps, dosing, changes, yfun=yfun, pid=pid, factor=factor,
+                                 times=times)
+
+
+def _statistics(s_data, out):
+    """ Mean, std, min and max over the simulations (first axis).
+
+    The statistics are written to out (4, Nt, Ns), the standard deviation is
+    accumulated per simulation, so no temporary arrays of the size of s_data
+    are created.
+    """
+    (s_mean, s_std, s_min, s_max) = out
+    np.mean(s_data, axis=0, out=s_mean)
+    np.min(s_data, axis=0, out=s_min)
+    np.max(s_data, axis=0, out=s_max)
+    s_std[...] = 0.0
+    delta = np.empty_like(s_mean)
+    for s in s_data:
+        np.subtract(s, s_mean, out=delta)
+        np.multiply(delta, delta, out=delta)
+        s_std += delta
+    s_std /= s_data.shape[0]
+    np.sqrt(s_std, out=s_std)
+
+
+# -----------------------------------------------------------------------------
+# Local sensitivities
+# -----------------------------------------------------------------------------
+# Local sensitivities of the timecourses
+#   result: Result with the linearized bands for the parameter changes
+#   dsdp: (Nt, Ns, Np) array of the derivatives dS/dp
+#   parameters: parameter ids in order of the last axis of dsdp
+#   values: parameter values at which the derivatives are evaluated
+Sensitivities = namedtuple("Sensitivities", ['result', 'dsdp', 'parameters', 'values'])
+
 
+def simulate_sensitivities(r, tend, steps, dosing, parameters, changes=None, sensitivity=0.1,
+                           step=1E-4, selections=None, outputs=None, yfun=None, n_workers=None,
+                           adaptive=False):
+    """ Local sensitivities dS/dp of the timecourses with linearized bands.
+
+    The derivatives are calculated with forward differences, i.e. one
+    simulation per parameter with the parameter scaled by (1 + step),
+    instead of the two simulations per parameter of simulate. The bands for
+    parameter changes of +/- sensitivity are the linearization of the
+    simulate result: for the changes D_p = dS/dp * p * sensitivity the
+    mean is the baseline, std = sqrt(mean(D_p^2)) and
+    min/max = baseline -/+ max(|D_p|).
+
+    The derivatives are calculated with differences instead of the forward
+    sensitivity solver of roadrunner (timeSeriesSensitivities): in roadrunner
+    2.10 the solver is more than ten times slower than the difference runs for
+    the whole-body models and does not propagate parameters into initial
+    assignments (e.g. the cardiac output).
+
+    :param parameters: dict of parameters {pid: value} (see parameters_for_sensitivity),
+        the derivatives are calculated at the current values of the model.
+    :param sensitivity: relative parameter change of the linearized bands
+    :param step: relative step of the forward differences
+    :param n_workers: number of worker processes for the parameter runs
+    :param adaptive: boolean flag for adaptive output (see simulate)
+    :return: Sensitivities
+    """
+    if selections is None and outputs is not None:
+        selections = output_selections(outputs, yfun=yfun, r=r)
+    if selections is None:
+        set_selections(r)
+    else:
+        r.timeCourseSelections = selections
+    if changes is None:
+        changes = {}
+    if adaptive and "time" not in r.timeCourseSelections:
+        raise ValueError("Adaptive output requires 'time' in the selections.")
+
+    s_base = _as_frame(_simulate_once(r, tend, steps, dosing, changes, yfun=yfun, adaptive=adaptive))
+    base = np.asarray(s_base.values, dtype=float)
+    times = s_base["time"].values if adaptive else None
+    pids = list(parameters.keys())
+    # parameter values with changes (constant parameters are not changed by the simulation)
+    values = np.array([r[pid] for pid in pids], dtype=float)
+
+    (Nt, Ns) = base.shape
+    dsdp = np.empty((Nt, Ns, len(pids)))
+    runs = _parameter_runs(r, tend, steps, dosing, changes, [(pid, 1.0 + step) for pid in pids],
+                           yfun=yfun, n_workers=n_workers, times=times)
+    with closing(runs):
+        for k, s in enumerate(runs):
+            dsdp[:, :, k] = (np.asarray(s, dtype=float) - base) / (step * values[k])
+
+    return Sensitivities(result=linearized_result(base, s_base.columns, dsdp, values, sensitivity),
+                         dsdp=dsdp, parameters=pids, values=values)
+
+
+def linearized_result(base, columns, dsdp, values, sensitivity=0.1):
+    """ Result of the parameter changes +/- sensitivity from the linearization.
+
+    :param base: (Nt, Ns) array of the baseline
+    :param columns: columns of the timecourses
+    :param dsdp: (Nt, Ns, Np) array of the derivatives
+    :param values: parameter values
+    :param sensitivity: relative parameter change
+    :return: Result
+    """
+    result = np.empty((len(Result._fields), ) + base.shape)
+    (s_base, s_mean, s_std, s_min, s_max) = result
+    s_base[...] = base
+    s_mean[...] = base
+    if dsdp.shape[2] == 0:
+        s_std[...] = 0.0
+        s_min[...] = base
+        s_max[...] = base
+    else:
+        delta = np.abs(dsdp * (np.asarray(values, dtype=float) * sensitivity))
+        np.sqrt(np.mean(delta * delta, axis=2), out=s_std)
+        np.max(delta, axis=2, out=s_max)
+        np.subtract(base, s_max, out=s_min)
+        s_max += base
+    return Result(data=result, columns=columns)
+
+
+# hashes of the models {r: SBML hash}
+_model_hashes = weakref.WeakKeyDictionary()
+
+
+def _model_hash(r):
+    """ Hash of the SBML of the model. """
+    key = _model_hashes.get(r)
+    if key is None:
+        key = model_key(r.getSBML())
+        _model_hashes[r] = key
+    return key
+
+
+def _integrator_settings(r):
+    """ Name and settings of the integrator. """
+    integrator = r.integrator
+    return [integrator.getName(), {k: integrator.getValue(k) for k in integrator.getSettings()}]
+
+
+def _set_integrator_settings(r, settings):
+    """ Sets integrator and settings (see _integrator_settings). """
+    name, values = settings
+    if r.integrator.getName() != name:
+        r.setIntegrator(name)
+    for key, value in values.items():
+        r.integrator.setValue(key, value)
+
+
+def _result_to_arrays(result):
+    """ Arrays of simulation result for the result cache. """
+    if isinstance(result, Result):
+        arrays = result.to_arrays()
+    elif isinstance(result, Timecourse):
+        arrays = {'base': result.data, 'columns': np.array(result.columns, dtype=str)}
+    else:
+        arrays = {'base': result.values, 'columns': np.array(result.columns, dtype=str)}
+    return arrays
+
+
+def _result_from_arrays(arrays, as_frame=True):
+    """ Simulation result from arrays of the result cache. """
+    columns = list(arrays['columns'])
+    if 'data' in arrays:
+        return Result.from_arrays(arrays)
+    if as_frame:
+        return pd.DataFrame(arrays['base'], columns=columns, copy=False)
+    return Timecourse(arrays['base'], columns)
+
+
+class RunningStats(object):
+    """ Incremental mean, std, min and max of arrays.
+
+    The mean and variance are updated with the Welford algorithm, so only
+    arrays of the shape of a single simulation are stored.
+    """
+
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, x):
+        """ Adds array x to the statistics. """
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        np.minimum(self.min, x, out=self.min)
+        np.maximum(self.max, x, out=self.max)
+
+    @property
+    def std(self):
+        """ Standard deviation (population, like np.std). """
+        return np.sqrt(self.m2 / self.n)
+
+
+def _simulate_once(r, tend, steps, dosing, changes, yfun=None, pid=None, factor=None,
+                   times=None, adaptive=False):
+    """ Single simulation from the initial state of the model.
+
+    The model is reset, dosing and changes are applied and the
+    parameter pid is (optionally) scaled by factor.
+
+    The output is on the uniform grid of steps, on the given times or
+    with adaptive on the variable steps of the integrator (see simulate).
+
+    :return: NamedArray of the simulation, or DataFrame if yfun is given
+    """
+    with profiling.phase("run", pid=pid, factor=factor):
+        events = _initial_state(r, tend, dosing, changes, pid=pid, factor=factor)
+        if events:
+            targets = get_snapshot(r).dose_targets(r)
+
+        with profiling.phase("integrate") as integrate:
+            if adaptive and events:
+                # the variable steps overshoot the dose times, so the adaptive
+                # simulation only provides the time grid of the segmented simulation
+                times = _simulate_adaptive(r, tend, max_step=1.0*tend/steps, events=events,
+                                           targets=targets)["time"].values
+                _initial_state(r, tend, dosing, changes, pid=pid, factor=factor)
+                s = _simulate_events(r, times, events, targets=targets)
+            elif adaptive:
+                s = _simulate_adaptive(r, tend, max_step=1.0*tend/steps)
+            elif events:
+                if times is None:
+                    times = np.linspace(0, tend, num=steps+1)
+                s = _simulate_events(r, times, events, targets=targets)
+            elif times is not None:
+                s = r.simulate(times=times)
+            else:
                 s = r.simulate(start=0, end=tend, steps=steps)
-                if yfun:
-                    # conversion function
-                    s = pd.DataFrame(s, columns=s.colnames)
-                    yfun(s)
-                    s_data[:, :, idx] = s
-                else:
-                    s_data[:, :, idx] = s
+            integrate.set(points=len(s), segments=1 + len(set(e[0] for e in events)) if events else 1)
+        if yfun:
+            # conversion function
+            s = _as_frame(s)
+            with profiling.phase("yfun"):
+                yfun(s)
+        return s
+
+
+def _initial_state(r, tend, dosing, changes, pid=None, factor=None):
+    """ Resets the model to the initial state with dosing and changes.
+
+    Doses at time zero are set via the initial state, the remaining
+    doses of a DosingSchedule are returned as events.
+
+    :return: list of dose events (time, pid, dose) with 0 < time < tend, or None
+    """
+    snapshot = get_snapshot(r)
+
+    # dosing
+    doses = None
+    events = None
+    if dosing is not None:
+        with profiling.phase("dosing"):
+            # get bodyweight
+            schedule = isinstance(dosing, DosingSchedule)
+            if "BW" in changes:
+                bodyweight = changes["BW"]
+            elif (schedule and dosing.per_bodyweight) or (not schedule and dosing.unit.endswith("kg")):
+                bodyweight = snapshot.initial_value("BW")
+            else:
+                bodyweight = None
+
+            if schedule:
+                # doses at time 0 are set via the initial state
+                events = [e for e in dosing.events(bodyweight=bodyweight) if 0 < e[0] < tend]
+                doses = {}
+                for t, pid_dose, dose in dosing.events(bodyweight=bodyweight):
+                    if t == 0:
+                        doses[pid_dose] = doses.get(pid_dose, 0.0) + dose
+            else:
+                pid_dose, dose = dose_parameter(dosing, bodyweight=bodyweight)
+                doses = {pid_dose: dose}
+
+    # reset all with dosing
+    with profiling.phase("reset"):
+        snapshot.restore(r, doses=doses)
+
+    with profiling.phase("changes"):
+        # general changes
+        for key, value in changes.items():
+            r[key] = value
+
+        # parameter changes
+        if pid is not None:
+            r[pid] = r[pid] * factor
+
+    return events
+
+
+def _simulate_events(r, times, events, targets):
+    """ Segmented simulation with dose events during the simulation.
+
+    The simulation is integrated between the dose events without resetting
+    the model; at every event the dose is added to the target variable of the
+    dose parameter. The segments are written in one preallocated array on the
+    output times, e.g. the time grid of r.simulate(start=0, end=tend, steps=steps).
+    Output at the time of a dose event contains the dose.
+
+    :param times: output times from 0 to tend
+    :param events: list of (time, pid, dose) sorted by time with 0 < time < tend
+    :param targets: dict of dose pid to target variable id
+    :return: DataFrame
+    """
+    tend = times[-1]
+    columns = list(r.timeCourseSelections)
+    data = np.empty((times.size, len(columns)))
+
+    boundaries = [0.0] + sorted(set(e[0] for e in events)) + [tend]
+    k_start = 0
+    idx = 0
+    for ka in range(len(boundaries)-1):
+        ta, tb = boundaries[ka], boundaries[ka+1]
+
+        # dose events at start of segment
+        while idx < len(events) and events[idx][0] == ta:
+            (_, pid, dose) = events[idx]
+            target = targets[pid]
+            r[target] = r[target] + dose
+            idx += 1
+
+        # output times in [ta, tb), the last segment includes tend
+        last = (ka == len(boundaries) - 2)
+        k_end = np.searchsorted(times, tb, side="right" if last else "left")
+        t_out = times[k_start:k_end]
+        t_sim = np.unique(np.concatenate([[ta], t_out, [tb]]))
+
+        s = r.simulate(times=t_sim)
+        data[k_start:k_end, :] = s[np.searchsorted(t_sim, t_out), :]
+        k_start = k_end
+
+    return pd.DataFrame(data, columns=columns, copy=False)
+
+
+def _simulate_adaptive(r, tend, max_step, events=None, targets=None):
+    """ Simulation with output at the variable steps of the integrator.
+
+    Dose events are handled like in _simulate_events. The integrator steps
+    beyond the end of a segment (the output is interpolated), so the doses
+    are given up to one step late. With events the result is only used as
+    time grid for _simulate_events.
+
+    :param max_step: maximal step size of the integrator (output interval)
+    :param events: list of (time, pid, dose) sorted by time with 0 < time < tend
+    :param targets: dict of dose pid to target variable id
+    :return: DataFrame
+    """
+    integrator = r.integrator
+    settings = {key: integrator.getValue(key) for key in ["variable_step_size", "maximum_time_step"]}
+    integrator.setValue("variable_step_size", True)
+    integrator.setValue("maximum_time_step", max_step)
+    try:
+        if not events:
+            events = []
+        boundaries = [0.0] + sorted(set(e[0] for e in events)) + [tend]
+        segments = []
+        idx = 0
+        for ka in range(len(boundaries)-1):
+            ta, tb = boundaries[ka], boundaries[ka+1]
+            while idx < len(events) and events[idx][0] == ta:
+                (_, pid, dose) = events[idx]
+                target = targets[pid]
+                r[target] = r[target] + dose
                 idx += 1
 
-        s_mean = pd.DataFrame(np.mean(s_data, axis=2), columns=s_base.columns)
-        s_std = pd.DataFrame(np.std(s_data, axis=2), columns=s_base.columns)
-        s_min = pd.DataFrame(np.min(s_data, axis=2), columns=s_base.columns)
-        s_max = pd.DataFrame(np.max(s_data, axis=2), columns=s_base.columns)
+            s = np.asarray(r.simulate(ta, tb))
+            # end of segment is replaced by the start of the next segment
+            segments.append(s if ka == len(boundaries) - 2 else s[:-1])
+    finally:
+        for key, value in settings.items():
+            integrator.setValue(key, value)
+
+    return pd.DataFrame(np.vstack(segments), columns=list(r.timeCourseSelections), copy=False)
+
+
+def iter_timecourse(r, tend, steps, dosing, changes=None, chunksize=1000):
+    """ Simulation in chunks of output points.
+
+    The model is integrated continuously (like simulate on the current
+    selections), but only chunks of at most chunksize time points are
+    returned, so the complete time course is never stored.
+
+    :param r: roadrunner model
+    :param tend: end time of simulation
+    :param steps: steps of simulation
+    :param dosing: Dosing or DosingSchedule
+    :param changes: dict of changes
+    :param chunksize: maximal number of time points per chunk
+    :return: generator of Timecourse chunks
+    """
+    chunksize = max(2, chunksize)
+    events = _initial_state(r, tend, dosing, changes if changes else {})
+    if not events:
+        events = []
+    else:
+        targets = get_snapshot(r).dose_targets(r)
+
+    times = np.linspace(0, tend, num=steps+1)
+    columns = list(r.timeCourseSelections)
+    boundaries = [0.0] + sorted(set(e[0] for e in events)) + [tend]
+    k_start = 0
+    idx = 0
+    for ka in range(len(boundaries)-1):
+        ta, tb = boundaries[ka], boundaries[ka+1]
+
+        # dose events at start of segment
+        while idx < len(events) and events[idx][0] == ta:
+            (_, pid, dose) = events[idx]
+            target = targets[pid]
+            r[target] = r[target] + dose
+            idx += 1
+
+        # output times in [ta, tb), the last segment includes tend
+        last = (ka == len(boundaries) - 2)
+        k_end = np.searchsorted(times, tb, side="right" if last else "left")
+        t_start = ta
+        if k_start == k_end:
+            r.simulate(times=[ta, tb])
+        for k in range(k_start, k_end, chunksize):
+            t_out = times[k:min(k + chunksize, k_end)]
+            # the last chunk of the segment is integrated to the segment end
+            t_end = [tb] if k + chunksize >= k_end else []
+            t_sim = np.unique(np.concatenate([[t_start], t_out, t_end]))
+            with profiling.phase("integrate", points=t_sim.size):
+                s = r.simulate(times=t_sim)
+            yield Timecourse(np.asarray(s)[np.searchsorted(t_sim, t_out), :], columns)
+            t_start = t_sim[-1]
+        k_start = k_end
 
-        return Result(base=s_base, mean=s_mean, std=s_std, min=s_min, max=s_max)
+
+def simulate_pk(r, tend, steps, dosing, outputs, changes=None, pk_kwargs=None, chunksize=1000):
+    """ Pharmacokinetic parameters of the outputs without storing the time courses.
+
+    The simulation chunks (see iter_timecourse) are reduced with a
+    PKAccumulator per output. The selections are set to the outputs.
+
+    :param outputs: list of columns for pharmacokinetic analysis
+    :param pk_kwargs: dict of keyword arguments for f_pk, e.g. dose and units
+    :return: dict {output: pk dict}
+    """
+    selections = output_selections(outputs)
+    if list(r.timeCourseSelections) != selections:
+        r.timeCourseSelections = selections
+    if pk_kwargs is None:
+        pk_kwargs = {}
+
+    accumulators = OrderedDict((key, PKAccumulator(compound=key, **pk_kwargs)) for key in outputs)
+    for chunk in iter_timecourse(r, tend, steps, dosing, changes=changes, chunksize=chunksize):
+        time = chunk["time"]
+        for key, accumulator in accumulators.items():
+            accumulator.update(time, chunk[key])
+    return OrderedDict((key, accumulator.result()) for key, accumulator in accumulators.items())
+
+
+def _as_frame(s):
+    """ DataFrame of simulation result. """
+    if isinstance(s, pd.DataFrame):
+        return s
+    with profiling.phase("frame"):
+        return pd.DataFrame(s, columns=s.colnames)
+
+
+# state of the worker processes (model and simulation settings)
+_worker = {}
+
+
+def _init_worker(sbml, selections, settings, integrator=None):
+    """ Initializes worker process by loading the model once.
+
+    :param sbml: SBML of the model
+    :param selections: timecourse selections
+    :param settings: dict of simulation settings used by the work items
+    :param integrator: integrator name and settings of the parent model
+        (see _integrator_settings), so workers integrate like the serial run
+    """
+    r = load_roadrunner(sbml)
+    r.timeCourseSelections = selections
+    if integrator is not None:
+        _set_integrator_settings(r, integrator)
+    _worker.clear()
+    _worker.update(settings)
+    _worker['r'] = r
+
+
+def _simulate_item(item):
+    """ Simulates a single (pid, factor) work item in the worker process. """
+    pid, factor = item
+    s = _simulate_once(_worker['r'], _worker['tend'], _worker['steps'], _worker['dosing'],
+                       _worker['changes'], yfun=_worker['yfun'], pid=pid, factor=factor,
+                       times=_worker.get('times'))
+    return np.asarray(s, dtype=float)
+
+
+def _simulate_item_profiled(item):
+    """ Simulates a single (pid, factor) work item with profiling in the worker process.
+
+    :return: (simulation, profiling records)
+    """
+    with profiling.profile() as profiler:
+        s = _simulate_item(item)
+    return s, profiler.records
 
 
 def resetAll(r):
@@ -243,37 +1159,29 @@ def parameters_for_sensitivity(r, model_path):
     - parameters with value=0 (no effect on model, dummy parameter)
     - parameters which are physical constants, e.g., molecular weights
 
+    The parameters are looked up in the cached model index (see cache.model_index),
+    the values are the current values of the model.
+
     :param r:
     :param model_path:
     :return:
     """
-    doc = libsbml.readSBMLFromFile(model_path)  # type: libsbml.SBMLDocument
-    model = doc.getModel()  # type: libsbml.Model
+    index = model_index(model_path)
 
-    # constant parameters in model
-    pids_const = []
-    for p in model.getListOfParameters():
-        if p.getConstant() == True:
-            pids_const.append(p.getId())
+    # constant parameters in model without dose and physical parameters
+    pids = index.ids[index.constant & ~index.dose & ~index.physical]
 
-    # print('constant parameters:', len(pids_const))
+    # current values
+    positions = {pid: k for k, pid in enumerate(r.model.getGlobalParameterIds())}
+    values = r.model.getGlobalParameterValues(
+        np.array([positions[pid] for pid in pids], dtype=np.int32)
+    )
 
-    # filter parameters
+    # filter zero parameters
     parameters = {}
-    for pid in pids_const:
-        # dose parameters
-        if (pid.startswith("IVDOSE_")) or (pid.startswith("PODOSE_")):
-            continue
-
-        # physical parameters
-        if (pid.startswith("Mr_")) or pid in ["R_PDB"]:
-            continue
-
-        # zero parameters
-        value = r[pid]
+    for pid, value in zip(pids, values):
         if np.abs(value) < 1E-8:
             continue
-
-        parameters[pid] = value
+        parameters[str(pid)] = float(value)
 
     return parameters
@@ -0,0 +1,13 @@
+import pytest
+from liverfunction import cache
+
+
+@pytest.fixture(autouse=True, scope="session")
+def cache_dir(tmp_path_factory):
+    """ Model and result cache of the tests in a temporary directory (not in the home directory). """
+    path = str(tmp_path_factory.mktemp("cache"))
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(cache, "CACHE_DIR", path)
+        # subprocesses of the tests
+        mp.setenv("LIVERFUNCTION_CACHE", path)
+        yield path
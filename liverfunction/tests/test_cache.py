@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import roadrunner
+from liverfunction.tests import data
+from liverfunction import cache
+
+
+def test_model_key():
+    key = cache.model_key(data.APAP_SBML)
+    with open(data.APAP_SBML) as f:
+        sbml = f.read()
+    assert key == cache.model_key(sbml)
+    assert key.endswith(roadrunner.__version__)
+
+
+def test_load_roadrunner(tmp_path):
+    cache.clear_model_cache()
+    cache_dir = str(tmp_path)
+    r1 = cache.load_roadrunner(data.APAP_SBML, cache_dir=cache_dir)
+    assert os.path.exists(os.path.join(cache_dir, "{}.rr".format(cache.model_key(data.APAP_SBML))))
+
+    # in-process cache returns independent instances
+    r2 = cache.load_roadrunner(data.APAP_SBML, cache_dir=cache_dir)
+    assert r1 is not r2
+    r2.PODOSE_apap = 100.0
+    assert r1.PODOSE_apap == 0.0
+
+    # disk cache
+    cache.clear_model_cache()
+    r3 = cache.load_roadrunner(data.APAP_SBML, cache_dir=cache_dir)
+    s1 = r1.simulate(0, 10, 11)
+    s3 = r3.simulate(0, 10, 11)
+    np.testing.assert_array_equal(s1, s3)
+
+
+def test_load_roadrunner_serializations(tmp_path):
+    # model file and SBML of the model (as loaded in workers) share the compiled model
+    cache.clear_model_cache()
+    cache_dir = str(tmp_path)
+    path = str(tmp_path / "model.xml")
+    with open(data.APAP_SBML, "r") as f:
+        sbml = f.read()
+    with open(path, "w") as f:
+        f.write(sbml.replace("\n", "\r\n"))
+    r = cache.load_roadrunner(path, cache_dir=cache_dir)
+    key = cache.model_key(r.getSBML())
+    assert key != cache.model_key(path)
+    cache.load_roadrunner(r.getSBML(), cache_dir=cache_dir)
+    assert [f for f in os.listdir(cache_dir) if f.endswith(".rr")] == ["{}.rr".format(key)]
+
+    # alias from disk
+    cache.clear_model_cache()
+    r2 = cache.load_roadrunner(path, cache_dir=cache_dir)
+    assert r2.PODOSE_apap == 0.0
+    assert [f for f in os.listdir(cache_dir) if f.endswith(".rr")] == ["{}.rr".format(key)]
+    cache.clear_model_cache(cache_dir=cache_dir, disk=True)
+    assert os.listdir(cache_dir) == ["model.xml"]
+
+
+def test_load_roadrunner_properties(tmp_path):
+    cache.clear_model_cache()
+    cache_dir = str(tmp_path)
+    for _ in range(3):
+        # compiled, in-process and disk cache
+        r = cache.load_roadrunner(data.APAP_SBML, cache_dir=cache_dir)
+        r.BW = 100.0
+        assert r["BW"] == 100.0
+        cache.clear_model_cache()
+
+
+def test_model_index(tmp_path):
+    cache.clear_model_cache()
+    cache_dir = str(tmp_path)
+    index = cache.model_index(data.APAP_SBML, cache_dir=cache_dir)
+    assert os.path.exists(os.path.join(cache_dir, "{}-index.npz".format(cache.sbml_hash(data.APAP_SBML))))
+    assert len(index.ids) == len(index.constant) == len(index.dose_targets)
+    k = list(index.ids).index("PODOSE_apap")
+    assert index.dose[k]
+    assert index.dose_targets[k] == "D_apap"
+
+    # persisted index
+    cache.clear_model_cache()
+    index2 = cache.model_index(data.APAP_SBML, cache_dir=cache_dir)
+    for field in cache.ModelIndex._fields:
+        np.testing.assert_array_equal(getattr(index, field), getattr(index2, field))
+
+
+def test_parameters_for_sensitivity():
+    from liverfunction.simulation import load_model, parameters_for_sensitivity
+    r = load_model(data.APAP_SBML)
+    parameters = parameters_for_sensitivity(r, data.APAP_SBML)
+    assert len(parameters) > 0
+    for pid, value in parameters.items():
+        assert not pid.startswith(("PODOSE_", "IVDOSE_", "Mr_"))
+        assert value == r[pid]
+
+
+def test_result_cache(tmp_path, monkeypatch):
+    from liverfunction import simulation as lfsim
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    kwargs = dict(outputs=["Ave_apap"], changes={"BW": 80.0})
+
+    s = lfsim.simulate(r, 10, 20, dosing, cache=True, **kwargs)
+    assert len(os.listdir(os.path.join(str(tmp_path), "results"))) == 1
+    s_cached = lfsim.simulate(r, 10, 20, dosing, cache=True, **kwargs)
+    np.testing.assert_array_equal(s.values, s_cached.values)
+    assert list(s.columns) == list(s_cached.columns)
+
+    # different settings are different results
+    dosing2 = lfsim.Dosing(substance="apap", route="oral", dose=1000, unit="mg")
+    s2 = lfsim.simulate(r, 10, 20, dosing2, cache=True, **kwargs)
+    assert not np.allclose(s.values, s2.values)
+    assert len(os.listdir(os.path.join(str(tmp_path), "results"))) == 2
+
+    # sensitivity results
+    result = lfsim.simulate(r, 10, 20, dosing, parameters={"BW": 70.0}, cache=True, **kwargs)
+    result_cached = lfsim.simulate(r, 10, 20, dosing, parameters={"BW": 70.0}, cache=True, **kwargs)
+    for field in lfsim.Result._fields:
+        np.testing.assert_array_equal(getattr(result, field).values, getattr(result_cached, field).values)
+
+    # conversion functions are keyed by their code and captured values
+    def make(factor):
+        def yfun(s):
+            s["X"] = factor * s["Ave_apap"]
+        return yfun
+
+    s1 = lfsim.simulate(r, 10, 20, dosing, cache=True, yfun=make(1.0), **kwargs)
+    s1000 = lfsim.simulate(r, 10, 20, dosing, cache=True, yfun=make(1000.0), **kwargs)
+    np.testing.assert_allclose(s1000.X.values, 1000.0 * s1.X.values)
+    s1_cached = lfsim.simulate(r, 10, 20, dosing, cache=True, yfun=make(1.0), **kwargs)
+    np.testing.assert_array_equal(s1_cached.X.values, s1.X.values)
+    assert cache.result_key(lambda s: s + 1) != cache.result_key(lambda s: s + 2)
+    assert cache.result_key(make(1.0)) == cache.result_key(make(1.0))
+
+    # module globals referenced by yfun
+    global FACTOR
+    FACTOR = 1.0
+    key = cache.result_key(yfun_global)
+    FACTOR = 2.0
+    assert cache.result_key(yfun_global) != key
+
+    # LRU eviction
+    cache.save_result("dummy", {'base': np.zeros(10)}, max_size=0)
+    assert os.listdir(os.path.join(str(tmp_path), "results")) == []
+
+
+FACTOR = 1.0
+
+
+def yfun_global(s):
+    s["X"] = FACTOR * s["Ave_apap"]
@@ -0,0 +1,81 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+
+from liverfunction import data
+
+
+def write_table(path, df):
+    with open(path, "w") as f:
+        f.write("# study table\n")
+        df.to_csv(f, sep="\t", index=False)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    os.makedirs(str(tmp_path / "data" / "Study2000"))
+    for k, fid in enumerate(["Fig1", "Study2000/Fig2", "Study2000/Tab1"]):
+        df = pd.DataFrame({"time": np.arange(5.0), "mean": np.arange(5.0) * (k + 1),
+                           "unit": "mg/L"})
+        write_table(str(tmp_path / "data" / (fid + ".tsv")), df)
+    return str(tmp_path / "data")
+
+
+def test_load_data(data_dir, tmp_path, capsys):
+    df = data.load_data("Fig1", data_dir=data_dir, extension="tsv")
+    assert list(df.columns) == ["time", "mean", "unit"]
+    assert "Fig1.tsv" in capsys.readouterr().out
+    df_cached = data.load_data("Fig1", data_dir=data_dir, extension="tsv", show=False,
+                               cache_dir=str(tmp_path / "cache"))
+    pd.testing.assert_frame_equal(df, df_cached)
+
+
+def test_data_catalog(data_dir, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    catalog = data.DataCatalog(data_dir, cache_dir=cache_dir)
+    assert catalog.keys() == ["Fig1", "Study2000/Fig2", "Study2000/Tab1"]
+    assert "Study2000/Fig2" in catalog
+    with pytest.raises(KeyError):
+        catalog.path("Fig3")
+
+    tables = catalog.load_many(n_workers=3)
+    assert list(tables.keys()) == catalog.keys()
+    for fid, df in tables.items():
+        pd.testing.assert_frame_equal(df, data.read_table(catalog.path(fid)))
+    assert len(os.listdir(cache_dir)) == 3
+
+    # cached tables are not parsed again
+    read_table = data.read_table
+    monkeypatch.setattr(data, "read_table", None)
+    df = catalog.load("Study2000/Fig2")
+    assert df["mean"].iloc[-1] == 8.0
+
+    # changed source invalidates the cache
+    monkeypatch.setattr(data, "read_table", read_table)
+    write_table(catalog.path("Study2000/Fig2"), pd.DataFrame({"time": [0.0], "mean": [1.0]}))
+    df = catalog.load("Study2000/Fig2")
+    assert list(df.columns) == ["time", "mean"]
+    assert len(os.listdir(cache_dir)) == 3
+
+    catalog.clear_cache()
+    assert os.listdir(cache_dir) == []
+
+    with pytest.raises(ValueError):
+        data.DataCatalog(data_dir, validate="size")
+
+
+def test_data_lightweight(data_dir):
+    # data loading (with the default cache directory) does not import the simulation stack
+    code = (
+        "import sys\n"
+        "from liverfunction import data\n"
+        "catalog = data.DataCatalog({!r})\n"
+        "catalog.load('Fig1')\n"
+        "data.load_data('Fig1', data_dir={!r}, extension='tsv', show=False, cache_dir=None)\n"
+        "print(','.join(m for m in ['roadrunner', 'libsbml'] if m in sys.modules))\n"
+    ).format(data_dir, data_dir)
+    out = subprocess.check_output([sys.executable, "-c", code]).decode().strip()
+    assert out == ""
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from liverfunction import simulation as lfsim
+from liverfunction import fitting
+from liverfunction.tests import data
+
+TRUE = {"FVli": 0.025, "LI__APAPUGT_HLM_CL": 1.6}
+INITIAL = {"FVli": 0.021, "LI__APAPUGT_HLM_CL": 1.27}
+
+
+@pytest.fixture(scope="module")
+def r():
+    return lfsim.load_model(data.APAP_SBML)
+
+
+@pytest.fixture(scope="module")
+def datasets(r):
+    """ Synthetic studies with two doses (time in min, concentration in mg/L). """
+    datasets = []
+    for dose in [1000, 2000]:
+        dosing = lfsim.Dosing(substance="apap", route="oral", dose=dose, unit="mg")
+        s = lfsim.simulate(r, 12, 24, dosing, changes=TRUE, outputs=["Cve_apap"])
+        df = pd.DataFrame({
+            "time": s.time.values * 60, "mean": s.Cve_apap.values * 1000,
+            "sd": 0.05 * s.Cve_apap.values * 1000 + 1.0,
+        })
+        datasets.append(fitting.FitData(df, "Cve_apap", dosing, yerr="sd", x_factor=1/60.0,
+                                        y_factor=1/1000.0, name="dose {}".format(dose)))
+    return datasets
+
+
+def test_fit_data():
+    df = pd.DataFrame({"time": [-10.0, 60.0, 0.0, 60.0, 120.0], "mean": [0.0, 2.0, 0.0, 4.0, np.nan]})
+    d = fitting.FitData(df, "Cve_apap", dosing=None, x_factor=1/60.0)
+    np.testing.assert_allclose(d.t, [0.0, 1.0, 1.0])
+    np.testing.assert_allclose(d.times, [0.0, 1.0])
+    np.testing.assert_allclose(d.yerr, 4.0)
+    np.testing.assert_allclose(d.residuals(np.array([0.0, 3.0])), [0.0, 0.25, -0.25])
+
+
+def test_fit(r, datasets):
+    with fitting.FitProblem(r, datasets, INITIAL) as problem:
+        x = np.log([INITIAL["FVli"], INITIAL["LI__APAPUGT_HLM_CL"]])
+        res = problem.residuals(x)
+        n = problem.n_simulations
+        # cached simulations
+        np.testing.assert_array_equal(problem.residuals(x), res)
+        assert problem.n_simulations == n
+        J = problem.jacobian(x)
+        assert J.shape == (res.size, 2)
+        assert problem.n_simulations == n + 4
+
+        costs = problem.evaluate([[INITIAL["FVli"], INITIAL["LI__APAPUGT_HLM_CL"]],
+                                  [TRUE["FVli"], TRUE["LI__APAPUGT_HLM_CL"]]])
+        assert costs[0] == pytest.approx(0.5 * np.sum(res**2))
+        assert costs[1] == pytest.approx(0.0, abs=1E-12)
+
+        fit = problem.fit()
+    assert fit.success
+    for pid, value in TRUE.items():
+        assert fit.parameters[pid] == pytest.approx(value, rel=1E-4)
+
+
+def test_fit_n_workers(r, datasets):
+    starts = [[0.015, 1.0], [0.03, 2.0]]
+    with fitting.FitProblem(r, datasets, INITIAL, bounds={"FVli": (0.01, 0.04)}) as problem:
+        fit = problem.fit(starts=starts)
+    with fitting.FitProblem(r, datasets, INITIAL, bounds={"FVli": (0.01, 0.04)},
+                            n_workers=2) as problem:
+        fit_parallel = problem.fit(starts=starts)
+    for pid in TRUE:
+        assert fit_parallel.parameters[pid] == pytest.approx(fit.parameters[pid], rel=1E-10)
+        assert fit.parameters[pid] == pytest.approx(TRUE[pid], rel=1E-4)
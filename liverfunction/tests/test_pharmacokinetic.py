@@ -0,0 +1,147 @@
+import sys
+import warnings
+import subprocess
+import numpy as np
+import pytest
+from liverfunction import pharmacokinetic as pk
+
+
+def bateman(t, ka, ke, dose=100.0, vd=10.0):
+    """ Concentration curve of oral dose with first order absorption and elimination. """
+    return dose/vd * ka/(ka - ke) * (np.exp(-ke*t) - np.exp(-ka*t))
+
+
+@pytest.fixture
+def curves():
+    t = np.linspace(0, 24, num=49)
+    c = np.array([
+        bateman(t, ka=ka, ke=ke)
+        for ka, ke in [(1.5, 0.2), (0.8, 0.1), (3.0, 0.5), (0.5, 0.3)]
+    ])
+    # maximum at start, maximum at end and two points after maximum
+    c = np.vstack([c, 10*np.exp(-0.2*t), 1 + t, np.concatenate([t[:-2], [50.0, 40.0]])])
+    return t, c
+
+
+def test_f_pk_batch(curves):
+    t, c = curves
+    dose = np.linspace(100, 200, num=c.shape[0])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        df = pk.f_pk_batch(t, c, compound="apap", dose=dose, bodyweight=75.0)
+        assert len(df) == c.shape[0]
+
+        for k in range(c.shape[0]):
+            pk_single = pk.f_pk(t, c[k, :], compound="apap", dose=dose[k], bodyweight=75.0)
+            assert list(df.columns) == list(pk_single.keys())
+            for key, value in pk_single.items():
+                if isinstance(value, str):
+                    assert df[key][k] == value
+                else:
+                    np.testing.assert_allclose(df[key][k], value, rtol=1E-8, atol=1E-12,
+                                               err_msg="{}: {}".format(k, key))
+
+
+def test_auc_batch(curves):
+    t, c = curves
+    np.testing.assert_allclose(pk._auc(t, c), [pk._auc(t, ck) for ck in c])
+
+
+def test_f_pk_nonuniform():
+    # with weighted dense sampling around the maximum does not bias the regression
+    t_uniform = np.linspace(0, 24, 2001)
+    t = np.unique(np.concatenate([np.linspace(0, 3, 2000), np.linspace(3, 24, 50)]))
+    kel = np.log(2) / 4.0
+    for times in [t_uniform, t]:
+        c = 10 * (np.exp(-kel * times) - np.exp(-2.0 * times))
+        res = pk.f_pk(times, c, compound="test", weighted=True)
+        assert res["thalf"] == pytest.approx(4.0, rel=0.01)
+    pk_batch = pk.f_pk_batch(t, c[np.newaxis, :], compound="test", weighted=True)
+    for key in ["thalf", "p_value", "std_err"]:
+        assert pk_batch[key][0] == pytest.approx(res[key])
+
+    with pytest.raises(ValueError):
+        pk.f_pk(t[::-1], c, compound="test")
+
+
+def test_f_pk_nonuniform_unweighted():
+    # study sampling times, the default regression is ordinary least squares
+    from scipy import stats
+    t = np.array([0, 0.25, 0.5, 1, 2, 4, 6, 8, 12, 24])
+    c = bateman(t, 1.5, 0.2) * (1 + 0.03*np.sin(7*t))
+    res = pk.f_pk(t, c, compound="apap", dose=100.0)
+    assert res["kel"] == pytest.approx(0.20083934926345645, rel=1E-10)
+    assert res["vd"] == pytest.approx(8.675022793313117, rel=1E-10)
+    assert res["cl"] == pytest.approx(1.7422859326546587, rel=1E-10)
+    assert res["p_value"] == pytest.approx(9.715652669161863e-07, rel=1E-8)
+    assert res["std_err"] == pytest.approx(0.0015283144739808789, rel=1E-10)
+
+    k = res["max_idx"] + 1
+    lr = stats.linregress(t[k:], np.log(c[k:]))
+    df = pk.f_pk_batch(t, c[np.newaxis, :], compound="apap", dose=100.0)
+    for key, lr_key in [("slope", "slope"), ("intercept", "intercept"), ("r_value", "rvalue"),
+                        ("p_value", "pvalue"), ("std_err", "stderr")]:
+        assert df[key][0] == pytest.approx(getattr(lr, lr_key), rel=1E-8)
+
+    # weighted regression with degrees of freedom of the effective number of points
+    w = pk._trapezoid_weights(t, np.array([res["max_idx"]]))[0, k:]
+    n_eff = np.sum(w)**2 / np.sum(w**2)
+    res_w = pk.f_pk(t, c, compound="apap", dose=100.0, weighted=True)
+    x, y = t[k:], np.log(c[k:])
+    xm, ym = np.average(x, weights=w), np.average(y, weights=w)
+    sxx = np.average((x - xm)**2, weights=w)
+    syy = np.average((y - ym)**2, weights=w)
+    r = np.average((x - xm)*(y - ym), weights=w) / np.sqrt(sxx * syy)
+    assert res_w["std_err"] == pytest.approx(np.sqrt((1 - r**2) * syy / sxx / (n_eff - 2)), rel=1E-8)
+    assert res_w["p_value"] > res["p_value"]
+
+
+def test_pk_accumulator(curves):
+    t, c = curves
+    # second maximum (regression restarts) and non-uniform grid
+    t2 = np.unique(np.concatenate([np.linspace(0, 2, 30), np.linspace(2, 24, 20)]))
+    data = [(t, ck) for ck in c]
+    data.append((t, bateman(t, 1.5, 0.2) + bateman(np.maximum(t - 12, 0), 1.5, 0.2, dose=200)))
+    data.append((t2, bateman(t2, 1.5, 0.2)))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for tk, ck in data:
+            for weighted in [False, True]:
+                pk_single = pk.f_pk(tk, ck, compound="apap", dose=100.0, weighted=weighted)
+                for chunksize in [1, 5, tk.size]:
+                    acc = pk.PKAccumulator(compound="apap", dose=100.0, weighted=weighted)
+                    for k in range(0, tk.size, chunksize):
+                        acc.update(tk[k:k+chunksize], ck[k:k+chunksize])
+                    pk_acc = acc.result()
+                    assert list(pk_acc.keys()) == list(pk_single.keys())
+                    for key, value in pk_single.items():
+                        if isinstance(value, str):
+                            assert pk_acc[key] == value
+                        else:
+                            # exact exponential decay: std_err of weighted sums is round-off
+                            np.testing.assert_allclose(pk_acc[key], value, rtol=1E-8, atol=1E-9,
+                                                       err_msg="{} {}: {}".format(weighted, chunksize, key))
+
+
+def test_import_lightweight():
+    # f_pk must be importable in workers without the heavy dependencies
+    code = (
+        "import sys\n"
+        "from liverfunction.pharmacokinetic import f_pk, f_pk_batch, PKAccumulator\n"
+        "import liverfunction.result\n"
+        "heavy = ['pandas', 'matplotlib', 'scipy.stats', 'roadrunner', 'libsbml', 'IPython']\n"
+        "print(','.join(m for m in heavy if m in sys.modules))\n"
+    )
+    out = subprocess.check_output([sys.executable, "-c", code]).decode().strip()
+    assert out == ""
+
+
+def test_import_lazy_dependencies():
+    import pandas as pd
+    t = np.linspace(0, 24, num=49)
+    c = bateman(t, ka=1.5, ke=0.2)
+    res = pk.f_pk(pd.Series(t), pd.Series(c), compound="apap", dose=100.0)
+    assert res == pytest.approx(pk.f_pk(t, c, compound="apap", dose=100.0), nan_ok=True)
+    df = pk.f_pk_batch(t, c[np.newaxis, :], compound="apap", dose=100.0)
+    assert df.auc[0] == pytest.approx(res['auc'])
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+from liverfunction import plotting
+from liverfunction.simulation import Result
+
+
+def test_decimate():
+    x = np.linspace(0, 10, 10001)
+    y = np.sin(x) + np.where(np.arange(x.size) == 5003, 5.0, 0.0)
+    xd, yd = plotting._decimate_line(x, y, max_points=100)
+    assert xd.size <= 210
+    assert xd[0] == x[0] and xd[-1] == x[-1]
+    assert np.all(np.diff(xd) > 0)
+    # peaks are preserved
+    assert yd.max() == y.max()
+    assert yd.min() == y.min()
+
+    xb, lower, upper = plotting._decimate_band(x, y - 1, y + 1, max_points=100)
+    assert xb.size == lower.size == upper.size
+    # decimated band contains the band
+    assert np.all(np.interp(x, xb, lower) <= y - 1 + 1E-2)
+    assert np.all(np.interp(x, xb, upper) >= y + 1 - 1E-2)
+
+    # short lines are not decimated
+    xd, yd = plotting._decimate_line(x[:100], y[:100], max_points=100)
+    np.testing.assert_array_equal(yd, y[:100])
+
+
+def test_add_lines():
+    t = np.linspace(0, 10, 5001)
+    df = pd.DataFrame({"time": t, "A": np.exp(-t)})
+    result = Result(base=df, mean=df, std=df * 0.1, min=df * 0.8, max=df * 1.2)
+
+    f, ax = plt.subplots(1, 1)
+    plotting.add_line(xid="time", yid="A", ax=ax, s=result, color="blue", label="A")
+    plotting.add_lines("time", [(df, "A", "red", "A df"), (result, "A", "black", "A result")], ax)
+    assert len(ax.lines) == 3
+    assert len(ax.collections) == 2
+    assert ax.get_legend_handles_labels()[1] == ["sim A", "sim A df", "sim A result"]
+    assert ax.get_ylim()[1] >= 1.2
+    plt.close(f)
@@ -0,0 +1,38 @@
+import warnings
+import numpy as np
+import pytest
+from liverfunction.tests import data
+from liverfunction import simulation as lfsim
+from liverfunction import population
+
+
+def test_sample_parameters():
+    distributions = population.distributions_from_parameters({"BW": 70.0, "FVli": 0.02}, cv=0.1)
+    for method in ["lhs", "sobol"]:
+        samples = population.sample_parameters(distributions, n=64, method=method, seed=1)
+        assert samples.shape == (64, 2)
+        assert list(samples.columns) == ["BW", "FVli"]
+        assert np.all(samples.values > 0)
+        assert np.median(samples.BW) == pytest.approx(70.0, rel=0.05)
+
+    with pytest.raises(ValueError):
+        population.sample_parameters(distributions, n=4, method="random")
+
+
+def test_simulate_population():
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    distributions = population.distributions_from_parameters({"BW": 70.0, "FVli": 0.021}, cv=0.2)
+    samples = population.sample_parameters(distributions, n=6, seed=42)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        kwargs = dict(outputs=["Ave_apap", "Aurine_apap"], pk_kwargs={"dose": 2000}, chunksize=2)
+        df = population.simulate_population(r, 24, 96, dosing, samples, **kwargs)
+        df_parallel = population.simulate_population(r, 24, 96, dosing, samples, n_workers=2, **kwargs)
+
+    assert len(df) == 12
+    assert list(df.individual.unique()) == list(range(6))
+    assert set(df.output) == {"Ave_apap", "Aurine_apap"}
+    np.testing.assert_array_equal(df.auc.values, df_parallel.auc.values)
+    assert df[df.output == "Ave_apap"].auc.std() > 0
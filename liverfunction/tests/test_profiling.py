@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import subprocess
+
+from liverfunction.tests import data
+from liverfunction import simulation as lfsim
+from liverfunction import profiling
+
+
+def _parameters(r, n=2):
+    return {pid: value for pid, value in
+            list(lfsim.parameters_for_sensitivity(r, data.APAP_SBML).items())[:n]}
+
+
+def test_profile_phases():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    parameters = _parameters(r)
+
+    with profiling.profile() as profiler:
+        lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters)
+
+    phases = set(record['phase'] for record in profiler.records)
+    for phase in ["run", "dosing", "reset", "changes", "integrate", "frame", "statistics"]:
+        assert phase in phases
+
+    # baseline and one run per parameter change
+    runs = [record for record in profiler.records if record['phase'] == "run"]
+    assert len(runs) == 1 + 2*len(parameters)
+    assert runs[0]['pid'] is None
+    assert set((rec['pid'], rec['factor']) for rec in runs[1:]) == set(
+        (pid, factor) for pid in parameters for factor in (0.9, 1.1))
+
+    # nested phases contain the run of the enclosing phase
+    for record in profiler.records:
+        if record['phase'] == "integrate":
+            assert record['points'] == 21
+            assert record['segments'] == 1
+        assert record['wall'] >= 0
+        assert record['process'] == os.getpid()
+    assert set(rec['pid'] for rec in profiler.records if rec['phase'] == "reset") == \
+        set([None] + list(parameters))
+
+    summary = profiler.summary()
+    assert summary.loc["run", "calls"] == len(runs)
+    assert summary.loc["integrate", "wall"] <= summary.loc["run", "wall"]
+    assert len(profiler.to_frame()) == len(profiler.records)
+
+
+def test_profile_argument():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dose = lfsim.Dosing(substance="apap", route="oral", dose=1000, unit="mg")
+    dosing = lfsim.DosingSchedule(times=[0.0, 4.0], dosings=[dose, dose])
+    profiler = profiling.Profiler()
+    records = []
+    lfsim.simulate(r, tend=10, steps=20, dosing=dosing, profiler=profiling.Profiler(callback=records.append))
+    lfsim.simulate(r, tend=10, steps=20, dosing=dosing, profiler=profiler)
+
+    integrate = [rec for rec in profiler.records if rec['phase'] == "integrate"]
+    assert len(integrate) == 1
+    assert integrate[0]['segments'] == 2
+    assert len(records) == len(profiler.records)
+    assert profiling.active() is None
+
+
+def test_profile_n_workers():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    parameters = _parameters(r)
+
+    profiler = profiling.Profiler()
+    lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters, n_workers=2,
+                   profiler=profiler)
+    runs = [record for record in profiler.records if record['phase'] == "run"]
+    assert len(runs) == 1 + 2*len(parameters)
+    assert set(rec['process'] for rec in runs[1:]) != {os.getpid()}
+
+
+def test_no_profiler():
+    assert profiling.active() is None
+    with profiling.phase("run") as phase:
+        phase.set(points=1)
+    with profiling.activate(None) as profiler:
+        assert profiler is None
+        assert profiling.active() is None
+
+
+def test_profile_environment(tmp_path):
+    path = str(tmp_path / "profile.jsonl")
+    code = (
+        "from liverfunction import simulation as lfsim\n"
+        "r = lfsim.load_model(model_path={!r})\n"
+        "dosing = lfsim.Dosing(substance='apap', route='oral', dose=2000, unit='mg')\n"
+        "lfsim.simulate(r, tend=10, steps=20, dosing=dosing)\n"
+    ).format(data.APAP_SBML)
+    env = dict(os.environ, LIVERFUNCTION_PROFILE=path)
+    subprocess.check_call([sys.executable, "-c", code], env=env)
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert "integrate" in set(record['phase'] for record in records)
@@ -0,0 +1,42 @@
+import os
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from liverfunction import pharmacokinetic as pk
+from liverfunction import report
+
+
+def test_write_pk_report(tmp_path):
+    t = np.linspace(0, 24, num=49)
+    curves = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for k, ka in enumerate([0.5, 1.0, 2.0]):
+            c = 10 * (np.exp(-0.2*t) - np.exp(-ka*t))
+            curves.append(("curve{}".format(k), t, c, pk.f_pk(t, c, compound="apap", dose=100.0)))
+        # no maximum within time course
+        curves.append(("increasing", t, 1 + t, pk.f_pk(t, 1 + t, compound="apap")))
+
+    pdf_path = str(tmp_path / "report.pdf")
+    summary_path = str(tmp_path / "summary.csv")
+    png_dir = str(tmp_path / "png")
+    summary = report.write_pk_report(curves, pdf_path=pdf_path, png_dir=png_dir, summary_path=summary_path)
+    assert list(summary.name) == ["curve0", "curve1", "curve2", "increasing"]
+    np.testing.assert_allclose(summary.auc.values, [curve[3]["auc"] for curve in curves])
+    assert len(pd.read_csv(summary_path)) == 4
+    assert sorted(os.listdir(png_dir)) == ["curve0.png", "curve1.png", "curve2.png", "increasing.png"]
+    with open(pdf_path, "rb") as f:
+        assert len(re.findall(rb"/Type /Page[^s]", f.read())) == 4
+
+    # catalog ids as names
+    curves_catalog = [("Critchley1994/Fig1", ) + curves[0][1:], ("Critchley1994_Fig1", ) + curves[1][1:]]
+    png_dir = str(tmp_path / "png_catalog")
+    report.write_pk_report(curves_catalog, png_dir=png_dir)
+    assert sorted(os.listdir(png_dir)) == ["Critchley1994_Fig1.png", "Critchley1994_Fig1_1.png"]
+    assert report.png_filename("../a b") == "_a_b.png"
+
+    pdf_path = str(tmp_path / "report_parallel.pdf")
+    report.write_pk_report(curves, pdf_path=pdf_path, n_workers=2, chunksize=2)
+    with open(pdf_path, "rb") as f:
+        assert len(re.findall(rb"/Type /Page[^s]", f.read())) == 4
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from liverfunction import simulation as lfsim
+from liverfunction.result import Result
+from liverfunction.tests import data
+
+
+@pytest.fixture(scope="module")
+def result():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    parameters = {pid: value for pid, value in
+                  list(lfsim.parameters_for_sensitivity(r, data.APAP_SBML).items())[:3]}
+    return lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters,
+                          outputs=["Cve_apap"], samples=True)
+
+
+def test_result_layout(result):
+    assert result.data.shape == (5, ) + result.shape
+    assert result.data.flags.c_contiguous
+    assert result.samples.shape == (6, ) + result.shape
+    for k, df in enumerate(result):
+        assert isinstance(df, pd.DataFrame)
+        assert list(df.columns) == result.columns
+        # views on the data array
+        assert np.shares_memory(df.values, result.data[k])
+        assert df is getattr(result, Result._fields[k])
+
+    s = result.samples
+    np.testing.assert_allclose(result.mean.values, np.mean(s, axis=0))
+    np.testing.assert_allclose(result.std.values, np.std(s, axis=0), atol=1E-14)
+    np.testing.assert_array_equal(result.min.values, np.min(s, axis=0))
+    np.testing.assert_array_equal(result.max.values, np.max(s, axis=0))
+
+    # namedtuple interface
+    base, mean, std, s_min, s_max = result
+    assert result[1] is mean
+    assert list(result._asdict().keys()) == list(Result._fields)
+    other = Result(**result._asdict())
+    np.testing.assert_array_equal(other.data, result.data)
+
+
+def test_result_quantiles(result):
+    lower, upper = result.band(0.05, 0.95)
+    assert np.all(lower.values >= result.min.values)
+    assert np.all(upper.values <= result.max.values)
+    assert np.all(lower.values <= upper.values)
+    np.testing.assert_array_equal(result.quantile(0.0).values, result.min.values)
+
+    no_samples = Result(data=result.data, columns=result.columns)
+    with pytest.raises(ValueError):
+        no_samples.quantile(0.5)
+
+
+def test_result_npz(result, tmp_path):
+    path = str(tmp_path / "result.npz")
+    result.to_npz(path)
+    loaded = Result.from_npz(path)
+    assert loaded.columns == result.columns
+    np.testing.assert_array_equal(loaded.data, result.data)
+    np.testing.assert_array_equal(loaded.samples, result.samples)
+
+    single = result.astype(np.float32)
+    assert single.data.dtype == np.float32
+    assert single.nbytes == result.nbytes // 2
+    assert single.mean.values.dtype == np.float32
+
+
+def test_result_arrow(result, tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "result.arrow")
+    result.to_feather(path)
+    loaded = Result.from_feather(path)
+    assert loaded.columns == result.columns
+    np.testing.assert_array_equal(loaded.data, result.data)
+    assert loaded.samples is None
+
+
+def test_result_samples_out_path(tmp_path):
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    out_path = str(tmp_path / "sensitivity.npy")
+    result = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters={"BW": 70.0},
+                            outputs=["Cve_apap"], out_path=out_path, samples=True)
+    assert isinstance(result.samples, np.memmap)
+    np.testing.assert_array_equal(result.quantile(1.0).values, result.max.values)
@@ -0,0 +1,38 @@
+import numpy as np
+from liverfunction.tests import data
+from liverfunction import simulation as lfsim
+from liverfunction import scenarios
+
+
+def test_scenario_table():
+    dosings = {
+        "po": lfsim.Dosing(substance="apap", route="oral", dose=1000, unit="mg"),
+        "iv": lfsim.Dosing(substance="apap", route="iv", dose=1000, unit="mg"),
+    }
+    df = scenarios.scenario_table(dosings, changes=[{"BW": 50.0}, {"BW": 90.0}])
+    assert len(df) == 4
+    assert list(df.dosing_id) == ["po", "po", "iv", "iv"]
+    assert list(df.changes_id) == [0, 1, 0, 1]
+
+
+def test_simulate_scenarios():
+    r = lfsim.load_model(data.APAP_SBML)
+    dosings = [lfsim.Dosing(substance="apap", route="oral", dose=dose, unit="mg") for dose in [500, 2000]]
+    table = scenarios.scenario_table(dosings, changes=[{}, {"BW": 90.0}])
+    # duplicated scenario
+    table.loc[4] = table.loc[1]
+    outputs = ["Ave_apap", "Aurine_apap"]
+
+    df = scenarios.simulate_scenarios(r, 10, 20, table, outputs=outputs)
+    assert df.index.names == ["scenario", "step"]
+    assert list(df.index.get_level_values("scenario").unique()) == [0, 1, 2, 3, 4]
+    assert len(df) == 5 * 21
+    np.testing.assert_array_equal(df.loc[1].values, df.loc[4].values)
+
+    # identical to single simulations
+    for sid in [0, 3]:
+        s = lfsim.simulate(r, 10, 20, table.dosing[sid], changes=table.changes[sid], outputs=outputs)
+        np.testing.assert_allclose(df.loc[sid][s.columns].values, s.values)
+
+    df_parallel = scenarios.simulate_scenarios(r, 10, 20, table, outputs=outputs, n_workers=2)
+    np.testing.assert_array_equal(df.values, df_parallel.values)
@@ -0,0 +1,54 @@
+import warnings
+import numpy as np
+import pytest
+from scipy import stats
+from liverfunction.tests import data
+from liverfunction import simulation as lfsim
+from liverfunction import population
+from liverfunction import sensitivity
+
+
+@pytest.fixture
+def distributions():
+    return {"x1": stats.uniform(0, 1), "x2": stats.uniform(0, 1), "x3": stats.uniform(0, 1)}
+
+
+def test_sobol_indices(distributions):
+    sample = sensitivity.saltelli_sample(distributions, n=1024, seed=1)
+    assert sample.samples.shape == (1024 * 8, 3)
+
+    # variance contributions 1:4:0
+    x = sample.samples
+    y = x.x1 + 2 * x.x2
+    df = sensitivity.sobol_indices(sample, y, n_bootstrap=20, seed=1)
+    np.testing.assert_allclose(df.S1.values, [0.2, 0.8, 0.0], atol=0.03)
+    np.testing.assert_allclose(df.ST.values, [0.2, 0.8, 0.0], atol=0.03)
+    assert np.all(df.S1_conf.values >= 0)
+
+    with pytest.raises(ValueError):
+        sensitivity.sobol_indices(sample, y[:10])
+
+
+def test_morris_indices(distributions):
+    sample = sensitivity.morris_sample(distributions, trajectories=10, levels=4, seed=1)
+    assert sample.samples.shape == (10 * 4, 3)
+
+    x = sample.samples
+    y = x.x1 - 2 * x.x2
+    df = sensitivity.morris_indices(sample, y)
+    # steps of delta in the unit hypercube, bin centers scale with (levels-1)/levels
+    np.testing.assert_allclose(df.mu.values, np.array([1.0, -2.0, 0.0]) * 0.75)
+    np.testing.assert_allclose(df.mu_star.values, np.array([1.0, 2.0, 0.0]) * 0.75)
+    np.testing.assert_allclose(df.sigma.values, 0.0, atol=1E-12)
+
+
+def test_sobol_analysis():
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    distributions = population.distributions_from_parameters({"BW": 70.0, "FVli": 0.021}, cv=0.2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        df = sensitivity.sobol_analysis(r, 24, 48, dosing, distributions, outputs=["Aurine_apap"],
+                                        n=8, metrics=["auc"], seed=1, n_bootstrap=0)
+    assert list(df.parameter) == ["BW", "FVli"]
+    assert set(df.columns) >= {"output", "metric", "S1", "ST"}
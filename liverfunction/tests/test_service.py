@@ -0,0 +1,42 @@
+import asyncio
+import numpy as np
+import pytest
+from liverfunction.tests import data
+from liverfunction import simulation as lfsim
+from liverfunction import service
+
+
+def test_service():
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    outputs = ["Ave_apap", "Aurine_apap"]
+
+    async def requests():
+        async with service.SimulationService(data.APAP_SBML, n_workers=2, max_queue=1) as s:
+            results = await asyncio.gather(*[
+                s.simulate(10, 20, dosing, changes={"BW": bw}, outputs=outputs) for bw in [60.0, 80.0]
+            ])
+            pk = await s.f_pk(10, 20, dosing, outputs=outputs, pk_kwargs={"dose": 2000})
+
+            # backpressure
+            busy = await asyncio.gather(*[s.simulate(10, 20, dosing, outputs=outputs) for _ in range(4)],
+                                        return_exceptions=True)
+            assert [isinstance(b, service.ServiceBusyError) for b in busy] == [False, False, False, True]
+
+            # timeout and cancellation
+            with pytest.raises(asyncio.TimeoutError):
+                await s.simulate(1000, 100000, dosing, outputs=outputs, timeout=0.01)
+            task = asyncio.ensure_future(s.simulate(10, 20, dosing, outputs=outputs))
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            after = await s.simulate(10, 20, dosing, outputs=outputs)
+        return results, pk, after
+
+    results, pk, after = asyncio.run(requests())
+    for bw, df in zip([60.0, 80.0], results):
+        s = lfsim.simulate(r, 10, 20, dosing, changes={"BW": bw}, outputs=outputs)
+        np.testing.assert_allclose(df[s.columns].values, s.values)
+    assert list(pk.output) == outputs
+    assert len(after) == 21
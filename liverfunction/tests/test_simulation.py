@@ -1,4 +1,6 @@
+import warnings
 import pytest
+import numpy as np
 from liverfunction.tests import data
 from liverfunction import simulation as lfsim
 
@@ -21,3 +23,276 @@ def test_get_doses_keys():
     assert "PODOSE_apap" in keys
     for key in keys:
         assert key.startswith("PODOSE_") or key.startswith("IVDOSE_")
+
+
+def test_simulate_sensitivity_n_workers():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    parameters = {pid: value for pid, value in
+                  list(lfsim.parameters_for_sensitivity(r, data.APAP_SBML).items())[:2]}
+
+    s_serial = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters)
+    s_parallel = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters,
+                                n_workers=2)
+
+    assert isinstance(s_parallel, lfsim.Result)
+    for key in lfsim.Result._fields:
+        df_serial = getattr(s_serial, key)
+        df_parallel = getattr(s_parallel, key)
+        assert list(df_serial.columns) == list(df_parallel.columns)
+        np.testing.assert_array_equal(df_serial.values, df_parallel.values)
+
+
+def test_simulate_sensitivity_n_workers_integrator():
+    # workers integrate with the tolerances of the model
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    r.integrator.setValue("relative_tolerance", 1E-3)
+    r.integrator.setValue("absolute_tolerance", 1E-3)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    parameters = {pid: value for pid, value in
+                  list(lfsim.parameters_for_sensitivity(r, data.APAP_SBML).items())[:2]}
+    s_serial = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters)
+    s_parallel = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters,
+                                n_workers=2)
+    for key in lfsim.Result._fields:
+        np.testing.assert_array_equal(getattr(s_serial, key).values, getattr(s_parallel, key).values)
+
+
+def test_simulate_sensitivity_streaming(tmp_path):
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    parameters = {pid: value for pid, value in
+                  list(lfsim.parameters_for_sensitivity(r, data.APAP_SBML).items())[:2]}
+
+    s_dense = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters)
+    out_path = str(tmp_path / "sensitivity.npy")
+    s_stream = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, parameters=parameters,
+                              out_path=out_path)
+
+    for key in lfsim.Result._fields:
+        np.testing.assert_allclose(getattr(s_dense, key).values, getattr(s_stream, key).values,
+                                   rtol=1E-10, atol=1E-12)
+
+    s_data = np.load(out_path, mmap_mode="r")
+    assert s_data.shape == (4, ) + s_dense.base.shape
+    np.testing.assert_array_equal(np.min(s_data, axis=0), s_dense.min.values)
+
+
+def test_running_stats():
+    x = np.random.RandomState(1).normal(size=(10, 3, 4))
+    stats = lfsim.RunningStats(shape=(3, 4))
+    for k in range(x.shape[0]):
+        stats.update(x[k])
+    np.testing.assert_allclose(stats.mean, np.mean(x, axis=0))
+    np.testing.assert_allclose(stats.std, np.std(x, axis=0))
+    np.testing.assert_array_equal(stats.min, np.min(x, axis=0))
+    np.testing.assert_array_equal(stats.max, np.max(x, axis=0))
+
+
+def test_set_dosing():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    selections = r.timeCourseSelections
+
+    lfsim.set_dosing(r, lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg"))
+    assert r.PODOSE_apap == 2000.0
+    assert r.D_apap == 2000.0
+    assert r.timeCourseSelections == selections
+
+    lfsim.set_dosing(r, lfsim.Dosing(substance="apap", route="iv", dose=10, unit="mg/kg"), bodyweight=80)
+    assert r.PODOSE_apap == 0.0
+    assert r.D_apap == 0.0
+    assert r.DIV_apap == 800.0
+
+    with pytest.raises(ValueError):
+        lfsim.set_dosing(r, lfsim.Dosing(substance="apap", route="im", dose=10, unit="mg"))
+
+
+def test_snapshot_restore():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    snapshot = lfsim.get_snapshot(r)
+    assert snapshot is lfsim.get_snapshot(r)
+    assert snapshot.dose_ids == lfsim.get_doses_keys(r)
+
+    s1 = r.simulate(0, 10, 11)
+    r.BW = 100.0
+    r.PODOSE_apap = 500.0
+    snapshot.restore(r)
+    assert r.BW == snapshot.initial_value("BW")
+    assert r.PODOSE_apap == 0.0
+    s2 = r.simulate(0, 10, 11)
+    np.testing.assert_array_equal(s1, s2)
+
+
+def test_simulate_dosing_schedule():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    selections = ["time", "D_apap", "Ave_apap", "Aurine_apap"]
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=1000, unit="mg")
+    s_single = lfsim.simulate(r, tend=12, steps=24, dosing=dosing, selections=selections)
+
+    schedule = lfsim.DosingSchedule.repeated(dosing, interval=6, n=2)
+    s = lfsim.simulate(r, tend=12, steps=24, dosing=schedule, selections=selections)
+    assert s.shape == s_single.shape
+    np.testing.assert_allclose(s.time, s_single.time)
+
+    # identical until the second dose, which is added to the dose variable
+    np.testing.assert_array_equal(s.values[:12, :], s_single.values[:12, :])
+    assert s.D_apap[12] == pytest.approx(s_single.D_apap[12] + 1000)
+    assert s.Ave_apap[13] > s_single.Ave_apap[13]
+
+
+def test_dosing_schedule_infusion():
+    dosing = lfsim.Dosing(substance="apap", route="iv", dose=1000, unit="mg")
+    schedule = lfsim.DosingSchedule(times=[2.0], dosings=[dosing], durations=[1.0], infusion_steps=10)
+    events = schedule.events()
+    assert len(events) == 10
+    assert events[0][0] == 2.0
+    assert events[-1][0] < 3.0
+    assert sum(e[2] for e in events) == pytest.approx(1000)
+
+    with pytest.raises(ValueError):
+        lfsim.DosingSchedule(times=[0], dosings=[lfsim.Dosing("apap", "oral", 10, "mg")], durations=[1.0])
+
+
+def yfun_plasma(s):
+    s['Cve_apap_mM'] = s['Ave_apap'] / s['Vve']
+
+
+def test_output_selections():
+    selections = lfsim.output_selections(["Cve_apap_mM", "Aurine_apap"], yfun=yfun_plasma)
+    assert selections == ["time", "Ave_apap", "Vve", "Aurine_apap"]
+
+    def yfun_frame(s):
+        s.loc[:, 'x'] = 1.0
+
+    assert lfsim.output_selections(["x"], yfun=yfun_frame) is None
+
+    # DataFrame attributes and unknown ids are not inferred as model columns
+    r = lfsim.load_model(data.APAP_SBML)
+
+    def yfun_shape(s):
+        s["n"] = np.arange(s.shape[0]) + 0 * s.index
+        s["y"] = s.Ave_apap
+
+    def yfun_unknown(s):
+        s["y"] = s.Ave_apap + s.unknown
+
+    assert lfsim.output_selections(["y"], yfun=yfun_shape) is None
+    assert lfsim.output_selections(["y"], yfun=yfun_shape, r=r) is None
+    assert lfsim.output_selections(["y"], yfun=yfun_unknown, r=r) is None
+    assert lfsim.output_selections(["y"], yfun=lambda s: s.__setitem__("y", s.Ave_apap), r=r) == \
+        ["time", "Ave_apap"]
+
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    s = lfsim.simulate(r, 10, 20, dosing, outputs=["y"], yfun=yfun_shape)
+    np.testing.assert_array_equal(s.n.values, np.arange(21))
+    np.testing.assert_array_equal(s.y.values, s.Ave_apap.values)
+
+
+def test_simulate_outputs():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    s_full = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, yfun=yfun_plasma)
+    s = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, yfun=yfun_plasma,
+                       outputs=["Cve_apap_mM"])
+    assert list(s.columns) == ["time", "Ave_apap", "Vve", "Cve_apap_mM"]
+    np.testing.assert_array_equal(s.Cve_apap_mM, s_full.Cve_apap_mM)
+
+    tc = lfsim.simulate(r, tend=10, steps=20, dosing=dosing, outputs=["Ave_apap"], as_frame=False)
+    assert isinstance(tc, lfsim.Timecourse)
+    assert tc.columns == ["time", "Ave_apap"]
+    assert tc.shape == (21, 2)
+    np.testing.assert_array_equal(tc["Ave_apap"], s.Ave_apap)
+    assert np.shares_memory(tc.frame.values, tc.data)
+
+
+def test_simulate_adaptive():
+    from liverfunction.pharmacokinetic import f_pk
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    schedule = lfsim.DosingSchedule.repeated(dosing, interval=6, n=3)
+    for d in [dosing, schedule]:
+        dense = lfsim.simulate(r, 24, 20000, d, outputs=["Cve_apap"])
+        s = lfsim.simulate(r, 24, 100, d, outputs=["Cve_apap"], adaptive=True)
+        assert len(s) < 0.05 * len(dense)
+        assert s.time.iloc[0] == 0.0
+        assert s.time.iloc[-1] == pytest.approx(24.0)
+        assert np.all(np.diff(s.time) > 0)
+        # output interval bounded by tend/steps
+        assert np.max(np.diff(s.time)) <= 0.24 + 1E-10
+
+        pk_dense = f_pk(dense.time, dense.Cve_apap, "apap")
+        pk = f_pk(s.time, s.Cve_apap, "apap", weighted=True)
+        for key in ["auc", "cmax"]:
+            assert pk[key] == pytest.approx(pk_dense[key], rel=1E-4)
+        assert pk["thalf"] == pytest.approx(pk_dense["thalf"], rel=1E-2)
+
+    # parameter changes on time grid of baseline
+    result = lfsim.simulate(r, 24, 100, dosing, outputs=["Cve_apap"], adaptive=True,
+                            parameters={"BW": 70.0})
+    assert result.mean.shape == result.base.shape
+    np.testing.assert_allclose(result.mean.time, result.base.time)
+
+
+def test_simulate_pk():
+    from liverfunction.pharmacokinetic import f_pk
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    schedule = lfsim.DosingSchedule.repeated(dosing, interval=6, n=3)
+    outputs = ["Ave_apap", "Aurine_apap"]
+    for d in [dosing, schedule]:
+        s = lfsim.simulate(r, 24, 96, d, outputs=outputs, changes={"BW": 80.0})
+
+        chunks = list(lfsim.iter_timecourse(r, 24, 96, d, changes={"BW": 80.0}, chunksize=10))
+        assert max(len(chunk) for chunk in chunks) <= 10
+        data_chunks = np.vstack([chunk.data for chunk in chunks])
+        np.testing.assert_allclose(data_chunks, s[chunks[0].columns].values, rtol=1E-4, atol=1E-8)
+
+        with warnings.catch_warnings():
+            # no maximum in urine
+            warnings.simplefilter("ignore")
+            pks = lfsim.simulate_pk(r, 24, 96, d, outputs=outputs, changes={"BW": 80.0},
+                                    pk_kwargs={"dose": 2000}, chunksize=10)
+            assert list(pks.keys()) == outputs
+            for key in outputs:
+                pk = f_pk(s.time, s[key], compound=key, dose=2000)
+                for name in ["auc", "cmax", "tmax", "thalf"]:
+                    assert pks[key][name] == pytest.approx(pk[name], rel=1E-4, nan_ok=True)
+
+
+def test_simulate_sensitivities():
+    r = lfsim.load_model(model_path=data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    # smooth parameters (the cardiac output has a kink in HR - HRrest at the reference)
+    parameters = {pid: value for pid, value in
+                  list(lfsim.parameters_for_sensitivity(r, data.APAP_SBML).items())[4:8]}
+
+    sv = lfsim.simulate_sensitivities(r, 10, 20, dosing, parameters, outputs=["Cve_apap"],
+                                      sensitivity=0.01)
+    (Nt, Ns) = sv.result.shape
+    assert sv.dsdp.shape == (Nt, Ns, 4)
+    assert sv.parameters == list(parameters.keys())
+    k_time = sv.result.columns.index("time")
+    np.testing.assert_array_equal(sv.dsdp[:, k_time, :], 0.0)
+
+    # central differences
+    base = lfsim.simulate(r, 10, 20, dosing, outputs=["Cve_apap"])
+    for k, pid in enumerate(sv.parameters):
+        s_up = lfsim.simulate(r, 10, 20, dosing, changes={pid: parameters[pid] * 1.001},
+                              outputs=["Cve_apap"])
+        s_down = lfsim.simulate(r, 10, 20, dosing, changes={pid: parameters[pid] * 0.999},
+                                outputs=["Cve_apap"])
+        dsdp = (s_up.Cve_apap.values - s_down.Cve_apap.values) / (0.002 * parameters[pid])
+        np.testing.assert_allclose(sv.dsdp[:, sv.result.columns.index("Cve_apap"), k], dsdp,
+                                   rtol=1E-2, atol=1E-3 * np.max(np.abs(dsdp)))
+
+    # linearized bands close to the difference runs for small changes
+    result = lfsim.simulate(r, 10, 20, dosing, outputs=["Cve_apap"], parameters=parameters,
+                            sensitivity=0.01)
+    scale = np.max(base.Cve_apap.values)
+    for field in lfsim.Result._fields:
+        np.testing.assert_allclose(getattr(sv.result, field).Cve_apap.values,
+                                   getattr(result, field).Cve_apap.values, atol=1E-3 * scale)
+
+    sv_parallel = lfsim.simulate_sensitivities(r, 10, 20, dosing, parameters, outputs=["Cve_apap"],
+                                               sensitivity=0.01, n_workers=2)
+    np.testing.assert_array_equal(sv_parallel.dsdp, sv.dsdp)
@@ -0,0 +1,97 @@
+import warnings
+import numpy as np
+import pytest
+
+from liverfunction import simulation as lfsim
+from liverfunction import surrogate
+from liverfunction.tests import data
+
+
+def linear_surrogate():
+    """ Surrogate of metrics linear in the parameters (exact interpolation). """
+    axes = [np.linspace(0, 1, 5), np.array([1.0, 2.0, 4.0])]
+    a, b = np.meshgrid(*axes, indexing="ij")
+    values = np.stack([1 + a + 2*b, 3 - a + b], axis=-1)
+    return surrogate.Surrogate(["a", "b"], axes, [("y", "auc"), ("y", "cmax")], values)
+
+
+def test_surrogate_predict():
+    s = linear_surrogate()
+    points = np.array([[0.1, 1.5], [0.0, 1.0], [1.0, 4.0], [0.55, 3.3]])
+    expected = np.column_stack([1 + points[:, 0] + 2*points[:, 1], 3 - points[:, 0] + points[:, 1]])
+    np.testing.assert_allclose(s.predict(points), expected)
+    np.testing.assert_allclose(s.predict({"a": points[:, 0], "b": points[:, 1]}), expected)
+    assert s(a=0.1, b=1.5) == pytest.approx({("y", "auc"): 4.1, ("y", "cmax"): 4.4})
+    # clipped to the grid
+    np.testing.assert_allclose(s.predict([2.0, 10.0]), s.predict([1.0, 4.0]))
+
+    with pytest.raises(ValueError):
+        surrogate.Surrogate(["a"], [np.array([1.0, 0.0])], [("y", "auc")], np.zeros((2, 1)))
+
+
+def test_surrogate_inverse(tmp_path):
+    s = linear_surrogate()
+    observed = {"auc": 1 + 0.3 + 2*2.7, "cmax": 3 - 0.3 + 2.7}
+
+    # single batched interpolation of the refined neighbourhoods
+    calls = []
+    predict = s.predict
+
+    def predict_counted(points):
+        calls.append(np.shape(points))
+        return predict(points)
+
+    s.predict = predict_counted
+    estimate = s.inverse(observed, candidates=3, refine=4)
+    assert calls == [(3 * 9**2, 2)]
+    # resolution grid spacing / refine
+    assert estimate.parameters["a"] == pytest.approx(0.3, abs=0.25/4)
+    assert estimate.parameters["b"] == pytest.approx(2.7, abs=2.0/4)
+    del calls[:]
+    estimate = s.inverse(observed, levels=3)
+    assert len(calls) == 3
+    assert estimate.parameters["a"] == pytest.approx(0.3, abs=0.25/4**3)
+    assert estimate.parameters["b"] == pytest.approx(2.7, abs=2.0/4**3)
+    del s.predict
+
+    estimate = s.inverse(observed, polish=True)
+    assert estimate.parameters["a"] == pytest.approx(0.3)
+    assert estimate.parameters["b"] == pytest.approx(2.7)
+    assert estimate.residual == pytest.approx(0.0, abs=1E-16)
+
+    # observed zero (absolute error) and three parameters
+    axes = [np.linspace(0, 1, 5), np.array([1.0, 2.0, 4.0]), np.linspace(-1, 1, 6)]
+    a, b, c = np.meshgrid(*axes, indexing="ij")
+    values = np.stack([1 + a + 2*b + c, a - 0.5, b + 2*c], axis=-1)
+    s3 = surrogate.Surrogate(["a", "b", "c"], axes, [("y", "auc"), ("y", "lag"), ("y", "cmax")], values)
+    estimate = s3.inverse({"auc": 1 + 0.5 + 2*3.0 - 0.3, "lag": 0.0, "cmax": 3.0 - 0.6}, polish=True)
+    assert estimate.parameters == pytest.approx({"a": 0.5, "b": 3.0, "c": -0.3})
+    assert estimate.metrics[("y", "lag")] == pytest.approx(0.0, abs=1E-8)
+
+    path = str(tmp_path / "surrogate.npz")
+    s.to_npz(path)
+    loaded = surrogate.Surrogate.from_npz(path)
+    assert loaded.parameters == s.parameters
+    assert loaded.keys == s.keys
+    np.testing.assert_array_equal(loaded.values, s.values)
+
+
+def test_build_surrogate():
+    r = lfsim.load_model(data.APAP_SBML)
+    dosing = lfsim.Dosing(substance="apap", route="oral", dose=2000, unit="mg")
+    grid = {"FVli": np.linspace(0.015, 0.027, 5), "LI__APAPUGT_HLM_CL": np.linspace(0.8, 1.8, 5)}
+    kwargs = dict(pk_kwargs={"dose": 2000})
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        s = surrogate.build_surrogate(r, 24, 96, dosing, grid, outputs=["Cve_apap"],
+                                      metrics=("auc", "cmax"), **kwargs)
+        assert s.values.shape == (5, 5, 2)
+        pks = lfsim.simulate_pk(r, 24, 96, dosing, ["Cve_apap"], changes={
+            "FVli": grid["FVli"][1], "LI__APAPUGT_HLM_CL": grid["LI__APAPUGT_HLM_CL"][3]
+        }, pk_kwargs=kwargs["pk_kwargs"])
+        assert s.values[1, 3, 0] == pytest.approx(pks["Cve_apap"]["auc"])
+
+        report = surrogate.surrogate_error(s, r, 24, 96, dosing, n=4, seed=1, **kwargs)
+    assert list(report.metric) == ["auc", "cmax"]
+    assert np.all(report.max_rel_error < 0.05)